@@ -0,0 +1,343 @@
+# This script measures the stages of the build pipeline on the reference
+# data and on synthetically scaled copies of it. Each stage runs in a fresh
+# Python process, so that the peak memory of a stage is not mixed up with the
+# memory of other stages. The results are written to a JSON file that can be
+# compared with the results of another commit via `--compare`.
+#
+# The peak RSS of a process includes the setup of a stage (e.g. reading the
+# reference data before the impact matrix is built), so it is only an upper
+# bound for the memory of the stage, and the difference to the RSS before
+# the stage only a lower bound. The memory of a stage is therefore measured
+# with tracemalloc (in the main process) in a second, untimed run of the
+# stage after a fresh setup.
+#
+# python benchmark.py --scale 1 2 10 --out build/benchmarks/new.json \
+#   --compare build/benchmarks/old.json
+
+import argparse
+import csv
+import gc
+import json
+import hashlib
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable
+
+import model
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+_BUILD = Path(__file__).parent.parent / "build"
+
+STAGES = ["read", "read_npz", "impact_matrix", "lib_write", "packs", "order"]
+
+
+@dataclass
+class Result:
+    stage: str
+    scale: int
+    wall_s: float
+    peak_rss_mb: float
+    rss_before_mb: float
+    # the net change of the live memory blocks after the stage, i.e. the
+    # blocks that are retained by the stage; not the number of allocations
+    retained_blocks: int
+    traced_peak_mb: float
+    # the growth of the peak RSS during the stage; a lower bound for the
+    # memory of the stage
+    stage_rss_mb: float = 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="measures the stages of the build pipeline"
+    )
+    parser.add_argument(
+        "--stage",
+        nargs="*",
+        choices=STAGES,
+        default=STAGES,
+        help="the stages to measure",
+    )
+    parser.add_argument(
+        "--scale",
+        nargs="*",
+        type=int,
+        default=[1],
+        help="the factors by which the flows and LCIA factors are scaled",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=_BUILD / "benchmarks" / f"{int(time.time())}.json",
+    )
+    parser.add_argument("--compare", type=Path, help="a previous result file")
+    parser.add_argument(
+        "--refdata",
+        type=Path,
+        default=model._ref_dir,
+        help="the reference data folder",
+    )
+    parser.add_argument("--run", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # in a child process, we run a single stage on a given data folder
+    if args.run is not None:
+        (stage, ref_dir) = args.run
+        result = run_stage(stage, Path(ref_dir), args.workers)
+        print(json.dumps(asdict(result)))
+        return
+
+    model._ref_dir = args.refdata
+    results: list[Result] = []
+    for scale in args.scale:
+        ref_dir = scaled_refdata(scale)
+        for stage in args.stage:
+            cmd = [
+                sys.executable,
+                __file__,
+                "--run",
+                stage,
+                str(ref_dir),
+                "--workers",
+                str(args.workers),
+            ]
+            out = subprocess.run(cmd, capture_output=True, text=True)
+            if out.returncode != 0:
+                print(out.stderr, file=sys.stderr)
+                raise RuntimeError(f"stage {stage} failed")
+            last = out.stdout.strip().splitlines()[-1]
+            result = Result(**json.loads(last))
+            result.scale = scale
+            results.append(result)
+            print(
+                f"{stage:>14} x{scale:<3} {result.wall_s:8.2f} s"
+                f" {result.traced_peak_mb:8.1f} MB traced"
+                f" {result.peak_rss_mb:8.1f} MB peak RSS"
+            )
+
+    report = {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "workers": args.workers,
+        "results": [asdict(r) for r in results],
+    }
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {args.out}")
+    if args.compare is not None:
+        compare(args.compare, report)
+
+
+def run_stage(stage: str, ref_dir: Path, workers: int = 1) -> Result:
+    """Runs the setup and then the measured part of a stage: first timed
+    and then, after a fresh setup, with tracemalloc for the memory of the
+    stage."""
+    model._ref_dir = ref_dir
+    tmp = Path(tempfile.mkdtemp(prefix="olca-bench-"))
+    try:
+        _use_tmp(tmp / "timed")
+        fn = _setup(stage, tmp / "timed", workers)
+        gc.collect()
+        rss_before = _rss_mb()
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        fn()
+        wall = time.perf_counter() - start
+        peak_rss = _rss_mb()
+        blocks = sys.getallocatedblocks() - blocks
+        del fn
+        gc.collect()
+
+        _use_tmp(tmp / "traced")
+        fn = _setup(stage, tmp / "traced", workers)
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        traced = tracemalloc.get_traced_memory()[1] / 1024**2
+        tracemalloc.stop()
+        return Result(
+            stage=stage,
+            scale=1,
+            wall_s=round(wall, 3),
+            peak_rss_mb=round(peak_rss, 1),
+            rss_before_mb=round(rss_before, 1),
+            retained_blocks=blocks,
+            traced_peak_mb=round(traced, 1),
+            stage_rss_mb=round(max(0.0, peak_rss - rss_before), 1),
+        )
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _use_tmp(tmp: Path):
+    """Creates the temporary folder of a run and points the cache and the
+    factor store of the model into it; the factors are parsed from the CSV
+    files, unless the stage creates a factor store there (read_npz)."""
+    tmp.mkdir(parents=True)
+    model._cache_dir = tmp / "cache"
+    model._factor_store = tmp / "lcia_factors.npz"
+
+
+def _setup(stage: str, tmp: Path, workers: int) -> Callable[[], object]:
+    # the modules are imported here, so that they see the changed data
+    # folder of the model module
+    import build_libs
+    import build_packs
+    import factor_store
+    import order
+
+    match stage:
+        case "read":
+            return lambda: model.RefData.read(workers=workers)
+        case "read_npz":
+            factor_store.export(workers=workers)
+            return lambda: model.RefData.read(workers=workers)
+        case "impact_matrix":
+            data = model.RefData.read(model.RefDataSet.METHODS)
+            return lambda: build_libs._build_impact_matrix(tmp, data, workers)
+        case "lib_write":
+            data = model.RefData.read(workers=workers)
+            lib = build_libs.LibDir(tmp)
+            return lambda: lib.write(
+                data.impact_methods.values(),
+                data.impact_categories.values(),
+                workers=workers,
+            )
+        case "packs":
+            data = model.RefData.read(workers=workers)
+            return lambda: build_packs.write_packs(data, tmp, workers)
+        case "order":
+            # the files are sorted in a copy, without the recorded hashes
+            # of canonical files
+            folder = tmp / "refdata"
+            shutil.copytree(model._ref_dir, folder)
+            order._STAMPS = tmp / "order.json"
+            return lambda: order.apply(workers, folder=folder)
+    raise ValueError(f"unknown stage {stage}")
+
+
+def scaled_refdata(scale: int) -> Path:
+    """Returns the reference data folder with `scale` times the flows and
+    LCIA factors. The copies of the flows get name-based UUIDs, so that
+    the scaled data are the same in each run and can be reused."""
+    if scale <= 1:
+        return model._ref_dir
+    folder = _BUILD / "benchmarks" / f"refdata_x{scale}"
+    stamp = folder / "source.txt"
+    source = _fingerprint(model._ref_dir)
+    if stamp.exists() and stamp.read_text() == source:
+        return folder
+    shutil.rmtree(folder, ignore_errors=True)
+    print(f"create scaled reference data x{scale}")
+    tmp = folder.parent / f"{folder.name}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    shutil.copytree(
+        model._ref_dir, tmp, ignore=shutil.ignore_patterns("lcia_factors")
+    )
+
+    def scaled(path: Path, target: Path, cols: list[int]):
+        with open(path, "r", encoding="utf-8", newline="") as inp, open(
+            target, "w", encoding="utf-8", newline=""
+        ) as out:
+            reader = csv.reader(inp)
+            writer = csv.writer(out)
+            writer.writerow(next(reader))
+            for row in reader:
+                writer.writerow(row)
+                for i in range(1, scale):
+                    copy = list(row)
+                    for col in cols:
+                        copy[col] = _copy_id(row[col], i)
+                    writer.writerow(copy)
+
+    for file in ["flows.csv", "flow_property_factors.csv"]:
+        if (model._ref_dir / file).exists():
+            scaled(model._ref_dir / file, tmp / file, [0])
+    (tmp / "lcia_factors").mkdir()
+    for path in (model._ref_dir / "lcia_factors").iterdir():
+        scaled(path, tmp / "lcia_factors" / path.name, [1])
+    (tmp / "source.txt").write_text(source)
+    os.replace(tmp, folder)
+    return folder
+
+
+def _fingerprint(folder: Path) -> str:
+    hasher = hashlib.sha1()
+    for path in sorted(folder.rglob("*")):
+        if path.is_file():
+            stat = path.stat()
+            hasher.update(f"{path}|{stat.st_size}|{stat.st_mtime_ns}".encode())
+    return hasher.hexdigest()
+
+
+def compare(base_file: Path, report: dict):
+    with open(base_file, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    base_results = {(r["stage"], r["scale"]): r for r in base["results"]}
+    print(f"compared to {base.get('commit')}:")
+    for r in report["results"]:
+        b = base_results.get((r["stage"], r["scale"]))
+        if b is None:
+            continue
+        print(
+            f"{r['stage']:>14} x{r['scale']:<3}"
+            f" time {_ratio(r['wall_s'], b['wall_s'])}"
+            f" memory {_ratio(r['traced_peak_mb'], b.get('traced_peak_mb'))}"
+            f" peak RSS {_ratio(r['peak_rss_mb'], b['peak_rss_mb'])}"
+        )
+
+
+def _ratio(new: float, old: float | None) -> str:
+    if not old:
+        return "   n/a"
+    return f"{(new - old) / old:+6.1%}"
+
+
+def _copy_id(flow_id: str, i: int) -> str:
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{flow_id}/{i}"))
+
+
+def _rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return rss / 1024**2
+    return rss / 1024
+
+
+def _commit() -> str | None:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        )
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,23 @@
+import argparse
 import csv
+import hashlib
 import json
 import logging as log
+import os
 import shutil
+from array import array
 from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, Iterable, Self, TypeVar
 
+import formulas
+import jsonzip
+import library
 import model
+import stages
+import numpy as np
 import olca_schema as lca
 from scipy import sparse
-from olca_schema import zipio
 
 
 VERSION = "2.0.0.alpha"
@@ -17,6 +25,38 @@ VERSION = "2.0.0.alpha"
 E = TypeVar("E", bound=lca.RootEntity)
 _LIB = Path(__file__).parent.parent / "build" / "libraries"
 
+# the input files of the libraries, relative to the refdata folder; folders
+# stand for all files in them and patterns for all matching files
+_UNIT_INPUTS = [
+    "currencies.csv",
+    "flow_properties.csv",
+    "unit_groups.csv",
+    "units.csv",
+]
+_FLOW_INPUTS = [
+    "flow_property_factors.csv",
+    "flows.csv",
+    "locations.csv",
+]
+# the scripts that are used when building the libraries
+_SCRIPTS = [
+    "build_libs.py",
+    "formulas.py",
+    "jsonzip.py",
+    "library.py",
+    "model.py",
+    "stages.py",
+]
+
+_IMPACT_INPUTS = [
+    "lcia_categories.csv",
+    "lcia_factors",
+    "lcia_method_categories.csv",
+    "lcia_method_nw_sets.csv",
+    "lcia_methods.csv",
+    "lcia_parameters_*.csv",
+]
+
 
 @dataclass
 class LibDir:
@@ -26,20 +66,69 @@ class LibDir:
     def name(self) -> str:
         return self.path.name
 
+    @property
+    def inputs_file(self) -> Path:
+        return _LIB / f"{self.name}_inputs.json"
+
+    @staticmethod
+    def current(base_name: str, inputs: dict[str, Any]) -> "LibDir | None":
+        """Returns the library if it was already built from the given inputs;
+        see `inputs_of`."""
+        lib = LibDir(_LIB / f"{base_name}-{VERSION}")
+        if (
+            lib.read_inputs() != inputs
+            or not (_LIB / f"{lib.name}_lib.zip").exists()
+        ):
+            return None
+        log.info("library %s is up to date", lib.name)
+        return lib
+
     @staticmethod
     def of(base_name: str, deps: list["LibDir"] = []) -> "LibDir":
         full_name = f"{base_name}-{VERSION}"
         log.info("init library %s", full_name)
         path = _LIB / full_name
+        lib = LibDir(path)
+
+        # the recorded inputs and the package of a previous build are removed
+        # first, so that an interrupted build is never taken as up to date;
+        # the inputs are written again when the library is finished
+        prev = (lib.read_inputs() or {}).get("dependencies", {})
+        lib.inputs_file.unlink(missing_ok=True)
+        (_LIB / f"{full_name}_lib.zip").unlink(missing_ok=True)
+
+        # remove the outputs of a previous build, except of the copied
+        # dependencies that are checked below
+        if path.exists():
+            for child in path.iterdir():
+                if child.name == "dependencies":
+                    continue
+                if child.is_dir():
+                    shutil.rmtree(child)
+                else:
+                    child.unlink()
         path.mkdir(exist_ok=True, parents=True)
 
-        # copy dependencies
+        # copy dependencies that changed since the last build
+        depdir = path / "dependencies"
         if hasdeps := len(deps) > 0:
             log.info("copy dependencies of %s", full_name)
-            depdir = path / "dependencies"
             depdir.mkdir(exist_ok=True)
             for dep in deps:
-                shutil.copytree(dep.path, depdir / dep.name)
+                target = depdir / dep.name
+                if target.exists():
+                    if prev.get(dep.name) == dep.fingerprint():
+                        log.info("dependency %s is up to date", dep.name)
+                        continue
+                    shutil.rmtree(target)
+                shutil.copytree(dep.path, target)
+        if depdir.exists():
+            names = {dep.name for dep in deps}
+            for child in depdir.iterdir():
+                if child.name not in names:
+                    shutil.rmtree(child)
+            if not hasdeps:
+                depdir.rmdir()
 
         # create the library manifest
         info: dict[str, Any] = {"name": full_name}
@@ -48,18 +137,17 @@ class LibDir:
         with open(path / "library.json", "w", encoding="utf-8") as out:
             json.dump(info, out, indent="  ")
 
-        return LibDir(path)
+        return lib
 
-    def write(self, *seqs: Iterable[E]) -> Self:
+    def write(
+        self, *seqs: Iterable[E], workers: int = 1, compresslevel: int = 6
+    ) -> Self:
         log.info("write data to %s", self.name)
-        with zipio.ZipWriter(str(self.path / "meta.zip")) as z:
+        with jsonzip.ZipWriter(
+            str(self.path / "meta.zip"), workers, compresslevel
+        ) as z:
             for seq in seqs:
-                handled = set()
-                for e in seq:
-                    if e.id in handled:
-                        continue
-                    handled.add(e.id)
-                    z.write(e)
+                z.write_all(seq)
         return self
 
     def package(self) -> Self:
@@ -68,91 +156,346 @@ class LibDir:
         shutil.make_archive(str(_LIB / pack), "zip", str(self.path))
         return self
 
+    def read_inputs(self) -> dict[str, Any] | None:
+        if not self.inputs_file.exists():
+            return None
+        with open(self.inputs_file, "r", encoding="utf-8") as inp:
+            return json.load(inp)
+
+    def save_inputs(self, inputs: dict[str, Any]) -> Self:
+        """Records the inputs of a finished build; see `inputs_of`. This must
+        be the last step of a build, after all files of the library were
+        written and packaged."""
+        tmp = self.inputs_file.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as out:
+            json.dump(inputs, out, indent="  ", sort_keys=True)
+        os.replace(tmp, self.inputs_file)
+        return self
 
-def main():
-    if _LIB.exists():
+    def fingerprint(self) -> str | None:
+        if not self.inputs_file.exists():
+            return None
+        return hashlib.sha1(self.inputs_file.read_bytes()).hexdigest()
+
+
+def inputs_of(
+    files: list[str],
+    deps: list[LibDir] = [],
+    options: dict[str, Any] | None = None,
+) -> dict[str, Any]:
+    """Collects the content hashes of the given refdata files, the build
+    scripts, the build options that change the output, and the recorded
+    inputs of the dependencies of a library."""
+    hashes: dict[str, str] = {}
+    for name in files:
+        path = model._ref_dir / name
+        if "*" in name:
+            paths = sorted(model._ref_dir.glob(name))
+        elif path.is_dir():
+            paths = sorted(path.iterdir())
+        else:
+            paths = [path]
+        for p in paths:
+            if p.is_file():
+                key = p.relative_to(model._ref_dir).as_posix()
+                hashes[key] = _sha1_of(p)
+    scripts = Path(__file__).parent
+    return {
+        "version": VERSION,
+        "scripts": {f: _sha1_of(scripts / f) for f in _SCRIPTS},
+        "options": options or {},
+        "files": hashes,
+        "dependencies": {dep.name: dep.fingerprint() for dep in deps},
+    }
+
+
+def _sha1_of(path: Path) -> str:
+    with open(path, "rb") as inp:
+        return hashlib.sha1(inp.read()).hexdigest()
+
+
+def main(
+    incremental: bool = False,
+    compresslevel: int = 6,
+    regionalized: bool = False,
+    raw_matrix: str | None = None,
+):
+    """Builds the libraries. In incremental mode, libraries and copied
+    dependencies are only rebuilt when their inputs changed. In regionalized
+    mode, the columns of the LCIA library are (flow, location) pairs; see
+    `_build_impact_matrix`. With a raw matrix format (`full` or `compact`),
+    the LCIA library also gets a memory-mappable copy of C."""
+    workers = os.cpu_count() or 1
+    if _LIB.exists() and not incremental:
         shutil.rmtree(str(_LIB))
-    _LIB.mkdir(parents=True)
-
-    data = model.RefData.read(model.RefDataSet.ALL)
-
-    unit_lib = (
-        LibDir.of("openLCA-ref-units")
-        .write(
-            data.currencies.values(),
-            data.unit_groups.values(),
-            data.flow_properties.values(),
-        )
-        .package()
+    _LIB.mkdir(parents=True, exist_ok=True)
+
+    # the impact matrix only needs the numbers of the characterization
+    # factors; so we do not create the factor objects here
+    data = model.RefData.read(model.RefDataSet.METHODS, cache=True)
+
+    options: dict[str, Any] = {"compresslevel": compresslevel}
+    inputs = inputs_of(_UNIT_INPUTS, options=options)
+    unit_lib = LibDir.current("openLCA-ref-units", inputs)
+    if unit_lib is None:
+        with stages.stage("units library"):
+            unit_lib = (
+                LibDir.of("openLCA-ref-units")
+                .write(
+                    data.currencies.values(),
+                    data.unit_groups.values(),
+                    data.flow_properties.values(),
+                    workers=workers,
+                    compresslevel=compresslevel,
+                )
+                .package()
+                .save_inputs(inputs)
+            )
+
+    inputs = inputs_of(_FLOW_INPUTS, deps=[unit_lib], options=options)
+    flow_lib = LibDir.current("openLCA-ref-flows", inputs)
+    if flow_lib is None:
+        with stages.stage("flows library"):
+            flow_lib = (
+                LibDir.of("openLCA-ref-flows", deps=[unit_lib])
+                .write(
+                    data.flows.values(),
+                    data.locations.values(),
+                    workers=workers,
+                    compresslevel=compresslevel,
+                )
+                .package()
+                .save_inputs(inputs)
+            )
+
+    deps = [unit_lib, flow_lib]
+    inputs = inputs_of(
+        _IMPACT_INPUTS,
+        deps,
+        options={
+            **options,
+            "regionalized": regionalized,
+            "raw matrix": raw_matrix,
+        },
     )
-
-    flow_lib = (
-        LibDir.of("openLCA-ref-flows", deps=[unit_lib])
-        .write(
-            data.flows.values(),
-            data.locations.values(),
+    impact_name = "openLCA-LCIA-pack"
+    if regionalized:
+        impact_name += "-regionalized"
+    if LibDir.current(impact_name, inputs) is not None:
+        return
+    impact_lib = LibDir.of(impact_name, deps)
+    with stages.stage("impact matrix"):
+        _build_impact_matrix(
+            impact_lib.path, data, workers, regionalized, raw_matrix
         )
-        .package()
-    )
-
-    impact_lib = LibDir.of(
-        "openLCA-LCIA-pack",
-        deps=[
-            unit_lib,
-            flow_lib,
-        ],
-    )
-    _build_impact_matrix(impact_lib.path, data)
-    impacts = [i for i in data.impact_categories.values()]
-    for i in impacts:
-        i.impact_factors = None
-    impact_lib.write(
-        data.impact_methods.values(),
-        impacts,
-    ).package()
-
-
-def _build_impact_matrix(libdir: Path, data: model.RefData):
+    with stages.stage("LCIA library"):
+        impact_lib.write(
+            data.impact_methods.values(),
+            data.impact_categories.values(),
+            workers=workers,
+            compresslevel=compresslevel,
+        ).package().save_inputs(inputs)
+
+
+def _build_impact_matrix(
+    libdir: Path,
+    data: model.RefData,
+    workers: int = 1,
+    regionalized: bool = False,
+    raw_matrix: str | None = None,
+):
+    """Creates the matrix C and its indices in the library folder. In
+    regionalized mode, a flow gets a separate column for each location of
+    its factors (and one for its factors without location) instead of
+    summing up these factors in a single column.
+
+    Next to the compressed `C.npz` that openLCA reads, a raw matrix format
+    writes the CSC arrays of C into `C.bin` that can be memory-mapped
+    without copying: with float64 values and int64 indices in the `full`
+    format, or with float32 values and int32 indices in the `compact`
+    format. The compact format falls back to float64 values when factors
+    cannot be stored as float32 numbers; see `library.write_raw`."""
     log.info("create impact matrix C in %s", libdir)
-    flow_idx: dict[str, int] = {}
-    impact_idx: dict[str, int] = {}
-    rows: list[int] = []
-    cols: list[int] = []
-    vals: list[float] = []
 
-    for impact in data.impact_categories.values():
-        if impact.id is None or impact.impact_factors is None:
-            continue
-        row = impact_idx.get(impact.id, -1)
-        if row == -1:
+    # we stream the factors file by file into growing typed arrays that hold
+    # the matrix entries; flows get a column when they first occur and the
+    # rows are sorted by the order of the categories when we are done
+    factors = model.FactorTable()
+    impact_idx: dict[str, int] = {}
+    flow_ids: list[str] = []
+    col_of = np.full(0, -1, dtype=np.intc)
+    pairs = _PairColumns(factors, flow_ids) if regionalized else None
+    rows = array("i")
+    cols = array("i")
+    vals = array("d")
+
+    # the factors with formulas get their columns like the other factors;
+    # they are evaluated when all categories and parameters are known
+    formula_rows = array("i")
+    formula_cols = array("i")
+    formula_sources: list[str] = []
+
+    for (impact_id, columns) in factors.stream(data, workers):
+        stages.count(len(columns.values))
+        row = impact_idx.get(impact_id)
+        if row is None:
             row = len(impact_idx)
-            impact_idx[impact.id] = row
-
-        for factor in impact.impact_factors:
-            if (
-                factor.flow is None
-                or factor.flow.id is None
-                or factor.value is None
-                or factor.value == 0
-            ):
-                continue
-            col = flow_idx.get(factor.flow.id, -1)
-            if col == -1:
-                col = len(flow_idx)
-                flow_idx[factor.flow.id] = col
-            rows.append(row)
-            cols.append(col)
-            vals.append(factor.value)
-
-    (k, m) = (len(impact_idx), len(flow_idx))
+            impact_idx[impact_id] = row
+        nonzero = columns.values != 0
+        flows = columns.flows[nonzero]
+        n = len(flows)
+        fs = columns.formulas
+        if fs:
+            extra = np.array([f.flow for f in fs], dtype=flows.dtype)
+            flows = np.concatenate((flows, extra))
+        if len(flows) == 0:
+            continue
+
+        if pairs is not None:
+            locations = columns.locations[nonzero]
+            if fs:
+                extra = np.array([f.location for f in fs], locations.dtype)
+                locations = np.concatenate((locations, extra))
+            chunk_cols = pairs.cols_of(flows, locations)
+        else:
+            if len(col_of) < len(factors.flows):
+                grow = np.full(len(factors.flows) - len(col_of), -1, np.intc)
+                col_of = np.concatenate((col_of, grow))
+            (new, first) = np.unique(
+                flows[col_of[flows] < 0], return_index=True
+            )
+            new = new[np.argsort(first)]
+            col_of[new] = np.arange(len(flow_ids), len(flow_ids) + len(new))
+            flow_ids.extend(factors.flows[i] for i in new)
+            chunk_cols = col_of[flows]
+
+        rows.frombytes(np.full(n, row, dtype=np.intc).tobytes())
+        cols.frombytes(chunk_cols[:n].tobytes())
+        vals.frombytes(columns.values[nonzero].tobytes())
+        if fs:
+            formula_rows.frombytes(np.full(len(fs), row, np.intc).tobytes())
+            formula_cols.frombytes(chunk_cols[n:].tobytes())
+            formula_sources.extend(f.formula for f in fs)
+
+    impact_ids = [
+        impact.id
+        for impact in data.impact_categories.values()
+        if impact.id in impact_idx
+    ]
+    (k, m) = (len(impact_ids), len(flow_ids))
     if k == 0 or m == 0:
         log.warning("no LCIA factors found")
         return
+    row_of = np.empty(k, dtype=np.intc)
+    for (i, impact_id) in enumerate(impact_ids):
+        row_of[impact_idx[impact_id]] = i
+
+    # the values of the formulas with the default parameters of the
+    # categories are added to C; with other parameter sets, these values
+    # are replaced, see library.Library.matrix
+    params = _parameters_of(data, impact_ids)
+    formula_factors = formulas.FormulaFactors(
+        rows=row_of[np.frombuffer(formula_rows, dtype=np.intc)],
+        cols=np.frombuffer(formula_cols, dtype=np.intc).copy(),
+        formulas=formula_sources,
+        defaults=np.zeros(len(formula_sources)),
+    )
+    if len(formula_factors) > 0:
+        defaults = formula_factors.evaluate(impact_ids, params)[:, 0]
+        defaults = np.nan_to_num(defaults, nan=0.0)
+        formula_factors.defaults = defaults
+        nonzero = defaults != 0
+        rows.frombytes(
+            np.frombuffer(formula_rows, dtype=np.intc)[nonzero].tobytes()
+        )
+        cols.frombytes(formula_factors.cols[nonzero].tobytes())
+        vals.frombytes(defaults[nonzero].tobytes())
+        formulas.write_formulas(libdir, formula_factors, params)
+
     log.info("write %ix%i matrix C with %i entries", k, m, len(vals))
-    csc = sparse.coo_array((vals, (rows, cols)), shape=(k, m)).tocsc()
+    if stage := stages.current():
+        stage.details["shape of C"] = (k, m)
+        stage.details["entries of C"] = len(vals)
+        stage.details["formula factors"] = len(formula_factors)
+        if pairs is not None:
+            stage.details["regionalized columns"] = sum(
+                1 for loc in pairs.location_ids if loc is not None
+            )
+
+    # assemble the CSC arrays directly: sort the entries by column and count
+    # the entries per column for the column pointers
+    col_arr = np.frombuffer(cols, dtype=np.intc)
+    order = np.argsort(col_arr, kind="stable")
+    indptr = np.zeros(m + 1, dtype=np.intc)
+    np.cumsum(np.bincount(col_arr, minlength=m), out=indptr[1:])
+    indices = row_of[np.frombuffer(rows, dtype=np.intc)[order]]
+    del rows, cols, col_arr
+    values = np.frombuffer(vals, dtype=np.float64)[order]
+    del vals, order
+    csc = sparse.csc_array((values, indices, indptr), shape=(k, m))
+    csc.sum_duplicates()
+
     sparse.save_npz(str(libdir / "C.npz"), csc)
-    _write_flow_idx(libdir, _swap_idx(flow_idx), data)
-    _write_impact_idx(libdir, _swap_idx(impact_idx), data)
+    library.write_csr(libdir, csc)
+    if raw_matrix is not None:
+        library.write_raw(libdir, csc, compact=raw_matrix == "compact")
+    locations = pairs.location_ids if pairs is not None else None
+    _write_flow_idx(libdir, flow_ids, data, locations)
+    _write_impact_idx(libdir, impact_ids, data)
+    _write_method_idx(libdir, impact_ids, data)
+    _write_nw_sets(libdir, impact_ids, data)
+
+
+def _parameters_of(
+    data: model.RefData, impact_ids: list[str]
+) -> formulas.Parameters:
+    """Reads the parameters of the given LCIA categories; the categories are
+    referenced by their IDs in the parameter files."""
+    ids = set(impact_ids)
+    params: formulas.Parameters = {}
+    for (key, defs) in formulas.read_parameters(model._ref_dir).items():
+        impact = data.impact_categories.get(key)
+        if impact is None or impact.id not in ids:
+            log.error("invalid LCIA category %s in parameters", key)
+            continue
+        params.setdefault(impact.id, {}).update(defs)
+    return params
+
+
+class _PairColumns:
+    """Assigns the matrix columns of a regionalized library to the (flow,
+    location) pairs of the factors in the order of their first occurrence.
+    The flow and location IDs of the columns are collected in `flow_ids`
+    and `location_ids`; the location is `None` for factors without
+    location."""
+
+    def __init__(self, factors: model.FactorTable, flow_ids: list[str]):
+        self.factors = factors
+        self.flow_ids = flow_ids
+        self.location_ids: list[str | None] = []
+        self._cols: dict[int, int] = {}
+
+    def cols_of(self, flows: np.ndarray, locations: np.ndarray) -> np.ndarray:
+        # a pair is encoded as a single integer: the flow index in the upper
+        # and the location index + 1 in the lower 32 bits
+        keys = (flows.astype(np.int64) << 32) | (locations + 1)
+        (uniq, first, inverse) = np.unique(
+            keys, return_index=True, return_inverse=True
+        )
+        cols = np.empty(len(uniq), dtype=np.intc)
+        for i in np.argsort(first, kind="stable").tolist():
+            key = int(uniq[i])
+            col = self._cols.get(key)
+            if col is None:
+                col = len(self._cols)
+                self._cols[key] = col
+                self.flow_ids.append(self.factors.flows[key >> 32])
+                loc = (key & 0xFFFFFFFF) - 1
+                self.location_ids.append(
+                    self.factors.locations[loc] if loc >= 0 else None
+                )
+            cols[i] = col
+        return cols[inverse.reshape(-1)]
 
 
 def _write_impact_idx(libdir: Path, idx: list[str], data: model.RefData):
@@ -178,7 +521,94 @@ def _write_impact_idx(libdir: Path, idx: list[str], data: model.RefData):
             writer.writerow(record)
 
 
-def _write_flow_idx(libdir: Path, idx: list[str], data: model.RefData):
+def _write_method_idx(libdir: Path, idx: list[str], data: model.RefData):
+    path = libdir / "index_methods.csv"
+    log.info("write method index %s", path)
+    row_of = {impact_id: i for (i, impact_id) in enumerate(idx)}
+    with open(path, "w", encoding="utf-8", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(
+            [
+                "method ID",
+                "method name",
+                "indicator index",
+                "indicator ID",
+            ]
+        )
+        handled: set[str] = set()
+        for method in data.impact_methods.values():
+            if method.id is None or method.id in handled:
+                continue
+            handled.add(method.id)
+            for ref in method.impact_categories or []:
+                row = row_of.get(ref.id) if ref.id else None
+                if row is None:
+                    continue
+                writer.writerow([method.id, method.name, row, ref.id])
+
+
+def _write_nw_sets(libdir: Path, idx: list[str], data: model.RefData):
+    """Writes the normalization and weighting factors of the NW sets as
+    dense vectors that are aligned with the rows of C: the rows of `N.npy`
+    and `W.npy` are the NW sets of `index_nw_sets.csv`; indicators without
+    a factor in a set are `nan`."""
+    row_of = {impact_id: i for (i, impact_id) in enumerate(idx)}
+    heads: list[list[Any]] = []
+    (norms, weights) = ([], [])
+    handled: set[str] = set()
+    for method in data.impact_methods.values():
+        if method.id is None or method.id in handled:
+            continue
+        handled.add(method.id)
+        for nw_set in method.nw_sets or []:
+            n = np.full(len(idx), np.nan)
+            w = np.full(len(idx), np.nan)
+            for factor in nw_set.factors or []:
+                ref = factor.impact_category
+                row = row_of.get(ref.id) if ref and ref.id else None
+                if row is None:
+                    continue
+                if factor.normalisation_factor is not None:
+                    n[row] = factor.normalisation_factor
+                if factor.weighting_factor is not None:
+                    w[row] = factor.weighting_factor
+            heads.append(
+                [
+                    len(heads),
+                    nw_set.id,
+                    nw_set.name,
+                    method.id,
+                    nw_set.weighted_score_unit,
+                ]
+            )
+            norms.append(n)
+            weights.append(w)
+
+    path = libdir / "index_nw_sets.csv"
+    log.info("write %i NW sets %s", len(heads), path)
+    with open(path, "w", encoding="utf-8", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(
+            [
+                "index",
+                "NW set ID",
+                "NW set name",
+                "method ID",
+                "weighted score unit",
+            ]
+        )
+        writer.writerows(heads)
+    shape = (len(heads), len(idx))
+    np.save(libdir / "N.npy", np.array(norms).reshape(shape))
+    np.save(libdir / "W.npy", np.array(weights).reshape(shape))
+
+
+def _write_flow_idx(
+    libdir: Path,
+    idx: list[str],
+    data: model.RefData,
+    locations: list[str | None] | None = None,
+):
     path = libdir / "index_B.csv"
     log.info("write flow index %s", path)
     with open(path, "w", encoding="utf-8", newline="") as out:
@@ -210,16 +640,16 @@ def _write_flow_idx(libdir: Path, idx: list[str], data: model.RefData):
             record[4] = flow.category
             record[5] = _ref_unit_of(flow, data)
             record[6] = _type_of(flow)
+            loc_id = locations[i] if locations is not None else None
+            if loc_id is not None:
+                record[7] = loc_id
+                loc = data.locations.get(loc_id)
+                if loc is not None:
+                    record[8] = loc.name
+                    record[9] = loc.code
             writer.writerow(record)
 
 
-def _swap_idx(idx: dict[str, int]) -> list[str]:
-    swapped: list[str] = [""] * len(idx)
-    for (s, i) in idx.items():
-        swapped[i] = s
-    return swapped
-
-
 def _ref_unit_of(flow: lca.Flow, data: model.RefData) -> str | None:
     if flow.flow_properties is None:
         return None
@@ -266,4 +696,39 @@ def _type_of(flow: lca.Flow) -> str:
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only rebuild libraries with changed inputs",
+    )
+    parser.add_argument(
+        "--compresslevel",
+        type=int,
+        default=6,
+        help="the zlib compression level (0-9) of the meta.zip files",
+    )
+    parser.add_argument(
+        "--regionalized",
+        action="store_true",
+        help="index the columns of the LCIA library by flow and location",
+    )
+    parser.add_argument(
+        "--raw-matrix",
+        choices=["full", "compact"],
+        help="also write C uncompressed into C.bin, so that it can be"
+        " memory-mapped; compact: with int32 indices and float32 values,"
+        " which have a relative precision of about 1e-7 only; if a factor"
+        " would change by more than 1e-6 (e.g. values below 1e-38), an"
+        " error is logged and float64 values are written instead",
+    )
+    stages.add_arguments(parser)
+    args = parser.parse_args()
+    stages.setup(args)
+    main(
+        incremental=args.incremental,
+        compresslevel=args.compresslevel,
+        regionalized=args.regionalized,
+        raw_matrix=args.raw_matrix,
+    )
+    stages.finish(args, "build_libs")
@@ -1,15 +1,18 @@
+import argparse
+import os
+import shutil
+
 from enum import StrEnum
 from pathlib import Path
-from typing import TypeVar
+from typing import Iterable
 
+import jsonzip
 import model
+import stages
 import olca_schema as lca
-from olca_schema import zipio
 
 VERSION = "2.0.0.alpha"
 
-E = TypeVar("E", bound=lca.RootEntity)
-
 
 class Pack(StrEnum):
     UNITS = "openLCA-ref-units"
@@ -17,41 +20,74 @@ class Pack(StrEnum):
     ALL = "openLCA-LCIA-pack"
 
 
-def main():
-    data = model.RefData.read()
+_BUILD = Path(__file__).parent.parent / "build"
+
+
+def main(compresslevel: int = 6):
+    workers = os.cpu_count() or 1
+    data = model.RefData.read(workers=workers, cache=True)
+    write_packs(data, workers=workers, compresslevel=compresslevel)
+
+
+def write_packs(
+    data: model.RefData,
+    folder: Path = _BUILD,
+    workers: int = 1,
+    compresslevel: int = 6,
+):
+    # each pack extends the previous one; so we copy the previous package
+    # and only add the new content to it. this way, each entity is
+    # serialized and compressed only once for all packages
+    prev: Path | None = None
     for pack in Pack:
-        _package(pack, data)
+        path = folder / f"{pack.value}_{VERSION}.zip"
+        print(f"write package: {path.name}")
+        if path.exists():
+            path.unlink()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if prev is not None:
+            shutil.copyfile(prev, path)
+        with stages.stage(pack.value), jsonzip.ZipWriter(
+            str(path), workers, compresslevel, append=prev is not None
+        ) as w:
+            for seq in _content_of(pack, data):
+                w.write_all(seq)
+        prev = path
 
 
-def _package(pack: Pack, data: model.RefData):
-    path = (
-        Path(__file__).parent.parent / "build" / f"{pack.value}_{VERSION}.zip"
-    )
-    print(f"write package: {path.name}")
-    if path.exists():
-        path.unlink()
-    with zipio.ZipWriter(str(path)) as w:
-        _write_all(data.unit_groups, w)
-        _write_all(data.flow_properties, w)
-        _write_all(data.currencies, w)
-        if pack == Pack.UNITS:
-            return
-        _write_all(data.flows, w)
-        _write_all(data.locations, w)
-        if pack == Pack.FLOWS:
-            return
-        _write_all(data.impact_categories, w)
-        _write_all(data.impact_methods, w)
-
-
-def _write_all(d: dict[str, E], writer: zipio.ZipWriter):
-    handled: set[str] = set()
-    for e in d.values():
-        if e.id is None or e.id in handled:
-            continue
-        writer.write(e)
-        handled.add(e.id)
+def _content_of(
+    pack: Pack, data: model.RefData
+) -> list[Iterable[lca.RootEntity]]:
+    """Returns the content that a pack adds to the previous pack."""
+    match pack:
+        case Pack.UNITS:
+            return [
+                data.unit_groups.values(),
+                data.flow_properties.values(),
+                data.currencies.values(),
+            ]
+        case Pack.FLOWS:
+            return [
+                data.flows.values(),
+                data.locations.values(),
+            ]
+        case Pack.ALL:
+            return [
+                data.impact_categories.values(),
+                data.impact_methods.values(),
+            ]
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--compresslevel",
+        type=int,
+        default=6,
+        help="the zlib compression level (0-9) of the packages",
+    )
+    stages.add_arguments(parser)
+    args = parser.parse_args()
+    stages.setup(args)
+    main(compresslevel=args.compresslevel)
+    stages.finish(args, "build_packs")
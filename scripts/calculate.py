@@ -0,0 +1,452 @@
+# This script calculates the LCIA results of many inventories with the matrix
+# C of the LCIA library that is created by build_libs.py. The inventories are
+# read in chunks, multiplied with C in a thread pool, and the results are
+# streamed into a CSV file per LCIA method, so that the memory usage does not
+# depend on the number of inventories. The inventories can be given as:
+#
+# * a CSV file with the columns `inventory, flow, amount` and an optional
+#   `location` column; the rows of an inventory need to be contiguous
+# * a NumPy archive (.npz) with the flow IDs in `flows`, optional location
+#   IDs in `locations`, a matrix `amounts` with a row per inventory and a
+#   column per flow, and optional inventory IDs in `inventories`
+#
+# python calculate.py inventories.csv --method "ReCiPe 2016 Midpoint (H)"
+
+import argparse
+import csv
+import logging as log
+import os
+import re
+import zipfile
+
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Sequence, TextIO
+
+import numpy as np
+from scipy import sparse
+
+import build_libs
+import library
+
+from formulas import ParameterSet
+
+# a flow of an inventory: the flow ID or a pair of flow and location ID
+FlowKey = str | tuple[str, str | None]
+Matrix = sparse.csc_array | sparse.csr_array
+
+
+@dataclass
+class Chunk:
+    """A chunk of inventories: the amounts have a row per inventory and a
+    column per flow of the calculator matrix `C_f` that is used for the
+    chunk, see `Calculator.for_flows`."""
+
+    ids: list[str]
+    amounts: np.ndarray | sparse.csr_array
+    C_f: Matrix
+
+
+class Calculator:
+    """Calculates the LCIA results of inventories with the matrix C of a
+    library. The results have a row per inventory and a column per indicator
+    of the library (the rows of C)."""
+
+    def __init__(
+        self,
+        lib: library.Library,
+        parameters: ParameterSet | None = None,
+        workers: int = 1,
+    ):
+        self.lib = lib
+        # the matrix is used as it is loaded, so that a memory-mapped matrix
+        # of the library is not copied
+        self.C: Matrix = lib.matrix(parameters)
+        self.workers = max(1, workers)
+
+    def columns_of(self, flows: Sequence[FlowKey]) -> np.ndarray:
+        """Returns the columns of the given flows in C; -1 for flows without
+        characterization factors. The locations are handled like in
+        `library.Library.inventory_vector`."""
+        columns = self.lib.columns
+        cols = np.full(len(flows), -1, dtype=np.int64)
+        for (i, key) in enumerate(flows):
+            (flow_id, loc_id) = key if isinstance(key, tuple) else (key, None)
+            col = columns.get((flow_id, loc_id))
+            if col is None and loc_id is not None:
+                col = columns.get((flow_id, None))
+            if col is not None:
+                cols[i] = col
+        return cols
+
+    def for_flows(self, flows: Sequence[FlowKey]) -> sparse.csr_array:
+        """Returns the matrix C with the columns in the order of the given
+        flows: `C_f = C * P` where `P` maps the flows to the columns of C.
+        Flows without factors get empty columns."""
+        cols = self.columns_of(flows)
+        valid = np.flatnonzero(cols >= 0)
+        if len(valid) < len(flows):
+            log.warning(
+                "%i of %i flows have no characterization factors",
+                len(flows) - len(valid),
+                len(flows),
+            )
+        P = sparse.csc_array(
+            (np.ones(len(valid)), (cols[valid], valid)),
+            shape=(self.C.shape[1], len(flows)),
+        )
+        return sparse.csr_array(self.C @ P)
+
+    def calculate(
+        self,
+        amounts: np.ndarray | sparse.csr_array,
+        C_f: Matrix | None = None,
+    ) -> np.ndarray:
+        """Calculates the results `H = G * C_f^T` of the inventories `G`. By
+        default, the columns of `G` are the columns of C."""
+        C_f = self.C if C_f is None else C_f
+        if sparse.issparse(amounts):
+            H = C_f @ sparse.csc_array(amounts.T)
+            return np.asarray(H.toarray().T)
+        return np.asarray(C_f @ np.asarray(amounts, dtype=np.float64).T).T
+
+    def stream(self, chunks: Iterable[Chunk]) -> Iterator[tuple[Chunk, Any]]:
+        """Calculates the results of the given chunks in a thread pool and
+        yields them in the order of the chunks. Only a few chunks per thread
+        are read ahead, so that the memory usage is bounded."""
+        with ThreadPoolExecutor(self.workers) as pool:
+            yield from _ordered(
+                pool,
+                lambda c: (c, self.calculate(c.amounts, c.C_f)),
+                chunks,
+                2 * self.workers,
+            )
+
+
+def _ordered(
+    pool: Executor, fn: Callable[[Any], Any], items: Iterable[Any], n: int
+) -> Iterator[Any]:
+    pending: deque[Future] = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= n:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def read_csv(
+    path: Path, calc: Calculator, chunk_size: int = 1000
+) -> Iterator[Chunk]:
+    """Reads the inventories of a CSV file in chunks. The columns of the
+    amounts are the columns of C."""
+    m = calc.C.shape[1]
+    col_cache: dict[tuple[str, str | None], int] = {}
+    done: set[str] = set()
+
+    def col_of(flow_id: str, loc_id: str | None) -> int:
+        key = (flow_id, loc_id)
+        col = col_cache.get(key)
+        if col is None:
+            col = int(calc.columns_of([key])[0])
+            col_cache[key] = col
+        return col
+
+    (ids, rows, cols, vals) = ([], [], [], [])
+    with open(path, "r", encoding="utf-8", newline="") as inp:
+        reader = csv.reader(inp)
+        header = [h.strip().lower() for h in next(reader)]
+        has_location = len(header) > 3 and header[3] == "location"
+        for row in reader:
+            if len(row) < 3:
+                continue
+            inventory = row[0]
+            if not ids or ids[-1] != inventory:
+                if inventory in done:
+                    log.error("rows of inventory %s not together", inventory)
+                if len(ids) == chunk_size:
+                    yield _csv_chunk(ids, rows, cols, vals, m, calc.C)
+                    (ids, rows, cols, vals) = ([], [], [], [])
+                ids.append(inventory)
+                done.add(inventory)
+            loc_id = None
+            if has_location and len(row) > 3:
+                loc_id = row[3].strip() or None
+            col = col_of(row[1].strip(), loc_id)
+            if col < 0:
+                continue
+            try:
+                vals.append(float(row[2]))
+            except ValueError:
+                log.error("invalid amount %s in %s", row[2], inventory)
+                continue
+            rows.append(len(ids) - 1)
+            cols.append(col)
+    if ids:
+        yield _csv_chunk(ids, rows, cols, vals, m, calc.C)
+    unknown = sum(1 for col in col_cache.values() if col < 0)
+    if unknown > 0:
+        log.warning("%i flows have no characterization factors", unknown)
+
+
+def _csv_chunk(ids, rows, cols, vals, m: int, C: Matrix) -> Chunk:
+    G = sparse.csr_array((vals, (rows, cols)), shape=(len(ids), m))
+    return Chunk(ids, G, C)
+
+
+def read_npz(
+    path: Path, calc: Calculator, chunk_size: int = 1000
+) -> Iterator[Chunk]:
+    """Reads the inventories of a NumPy archive in chunks. The rows of the
+    amounts are read directly from the archive, so that they do not need
+    to fit into memory."""
+    with np.load(path, allow_pickle=False) as npz:
+        flows = [str(f) for f in npz["flows"]]
+        locations = (
+            [str(loc) or None for loc in npz["locations"]]
+            if "locations" in npz.files
+            else None
+        )
+        ids = (
+            [str(i) for i in npz["inventories"]]
+            if "inventories" in npz.files
+            else None
+        )
+    keys: list[FlowKey] = (
+        list(zip(flows, locations)) if locations is not None else flows
+    )
+    C_f = calc.for_flows(keys)
+    start = 0
+    for amounts in _npy_rows(path, "amounts", chunk_size):
+        if amounts.shape[1] != len(flows):
+            raise ValueError(
+                f"the amounts have {amounts.shape[1]} columns but there"
+                f" are {len(flows)} flows"
+            )
+        end = start + len(amounts)
+        chunk_ids = (
+            ids[start:end]
+            if ids is not None
+            else [str(i) for i in range(start, end)]
+        )
+        yield Chunk(chunk_ids, amounts, C_f)
+        start = end
+
+
+def _npy_rows(path: Path, name: str, n: int) -> Iterator[np.ndarray]:
+    """Reads the rows of a 2-dimensional array in a .npz file in chunks of
+    `n` rows."""
+    with zipfile.ZipFile(path) as z, z.open(f"{name}.npy") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        (shape, fortran_order, dtype) = header
+        if len(shape) != 2:
+            raise ValueError(f"{name} is not a matrix: {shape}")
+        if fortran_order or dtype.hasobject:
+            # the rows are not stored contiguously; we load the array
+            with np.load(path, allow_pickle=False) as npz:
+                array = npz[name]
+            for start in range(0, shape[0], n):
+                yield array[start : start + n].astype(np.float64)
+            return
+        row_size = shape[1] * dtype.itemsize
+        for start in range(0, shape[0], n):
+            count = min(n, shape[0] - start)
+            buffer = _read_fully(f, count * row_size)
+            rows = np.frombuffer(buffer, dtype=dtype).reshape(count, shape[1])
+            yield rows.astype(np.float64)
+
+
+def _read_fully(f, size: int) -> bytes:
+    parts: list[bytes] = []
+    while size > 0:
+        part = f.read(size)
+        if not part:
+            raise EOFError("unexpected end of array data")
+        parts.append(part)
+        size -= len(part)
+    return b"".join(parts)
+
+
+class ResultWriter:
+    """Writes the results of the selected LCIA methods into a CSV file per
+    method. The files have a row per inventory and a column per indicator
+    of the method; optionally followed by the single scores of the NW sets
+    of the method."""
+
+    def __init__(
+        self,
+        lib: library.Library,
+        folder: Path,
+        methods: list[library.Method],
+        single_scores: bool = False,
+    ):
+        self.lib = lib
+        self.methods = methods
+        self.single_scores = single_scores
+        folder.mkdir(parents=True, exist_ok=True)
+        (names, units) = (lib.impact_names, lib.impact_units)
+        self._files: list[TextIO] = []
+        self._writers: list[Any] = []
+        self._nw_sets: list[list[library.NwSet]] = []
+        for method in methods:
+            f = open(
+                folder / f"{_file_name(method)}.csv",
+                "w",
+                encoding="utf-8",
+                newline="",
+            )
+            writer = csv.writer(f)
+            nw_sets = [
+                s
+                for s in lib.nw_sets.values()
+                if single_scores and s.method_id == method.id
+            ]
+            writer.writerow(
+                ["inventory"]
+                + [f"{names[i]} [{units[i]}]" for i in method.rows]
+                + [f"{s.name} [{s.unit or ''}]" for s in nw_sets]
+            )
+            self._files.append(f)
+            self._writers.append(writer)
+            self._nw_sets.append(nw_sets)
+
+    def write(self, ids: list[str], H: np.ndarray):
+        scores = self.lib.single_scores(H) if self.single_scores else None
+        for (i, method) in enumerate(self.methods):
+            block = H[:, method.rows]
+            sets = self._nw_sets[i]
+            if scores is not None and sets:
+                block = np.hstack((block, scores[:, [s.index for s in sets]]))
+            writer = self._writers[i]
+            for (inventory, values) in zip(ids, block.tolist()):
+                writer.writerow([inventory] + values)
+
+    def close(self):
+        for f in self._files:
+            f.close()
+
+
+def _file_name(method: library.Method) -> str:
+    name = re.sub(r"[^\w.-]+", "_", method.name).strip("_")
+    return f"{name}_{method.id[0:8]}"
+
+
+def calculate(
+    inventories: Path,
+    lib: library.Library,
+    out: Path,
+    methods: list[str] = [],
+    chunk_size: int = 1000,
+    workers: int = 1,
+    parameters: ParameterSet | None = None,
+    single_scores: bool = False,
+) -> int:
+    """Calculates the results of the inventories in the given file and
+    writes them into the output folder. Returns the number of inventories.
+    Raises a `KeyError` for an unknown method before anything is
+    calculated."""
+    selected: dict[str, library.Method] = {}
+    for key in methods or [m.id for m in lib.methods.values()]:
+        method = lib.methods.get(key)
+        if method is None:
+            raise KeyError(f"unknown LCIA method: {key}")
+        selected[method.id] = method
+
+    calc = Calculator(lib, parameters, workers)
+    if inventories.suffix.lower() == ".npz":
+        chunks = read_npz(inventories, calc, chunk_size)
+    else:
+        chunks = read_csv(inventories, calc, chunk_size)
+    writer = ResultWriter(lib, out, list(selected.values()), single_scores)
+    n = 0
+    try:
+        for (chunk, H) in calc.stream(chunks):
+            writer.write(chunk.ids, H)
+            n += len(chunk.ids)
+            log.info("calculated %i inventories", n)
+    finally:
+        writer.close()
+    return n
+
+
+def _parameter(s: str) -> tuple[str, float]:
+    (name, sep, value) = s.partition("=")
+    if not sep:
+        raise argparse.ArgumentTypeError(f"not a NAME=VALUE pair: {s}")
+    return (name.strip(), float(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="calculates the LCIA results of many inventories"
+    )
+    parser.add_argument(
+        "inventories", type=Path, help="the inventories, a .csv or .npz file"
+    )
+    parser.add_argument(
+        "--lib",
+        type=Path,
+        default=build_libs._LIB / f"openLCA-LCIA-pack-{build_libs.VERSION}",
+        help="the folder of the LCIA library",
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        help="the output folder; default: build/results/<inventories>",
+    )
+    parser.add_argument(
+        "--method",
+        action="append",
+        default=[],
+        help="the ID or name of an LCIA method; default: all methods",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="the number of inventories that are calculated together",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument(
+        "--parameter",
+        action="append",
+        default=[],
+        type=_parameter,
+        metavar="NAME=VALUE",
+        help="a parameter value for the formulas of the factors",
+    )
+    parser.add_argument(
+        "--single-scores",
+        action="store_true",
+        help="add the single scores of the NW sets of the methods",
+    )
+    args = parser.parse_args()
+
+    out: Path = args.out or (
+        build_libs._LIB.parent / "results" / args.inventories.stem
+    )
+    try:
+        n = calculate(
+            args.inventories,
+            library.Library(args.lib),
+            out,
+            methods=args.method,
+            chunk_size=max(1, args.chunk_size),
+            workers=args.workers,
+            parameters=dict(args.parameter),
+            single_scores=args.single_scores,
+        )
+    except KeyError as e:
+        parser.error(e.args[0])
+    print(f"wrote the results of {n} inventories to {out}")
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO)
+    main()
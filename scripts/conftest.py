@@ -0,0 +1,57 @@
+# fixtures of the tests in this folder; run with python -m pytest scripts
+
+import shutil
+
+from pathlib import Path
+
+import pytest
+
+import flowmap
+import model
+
+_REF_DIR = Path(__file__).parent.parent / "refdata"
+
+
+@pytest.fixture
+def refdata(tmp_path, monkeypatch):
+    """Returns a function that creates a small reference data folder with
+    the given files (name -> CSV text) and the units and flow properties of
+    the reference data, and points the model module to it."""
+    folder = tmp_path / "refdata"
+
+    def create(files: dict[str, str]) -> Path:
+        (folder / "lcia_factors").mkdir(parents=True, exist_ok=True)
+        for name in ("units.csv", "unit_groups.csv", "flow_properties.csv"):
+            shutil.copy(_REF_DIR / name, folder / name)
+        for (name, text) in files.items():
+            (folder / name).parent.mkdir(parents=True, exist_ok=True)
+            (folder / name).write_text(text, encoding="utf-8")
+        return folder
+
+    monkeypatch.setattr(model, "_ref_dir", folder)
+    monkeypatch.setattr(model, "_cache_dir", tmp_path / "cache")
+    monkeypatch.setattr(model, "_factor_store", tmp_path / "factors.npz")
+    return create
+
+
+@pytest.fixture
+def mapping(tmp_path, monkeypatch):
+    """Returns a function that writes a flow mapping with the given rows
+    (source, target, factor) and opens its compiled index."""
+    monkeypatch.setattr(model, "_cache_dir", tmp_path / "cache")
+
+    def create(rows: list[tuple[str, str, float]]) -> flowmap.FlowMap:
+        path = tmp_path / "mapping.csv"
+        with open(path, "w", encoding="utf-8") as out:
+            for (source, target, factor) in rows:
+                cells = [""] * len(flowmap.Col)
+                cells[flowmap.Col.SOURCE_FLOW_UUID] = source
+                cells[flowmap.Col.TARGET_FLOW_UUID] = target
+                cells[flowmap.Col.FACTOR] = str(factor)
+                cells[flowmap.Col.TARGET_FLOW_NAME] = target.upper()
+                cells[flowmap.Col.TARGET_CATEGORY] = "Emissions to air"
+                cells[flowmap.Col.TARGET_UNIT_NAME] = "kg"
+                out.write(";".join(cells) + "\n")
+        return flowmap.FlowMap.open(path)
+
+    return create
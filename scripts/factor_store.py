@@ -0,0 +1,167 @@
+# This script converts the LCIA factors between the CSV files in the
+# `refdata/lcia_factors` folder and a columnar NumPy archive. The CSV files
+# are the source of truth; the archive is a compact copy of them that is
+# loaded much faster in model.py (it is used automatically when it exists in
+# build/lcia_factors.npz and was created from the current CSV files).
+#
+# python factor_store.py export [--out FILE]
+# python factor_store.py import --out-dir FOLDER [--file FILE]
+#
+# An import writes the numbers in another textual form than the source files,
+# so it cannot write into the `refdata/lcia_factors` folder.
+
+import argparse
+import csv
+import hashlib
+import os
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+import model
+
+from model import _FactorStore
+
+_HEADER = ["LCIA category", "Flow", "Flow property", "Flow unit", "Location"]
+
+
+def export(out: Path | None = None, workers: int = 1) -> Path:
+    """Writes the factors of the CSV files into an archive."""
+    out = out or model._factor_store
+    paths = sorted((model._ref_dir / "lcia_factors").iterdir())
+    dicts: list[dict[str, int]] = [{} for _ in _FactorStore.COLUMNS]
+    columns: list[list[np.ndarray]] = [[] for _ in _FactorStore.COLUMNS]
+    values: list[np.ndarray] = []
+    offsets = [0]
+    formula_rows: list[int] = []
+    formulas: list[str] = []
+
+    # the archive should contain the parsed CSV files, so we do not use the
+    # cache or an existing archive here
+    with _no_store():
+        shards = model._factor_shards(workers)
+        for shard in shards:
+            codes = np.frombuffer(shard.codes, np.intc).reshape((-1, 5))
+            for (c, d) in enumerate(dicts):
+                used = np.unique(codes[:, c])
+                lut = np.full(len(shard.keys), -1, dtype=np.int32)
+                lut[used] = [
+                    d.setdefault(shard.keys[k], len(d)) for k in used
+                ]
+                columns[c].append(lut[codes[:, c]])
+            values.append(np.frombuffer(shard.values, dtype=np.float64))
+            for (row, formula) in sorted(shard.formulas.items()):
+                formula_rows.append(offsets[-1] + row)
+                formulas.append(formula)
+            offsets.append(offsets[-1] + len(shard))
+
+    arrays: dict[str, np.ndarray] = {
+        "shards": np.array([p.name for p in paths]),
+        "hashes": np.array([_sha1_of(p) for p in paths]),
+        "offsets": np.array(offsets, dtype=np.int64),
+        "values": _concat(values, np.float64),
+        "formula_rows": np.array(formula_rows, dtype=np.int64),
+        "formulas": np.array(formulas, dtype=str),
+    }
+    for (c, col) in enumerate(_FactorStore.COLUMNS):
+        arrays[col] = _concat(columns[c], np.int32)
+        arrays[f"{col}_keys"] = np.array(list(dicts[c].keys()), dtype=str)
+
+    out.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out.parent / f"{out.name}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp, out)
+    print(
+        f"exported {offsets[-1]} factors of {len(paths)} files to {out}"
+        f" ({out.stat().st_size / 1024**2:.1f} MB)"
+    )
+    return out
+
+
+def import_(folder: Path, file: Path | None = None):
+    """Writes the factors of an archive into CSV files in the given folder.
+    The numbers are written in their shortest representation, so the files
+    can differ in the number format from the exported files. As the CSV
+    files are the source of truth, they are never overwritten: a
+    `ValueError` is raised if the folder is the `lcia_factors` folder of
+    the reference data."""
+    if folder.resolve() == (model._ref_dir / "lcia_factors").resolve():
+        raise ValueError(
+            f"{folder} contains the source files of the LCIA factors"
+        )
+    file = file or model._factor_store
+    folder.mkdir(parents=True, exist_ok=True)
+    npz = np.load(file, allow_pickle=False)
+    keys = [npz[f"{col}_keys"].tolist() for col in _FactorStore.COLUMNS]
+    columns = [npz[col] for col in _FactorStore.COLUMNS]
+    values = npz["values"].tolist()
+    offsets = npz["offsets"]
+    formulas = dict(
+        zip(npz["formula_rows"].tolist(), npz["formulas"].tolist())
+    )
+    names = npz["shards"].tolist()
+    for (i, name) in enumerate(names):
+        with open(folder / name, "w", encoding="utf-8", newline="") as out:
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(_HEADER + ["Factor"])
+            for row in range(int(offsets[i]), int(offsets[i + 1])):
+                record = [keys[c][columns[c][row]] for c in range(5)]
+                formula = formulas.get(row)
+                record.append(
+                    formula if formula is not None else repr(values[row])
+                )
+                writer.writerow(record)
+    print(f"imported {offsets[-1]} factors into {len(names)} files")
+
+
+@contextmanager
+def _no_store() -> Iterator[None]:
+    store = model._factor_store
+    model._factor_store = Path(os.devnull) / "none"
+    try:
+        yield
+    finally:
+        model._factor_store = store
+
+
+def _concat(arrays: list[np.ndarray], dtype) -> np.ndarray:
+    if len(arrays) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def _sha1_of(path: Path) -> str:
+    with open(path, "rb") as inp:
+        return hashlib.sha1(inp.read()).hexdigest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument(
+        "--file",
+        "--out",
+        type=Path,
+        help="the archive file; default: build/lcia_factors.npz",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        help="the folder of the imported CSV files; required for import, and"
+        " it cannot be the lcia_factors folder of the reference data",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    if args.command == "export":
+        export(args.file, args.workers)
+    elif args.out_dir is None:
+        parser.error("import requires --out-dir")
+    else:
+        try:
+            import_(args.out_dir, args.file)
+        except ValueError as e:
+            parser.error(str(e))
@@ -0,0 +1,366 @@
+import argparse
+import csv
+import hashlib
+import logging as log
+import os
+import struct
+
+from dataclasses import dataclass
+from enum import IntEnum
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+import model
+
+_MAGIC = b"OLCAFMAP"
+_VERSION = 1
+
+# magic, version, rows, columns, strings, keys, size of the string table
+_HEADER = struct.Struct("<8sIIIIIQ")
+
+
+class Col(IntEnum):
+    """The columns of a flow mapping file, see
+    docs/format_csv_flow_mapping.md"""
+
+    SOURCE_FLOW_UUID = 0
+    TARGET_FLOW_UUID = 1
+    FACTOR = 2
+    SOURCE_FLOW_NAME = 3
+    SOURCE_CATEGORY = 4
+    SOURCE_LOCATION = 5
+    TARGET_FLOW_NAME = 6
+    TARGET_CATEGORY = 7
+    TARGET_LOCATION = 8
+    SOURCE_PROPERTY_UUID = 9
+    SOURCE_PROPERTY_NAME = 10
+    TARGET_PROPERTY_UUID = 11
+    TARGET_PROPERTY_NAME = 12
+    SOURCE_UNIT_UUID = 13
+    SOURCE_UNIT_NAME = 14
+    TARGET_UNIT_UUID = 15
+    TARGET_UNIT_NAME = 16
+    PROVIDER_UUID = 17
+    PROVIDER_NAME = 18
+    PROVIDER_CATEGORY = 19
+    PROVIDER_LOCATION = 20
+
+
+@dataclass
+class FlowMapEntry:
+    source_flow: str
+    target_flow: str
+    factor: float
+    row: list[str]
+
+    def __getitem__(self, col: Col) -> str:
+        return self.row[col] if col < len(self.row) else ""
+
+
+def key_of(s: str) -> str:
+    """Normalizes a source key of a mapping: flow UUIDs and path keys are
+    compared case-insensitive and without surrounding white-spaces."""
+    return s.strip().lower()
+
+
+def path_key(*segments: str) -> str:
+    """Returns the path key of a flow like it is used in the SimaPro
+    mappings, e.g. `path_key("Elementary flow", "Emissions to air",
+    "low. pop.", "Ammonia", "kg")`."""
+    return "/".join(key_of(s) for s in segments)
+
+
+class FlowMap:
+    """A compiled flow mapping file. The index file is memory-mapped: it
+    contains a string table, the cells of the mapping rows as indices into
+    that table, and the sorted 64-bit hashes of the source keys. A lookup
+    by source flow UUID or path key is a binary search over these hashes."""
+
+    def __init__(self, file: Path):
+        self.file = file
+        self._buffer = np.memmap(file, dtype=np.uint8, mode="r")
+        (magic, version, rows, cols, strings, keys, blob) = _HEADER.unpack(
+            self._buffer[: _HEADER.size].tobytes()
+        )
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"not a flow map index: {file}")
+        self.columns = cols
+        sections = _Sections(self._buffer, _HEADER.size)
+        self._offsets = sections.next(np.uint32, strings + 1)
+        self._blob = sections.next(np.uint8, blob)
+        self._cells = sections.next(np.uint32, rows * cols).reshape(
+            (rows, cols)
+        )
+        self.factors = sections.next(np.float64, rows)
+        self._hashes = sections.next(np.uint64, keys)
+        self._keys = sections.next(np.uint32, keys)
+        self._key_rows = sections.next(np.uint32, keys + 1)
+        self._rows = sections.next(np.uint32, rows)
+
+    @staticmethod
+    def open(mapping: str | Path) -> "FlowMap":
+        """Opens the index of the given mapping file. The mapping is given
+        by its file name in refdata/mappings or by its path. The index is
+        compiled into the cache folder when it does not exist yet or when
+        the mapping file was changed."""
+        path = _mapping_path(mapping)
+        with open(path, "rb") as inp:
+            digest = hashlib.sha1(inp.read()).hexdigest()
+        index = model._cache_dir / f"{digest}.flowmap.v{_VERSION}"
+        if not index.exists():
+            compile_index(path, index)
+        return FlowMap(index)
+
+    def __len__(self) -> int:
+        return len(self.factors)
+
+    def __contains__(self, key: str) -> bool:
+        return self._slot_of(key_of(key)) >= 0
+
+    def rows_of(self, key: str) -> list[int]:
+        """Returns the indices of the mapping rows of the given source key,
+        in the order in which they are defined in the mapping file."""
+        slot = self._slot_of(key_of(key))
+        if slot < 0:
+            return []
+        start, end = self._key_rows[slot], self._key_rows[slot + 1]
+        return [int(r) for r in self._rows[start:end]]
+
+    def get(self, key: str) -> FlowMapEntry | None:
+        rows = self.rows_of(key)
+        return self.entry(rows[0]) if rows else None
+
+    def entries_of(self, key: str) -> list[FlowMapEntry]:
+        return [self.entry(row) for row in self.rows_of(key)]
+
+    def entry(self, row: int) -> FlowMapEntry:
+        cells = [self._str(i) for i in self._cells[row]]
+        return FlowMapEntry(
+            source_flow=cells[Col.SOURCE_FLOW_UUID],
+            target_flow=cells[Col.TARGET_FLOW_UUID],
+            factor=float(self.factors[row]),
+            row=cells,
+        )
+
+    def entries(self) -> Iterable[FlowMapEntry]:
+        for row in range(len(self)):
+            yield self.entry(row)
+
+    def cell(self, row: int, col: Col) -> str:
+        if col >= self.columns:
+            return ""
+        return self._str(self._cells[row, col])
+
+    def find(self, keys: Iterable[str]) -> np.ndarray:
+        """Returns for each of the given source keys the index of its first
+        mapping row, or -1 if there is no mapping for that key. The hashes
+        of all keys are searched at once, so this is the fast path for
+        converting large inventories."""
+        slots = self._slots_of(keys)
+        found = np.full(len(slots), -1, dtype=np.int64)
+        mapped = slots >= 0
+        found[mapped] = self._rows[self._key_rows[slots[mapped]]]
+        return found
+
+    def find_all(self, keys: Iterable[str]) -> tuple[np.ndarray, np.ndarray]:
+        """Returns all mapping rows of the given source keys as two arrays
+        of the same length: the positions of the keys and the indices of
+        their mapping rows. Keys without mapping are not contained."""
+        slots = self._slots_of(keys)
+        positions = np.flatnonzero(slots >= 0)
+        starts = self._key_rows[slots[positions]].astype(np.int64)
+        counts = self._key_rows[slots[positions] + 1] - starts
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        within = np.arange(len(offsets)) - offsets
+        rows = self._rows[np.repeat(starts, counts) + within]
+        return (np.repeat(positions, counts), rows.astype(np.int64))
+
+    def convert(
+        self, keys: Iterable[str], amounts: np.ndarray
+    ) -> tuple[list[str | None], np.ndarray]:
+        """Converts the given amounts of source flows to the amounts of the
+        mapped target flows: `a_t = x * a_s`. For unmapped flows, the target
+        is `None` and the amount is kept."""
+        rows = self.find(keys)
+        mapped = rows >= 0
+        factors = np.ones(len(rows))
+        factors[mapped] = self.factors[rows[mapped]]
+        col = self._cells[:, Col.TARGET_FLOW_UUID]
+        targets = [self._str(col[r]) if r >= 0 else None for r in rows]
+        return (targets, np.asarray(amounts) * factors)
+
+    def _slot_of(self, key: str) -> int:
+        h = _hash(key)
+        slot = int(np.searchsorted(self._hashes, np.uint64(h)))
+        while slot < len(self._hashes) and self._hashes[slot] == h:
+            if self._str(self._keys[slot]) == key:
+                return slot
+            slot += 1
+        return -1
+
+    def _slots_of(self, keys: Iterable[str]) -> np.ndarray:
+        normed = [key_of(k) for k in keys]
+        hashes = np.fromiter(
+            (_hash(k) for k in normed), dtype=np.uint64, count=len(normed)
+        )
+        slots = np.searchsorted(self._hashes, hashes)
+        found = np.full(len(normed), -1, dtype=np.int64)
+        n = len(self._hashes)
+        for (i, slot) in enumerate(slots):
+            # check the key, as different keys can have the same hash
+            while slot < n and self._hashes[slot] == hashes[i]:
+                if self._str(self._keys[slot]) == normed[i]:
+                    found[i] = slot
+                    break
+                slot += 1
+        return found
+
+    def _str(self, i: int) -> str:
+        start, end = self._offsets[i], self._offsets[i + 1]
+        return self._blob[start:end].tobytes().decode("utf-8")
+
+
+def compile_index(mapping: str | Path, index: Path) -> Path:
+    """Compiles the given mapping file into an index file."""
+    path = _mapping_path(mapping)
+    strings: dict[str, int] = {"": 0}
+
+    def idx(s: str) -> int:
+        i = strings.get(s)
+        if i is None:
+            i = len(strings)
+            strings[s] = i
+        return i
+
+    cells = []
+    factors = []
+    rows_of: dict[str, list[int]] = {}
+    cols = len(Col)
+    with open(path, "r", encoding="utf-8", newline="") as inp:
+        for row in csv.reader(inp, delimiter=";"):
+            if len(row) < 2:
+                continue
+            cols = max(cols, len(row))
+            cells.append([idx(s) for s in row])
+            factors.append(_factor_of(row))
+            key = key_of(row[Col.SOURCE_FLOW_UUID])
+            rows_of.setdefault(key, []).append(len(cells) - 1)
+            idx(key)
+
+    # the sorted hashes of the keys
+    keys = sorted(rows_of.keys(), key=lambda k: (_hash(k), k))
+    key_rows = [0]
+    rows: list[int] = []
+    for key in keys:
+        rows.extend(rows_of[key])
+        key_rows.append(len(rows))
+
+    # the string table
+    blob = bytearray()
+    offsets = [0]
+    for s in strings.keys():
+        blob.extend(s.encode("utf-8"))
+        offsets.append(len(blob))
+
+    matrix = np.zeros((len(cells), cols), dtype=np.uint32)
+    for (i, row) in enumerate(cells):
+        matrix[i, : len(row)] = row
+
+    index.parent.mkdir(parents=True, exist_ok=True)
+    tmp = index.parent / f"{index.name}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as out:
+        out.write(
+            _HEADER.pack(
+                _MAGIC,
+                _VERSION,
+                len(cells),
+                cols,
+                len(strings),
+                len(keys),
+                len(blob),
+            )
+        )
+        sections = [
+            np.array(offsets, dtype=np.uint32),
+            np.frombuffer(bytes(blob), dtype=np.uint8),
+            matrix,
+            np.array(factors, dtype=np.float64),
+            np.array([_hash(k) for k in keys], dtype=np.uint64),
+            np.array([strings[k] for k in keys], dtype=np.uint32),
+            np.array(key_rows, dtype=np.uint32),
+            np.array(rows, dtype=np.uint32),
+        ]
+        for section in sections:
+            out.write(b"\0" * (-out.tell() % 8))
+            out.write(section.tobytes())
+    os.replace(tmp, index)
+    log.info("compiled %s: %i rows, %i keys", path.name, len(cells), len(keys))
+    return index
+
+
+class _Sections:
+    """Reads the 8-byte aligned arrays of an index file."""
+
+    def __init__(self, buffer: np.ndarray, offset: int):
+        self.buffer = buffer
+        self.offset = offset
+
+    def next(self, dtype: type, count: int) -> np.ndarray:
+        self.offset += -self.offset % 8
+        size = np.dtype(dtype).itemsize * count
+        a = self.buffer[self.offset : self.offset + size]
+        self.offset += size
+        return a.view(dtype)
+
+
+def _mapping_path(mapping: str | Path) -> Path:
+    if isinstance(mapping, Path):
+        return mapping
+    path = model._ref_dir / "mappings" / mapping
+    if path.exists():
+        return path
+    return Path(mapping)
+
+
+def _hash(key: str) -> int:
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def _factor_of(row: list[str]) -> float:
+    if len(row) <= Col.FACTOR:
+        return 1.0
+    try:
+        return float(row[Col.FACTOR])
+    except ValueError:
+        log.error("invalid conversion factor in mapping row: %s", row)
+        return 1.0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="compiles flow mapping files into index files"
+    )
+    parser.add_argument(
+        "mappings",
+        nargs="*",
+        help="the mapping files; default: all files in refdata/mappings",
+    )
+    parser.add_argument("--lookup", help="a source flow UUID or path key")
+    args = parser.parse_args()
+
+    files = args.mappings or sorted(
+        p.name for p in (model._ref_dir / "mappings").glob("*.csv")
+    )
+    for file in files:
+        fm = FlowMap.open(file)
+        print(f"{file}: {len(fm)} rows -> {fm.file}")
+        if args.lookup:
+            for e in fm.entries_of(args.lookup):
+                print(f"  {e.source_flow} -> {e.target_flow} * {e.factor}")
+
+
+if __name__ == "__main__":
+    main()
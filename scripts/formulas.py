@@ -0,0 +1,424 @@
+import ast
+import csv
+import logging as log
+import math
+import re
+
+from dataclasses import dataclass
+from functools import lru_cache, reduce
+from pathlib import Path
+from types import CodeType
+from typing import Any, Mapping, Sequence
+
+import numpy as np
+from scipy import sparse
+
+# a parameter set maps parameter names to values; the names are not case
+# sensitive, like in openLCA
+ParameterSet = Mapping[str, float]
+
+# the parameter definitions of the LCIA categories: category ID -> name ->
+# value; the value can be a number or a formula of other parameters
+Parameters = dict[str, dict[str, str]]
+
+_TOKEN = re.compile(
+    r"\s*(?:(?P<num>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+    r"|(?P<name>[^\W\d]\w*)"
+    r"|(?P<op><>|<=|>=|==|!=|&&|\|\||[-+*/^(),;<>=!&|]))"
+)
+
+_OPS = {
+    "^": "**",
+    ";": ",",
+    "=": "==",
+    "<>": "!=",
+    "&&": " and ",
+    "&": " and ",
+    "||": " or ",
+    "|": " or ",
+    "!": " not ",
+}
+
+
+def _if(condition, a, b):
+    return np.where(condition, a, b)
+
+
+_FUNCTIONS: dict[str, Any] = {
+    "f_abs": np.abs,
+    "f_sqrt": np.sqrt,
+    "f_sqr": np.square,
+    "f_exp": np.exp,
+    "f_ln": np.log,
+    "f_log": np.log10,
+    "f_pow": np.power,
+    "f_round": np.round,
+    "f_min": lambda *xs: reduce(np.minimum, xs),
+    "f_max": lambda *xs: reduce(np.maximum, xs),
+    "f_if": _if,
+    "f_iif": _if,
+    "f_and": lambda *xs: reduce(np.logical_and, xs),
+    "f_or": lambda *xs: reduce(np.logical_or, xs),
+    "f_not": np.logical_not,
+}
+
+_CONSTANTS = {"pi": math.pi, "e": math.e, "true": 1.0, "false": 0.0}
+
+_GLOBALS: dict[str, Any] = {
+    "__builtins__": {},
+    **_FUNCTIONS,
+    **{f"v_{name}": value for (name, value) in _CONSTANTS.items()},
+}
+
+_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.BoolOp,
+    ast.Compare,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Pow,
+    ast.UAdd,
+    ast.USub,
+    ast.Not,
+    ast.And,
+    ast.Or,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+)
+
+
+@dataclass(frozen=True)
+class Formula:
+    """A compiled formula. The formula is evaluated with NumPy, so that the
+    parameters can be arrays with a value for each of several parameter
+    sets; the result then contains the value for each set."""
+
+    source: str
+    variables: frozenset[str]
+    code: CodeType
+
+    def evaluate(self, scope: Mapping[str, Any], size: int = 1) -> np.ndarray:
+        """Evaluates the formula with the given parameter values and returns
+        an array of the given size. Raises a `NameError` if a parameter of
+        the formula is not defined."""
+        try:
+            local = {f"v_{name}": scope[name] for name in self.variables}
+        except KeyError as e:
+            raise NameError(f"unknown parameter {e.args[0]}") from None
+        with np.errstate(all="ignore"):
+            value = eval(self.code, _GLOBALS, local)
+        return np.broadcast_to(np.asarray(value, dtype=np.float64), (size,))
+
+
+@lru_cache(maxsize=None)
+def compile_formula(source: str) -> Formula:
+    """Parses and compiles the given formula; each distinct formula is only
+    compiled once. Raises a `ValueError` if it is not a valid formula."""
+    expression = _translate(source)
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError:
+        raise ValueError(f"invalid formula: {source}") from None
+    tree = ast.fix_missing_locations(_Checker(source).visit(tree))
+    variables = frozenset(
+        node.id[2:]
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Name)
+        and node.id.startswith("v_")
+        and node.id[2:] not in _CONSTANTS
+    )
+    code = compile(tree, "<formula>", "eval")
+    return Formula(source, variables, code)
+
+
+def is_formula(source: str) -> bool:
+    """Returns true if the given text is a valid formula, see
+    `compile_formula`."""
+    try:
+        compile_formula(source)
+        return True
+    except ValueError:
+        return False
+
+
+def _translate(source: str) -> str:
+    """Translates the openLCA formula syntax into a Python expression. To
+    avoid conflicts with Python keywords and builtins, function names get a
+    `f_` and variables a `v_` prefix."""
+    parts: list[str] = []
+    pos = 0
+    while pos < len(source):
+        m = _TOKEN.match(source, pos)
+        if m is None:
+            if source[pos:].strip() == "":
+                break
+            raise ValueError(f"invalid formula: {source}")
+        pos = m.end()
+        if (num := m.group("num")) is not None:
+            parts.append(num)
+        elif (name := m.group("name")) is not None:
+            name = name.lower()
+            if name in ("and", "or", "not"):
+                parts.append(f" {name} ")
+            elif source[pos:].lstrip().startswith("("):
+                parts.append(f"f_{name}")
+            else:
+                parts.append(f"v_{name}")
+        else:
+            op = m.group("op")
+            parts.append(_OPS.get(op, op))
+    return " ".join(parts).strip()
+
+
+class _Checker(ast.NodeTransformer):
+    """Only allows arithmetic expressions with the known functions and
+    replaces the logical operators by their element-wise functions."""
+
+    def __init__(self, source: str):
+        self.source = source
+
+    def generic_visit(self, node: ast.AST) -> ast.AST:
+        if not isinstance(node, _NODES):
+            raise ValueError(f"invalid formula: {self.source}")
+        return super().generic_visit(node)
+
+    def visit_Constant(self, node: ast.Constant) -> ast.AST:
+        if not isinstance(node.value, (int, float)):
+            raise ValueError(f"invalid formula: {self.source}")
+        return ast.Constant(float(node.value))
+
+    def visit_Call(self, node: ast.Call) -> ast.AST:
+        if (
+            not isinstance(node.func, ast.Name)
+            or node.func.id not in _FUNCTIONS
+            or node.keywords
+        ):
+            raise ValueError(f"unknown function in formula: {self.source}")
+        return self.generic_visit(node)
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        if len(node.ops) != 1:
+            raise ValueError(f"chained comparison in formula: {self.source}")
+        return self.generic_visit(node)
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        self.generic_visit(node)
+        fn = "f_and" if isinstance(node.op, ast.And) else "f_or"
+        return ast.Call(ast.Name(fn, ast.Load()), node.values, [])
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.Call(ast.Name("f_not", ast.Load()), [node.operand], [])
+        return node
+
+
+class _Scope(Mapping[str, np.ndarray]):
+    """The parameter values of an LCIA category for several parameter sets.
+    The values are resolved when they are first used: a value of a parameter
+    set overrides the definition of the category; a missing value (`nan`) in
+    a set is taken from the definition."""
+
+    def __init__(
+        self,
+        definitions: Mapping[str, str],
+        overrides: Mapping[str, np.ndarray],
+        size: int,
+    ):
+        self.definitions = definitions
+        self.overrides = overrides
+        self.size = size
+        self._values: dict[str, np.ndarray] = {}
+        self._resolving: set[str] = set()
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        value = self._values.get(name)
+        if value is not None:
+            return value
+        override = self.overrides.get(name)
+        definition = self.definitions.get(name)
+        if override is None and definition is None:
+            raise KeyError(name)
+        if override is not None and (
+            definition is None or not np.isnan(override).any()
+        ):
+            value = override
+        else:
+            if name in self._resolving:
+                raise ValueError(f"cyclic definition of parameter {name}")
+            self._resolving.add(name)
+            try:
+                value = compile_formula(definition).evaluate(self, self.size)
+            finally:
+                self._resolving.discard(name)
+            if override is not None:
+                value = np.where(np.isnan(override), value, override)
+        self._values[name] = value
+        return value
+
+    def __iter__(self):
+        return iter(self.definitions.keys() | self.overrides.keys())
+
+    def __len__(self) -> int:
+        return len(self.definitions.keys() | self.overrides.keys())
+
+
+@dataclass
+class FormulaFactors:
+    """The factors with formulas of a matrix C: their positions in C, their
+    formulas, and the values of the formulas with the default parameters,
+    which are the values of these factors in C."""
+
+    rows: np.ndarray
+    cols: np.ndarray
+    formulas: list[str]
+    defaults: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.formulas)
+
+    def evaluate(
+        self,
+        impact_ids: list[str],
+        parameters: Parameters,
+        sets: Sequence[ParameterSet] = (),
+    ) -> np.ndarray:
+        """Evaluates the formulas for the given parameter sets in one batch:
+        each distinct formula of an LCIA category is evaluated once with the
+        values of all sets. Returns an array with a row for each factor and a
+        column for each set (or a single column with the default parameters
+        if no set is given); factors that could not be evaluated are `nan`."""
+        size = max(len(sets), 1)
+        overrides: dict[str, np.ndarray] = {}
+        for (i, params) in enumerate(sets):
+            for (name, value) in params.items():
+                key = name.lower()
+                if key not in overrides:
+                    overrides[key] = np.full(size, np.nan)
+                overrides[key][i] = value
+
+        groups: dict[tuple[int, str], list[int]] = {}
+        for (i, key) in enumerate(zip(self.rows.tolist(), self.formulas)):
+            groups.setdefault(key, []).append(i)
+        values = np.full((len(self), size), np.nan)
+        scopes: dict[int, _Scope] = {}
+        for ((row, source), idx) in groups.items():
+            scope = scopes.get(row)
+            if scope is None:
+                defs = parameters.get(impact_ids[row], {})
+                scope = _Scope(defs, overrides, size)
+                scopes[row] = scope
+            try:
+                value = compile_formula(source).evaluate(scope, size)
+            except (ValueError, NameError, TypeError, ArithmeticError) as e:
+                log.error(
+                    "failed to evaluate formula %s of indicator %s: %s",
+                    source,
+                    impact_ids[row],
+                    e,
+                )
+                continue
+            if not np.isfinite(value).all():
+                log.error(
+                    "formula %s of indicator %s is not finite",
+                    source,
+                    impact_ids[row],
+                )
+                value = np.where(np.isfinite(value), value, np.nan)
+            values[idx] = value
+        return values
+
+    def apply(
+        self, C: sparse.csc_array | sparse.csr_array, values: np.ndarray
+    ) -> sparse.csc_array:
+        """Returns a copy of C where the default values of the formula factors
+        are replaced by the given values; `nan` values are set to 0."""
+        delta = np.nan_to_num(values, nan=0.0) - self.defaults
+        D = sparse.csc_array((delta, (self.rows, self.cols)), shape=C.shape)
+        result = sparse.csc_array(C + D)
+        result.eliminate_zeros()
+        return result
+
+
+def read_parameters(folder: Path) -> Parameters:
+    """Reads the parameters of the LCIA categories from the
+    `lcia_parameters_*.csv` files in the given folder."""
+    params: Parameters = {}
+    for path in sorted(folder.glob("lcia_parameters*.csv")):
+        with open(path, "r", encoding="utf-8", newline="") as inp:
+            reader = csv.reader(inp)
+            next(reader, None)
+            for row in reader:
+                if len(row) < 3 or row[0].strip() == "":
+                    continue
+                name = row[1].strip().lower()
+                params.setdefault(row[0].strip(), {})[name] = row[2].strip()
+    return params
+
+
+def write_formulas(folder: Path, factors: FormulaFactors, params: Parameters):
+    """Writes the formula factors and parameters into a library folder."""
+    with open(
+        folder / "C_formulas.csv", "w", encoding="utf-8", newline=""
+    ) as out:
+        writer = csv.writer(out)
+        writer.writerow(["row", "column", "formula", "default value"])
+        for i in range(len(factors)):
+            writer.writerow(
+                [
+                    int(factors.rows[i]),
+                    int(factors.cols[i]),
+                    factors.formulas[i],
+                    float(factors.defaults[i]),
+                ]
+            )
+    with open(
+        folder / "parameters.csv", "w", encoding="utf-8", newline=""
+    ) as out:
+        writer = csv.writer(out)
+        writer.writerow(["indicator ID", "parameter", "value"])
+        for (impact_id, defs) in params.items():
+            for (name, value) in defs.items():
+                writer.writerow([impact_id, name, value])
+
+
+def read_formulas(folder: Path) -> tuple[FormulaFactors, Parameters]:
+    """Reads the formula factors and parameters of a library folder."""
+    (rows, cols, sources, defaults) = ([], [], [], [])
+    path = folder / "C_formulas.csv"
+    if path.exists():
+        with open(path, "r", encoding="utf-8", newline="") as inp:
+            reader = csv.reader(inp)
+            next(reader)
+            for row in reader:
+                rows.append(int(row[0]))
+                cols.append(int(row[1]))
+                sources.append(row[2])
+                defaults.append(float(row[3]))
+    params: Parameters = {}
+    path = folder / "parameters.csv"
+    if path.exists():
+        with open(path, "r", encoding="utf-8", newline="") as inp:
+            reader = csv.reader(inp)
+            next(reader)
+            for row in reader:
+                params.setdefault(row[0], {})[row[1]] = row[2]
+    factors = FormulaFactors(
+        rows=np.array(rows, dtype=np.int64),
+        cols=np.array(cols, dtype=np.int64),
+        formulas=sources,
+        defaults=np.array(defaults, dtype=np.float64),
+    )
+    return (factors, params)
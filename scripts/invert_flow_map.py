@@ -1,109 +1,201 @@
-# This script swaps the source and target columns of a mapping file and inverts
-# the respective conversion factors. Note that this does not work for provider
-# mappings.
-
+# This script swaps the source and target columns of mapping files and
+# inverts the respective conversion factors, e.g. to generate
+# SimaPro_Export.csv from SimaPro_Import.csv. The files are streamed row by
+# row and can be processed in parallel. Provider information of the target
+# flows cannot be inverted, as there are no provider columns for source
+# flows; it is dropped with a warning. Also, when several source flows are
+# mapped to the same target flow, the inverted mapping is ambiguous; such
+# collisions are reported.
+
+import argparse
 import csv
+import logging as log
+import os
 
-from enum import Enum
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import cast
-
-# CHANGE THE PATHS TO THE MAPPING FILES HERE:
-INP = Path.home() / "Downloads/SimaPro_Import.csv"
-OUT = Path.home() / "Downloads/SimaPro_Export.csv"
-
-
-class Source(Enum):
-    FLOW_UUID = 0
-    FLOW_NAME = 3
-    CATEGORY = 4
-    LOCATION_CODE = 5
-    FLOW_PROPERTY_UUID = 9
-    FLOW_PROPERTY_NAME = 10
-    UNIT_UUID = 13
-    UNIT_NAME = 14
-
-
-class Target(Enum):
-    FLOW_UUID = 1
-    FLOW_NAME = 6
-    CATEGORY = 7
-    LOCATION_CODE = 8
-    FLOW_PROPERTY_UUID = 11
-    FLOW_PROPERTY_NAME = 12
-    UNIT_UUID = 15
-    UNIT_NAME = 16
-    PROVIDER_UUID = 17
-    PROVIDER_NAME = 18
-    PROVIDER_CATEGORY = 19
-    PROVIDER_LOCATION = 20
+
+import model
+
+from flowmap import Col
+
+# the columns of the inverted rows: for each column of an output row, the
+# column of the input row from which the value is taken
+_PERMUTATION: list[int] = [
+    Col.TARGET_FLOW_UUID,
+    Col.SOURCE_FLOW_UUID,
+    Col.FACTOR,
+    Col.TARGET_FLOW_NAME,
+    Col.TARGET_CATEGORY,
+    Col.TARGET_LOCATION,
+    Col.SOURCE_FLOW_NAME,
+    Col.SOURCE_CATEGORY,
+    Col.SOURCE_LOCATION,
+    Col.TARGET_PROPERTY_UUID,
+    Col.TARGET_PROPERTY_NAME,
+    Col.SOURCE_PROPERTY_UUID,
+    Col.SOURCE_PROPERTY_NAME,
+    Col.TARGET_UNIT_UUID,
+    Col.TARGET_UNIT_NAME,
+    Col.SOURCE_UNIT_UUID,
+    Col.SOURCE_UNIT_NAME,
+]
+
+# the number of columns of the inverted rows; the first three provider
+# columns are written empty
+_WIDTH = 20
+
+_PROVIDER_COLS = range(Col.PROVIDER_UUID, Col.PROVIDER_LOCATION + 1)
 
 
 @dataclass
-class Row:
-    row: list[str | float]
-
-    def swap(self) -> "Row":
-        s: list[str | float] = [""] * 20
-
-        # invert the factor
-        f = self._f(2)
-        s[2] = 0 if f == 0 else 1 / f
-
-        # map fields
-        s[Source.FLOW_UUID.value] = self._s(Target.FLOW_UUID.value)
-        s[Source.FLOW_NAME.value] = self._s(Target.FLOW_NAME.value)
-        s[Source.CATEGORY.value] = self._s(Target.CATEGORY.value)
-        s[Source.LOCATION_CODE.value] = self._s(Target.LOCATION_CODE.value)
-        s[Source.FLOW_PROPERTY_UUID.value] = self._s(
-            Target.FLOW_PROPERTY_UUID.value
-        )
-        s[Source.FLOW_PROPERTY_NAME.value] = self._s(
-            Target.FLOW_PROPERTY_NAME.value
-        )
-        s[Source.UNIT_UUID.value] = self._s(Target.UNIT_UUID.value)
-        s[Source.UNIT_NAME.value] = self._s(Target.UNIT_NAME.value)
-        s[Target.FLOW_UUID.value] = self._s(Source.FLOW_UUID.value)
-        s[Target.FLOW_NAME.value] = self._s(Source.FLOW_NAME.value)
-        s[Target.CATEGORY.value] = self._s(Source.CATEGORY.value)
-        s[Target.LOCATION_CODE.value] = self._s(Source.LOCATION_CODE.value)
-        s[Target.FLOW_PROPERTY_UUID.value] = self._s(
-            Source.FLOW_PROPERTY_UUID.value
-        )
-        s[Target.FLOW_PROPERTY_NAME.value] = self._s(
-            Source.FLOW_PROPERTY_NAME.value
-        )
-        s[Target.UNIT_UUID.value] = self._s(Source.UNIT_UUID.value)
-        s[Target.UNIT_NAME.value] = self._s(Source.UNIT_NAME.value)
-        return Row(s)
-
-    def _s(self, i: int) -> str:
-        if len(self.row) <= i:
-            return ""
-        v = self.row[i]
-        if v is None:
-            return ""
-        if isinstance(v, str):
-            return v
-        return str(v)
-
-    def _f(self, i: int) -> float:
-        if len(self.row) <= i:
-            return 1.0
-        v = self.row[i]
-        try:
-            return float(v)
-        except:
-            return 1.0
+class Inversion:
+    """The result of inverting a mapping file."""
+
+    source: Path
+    target: Path
+    rows: int = 0
+    providers: int = 0
+    collisions: list[tuple[str, list[str]]] = field(default_factory=list)
+
+
+def invert(source: Path, target: Path) -> Inversion:
+    """Writes the inverted mapping of the source file into the target file.
+    The rows are written into a temporary file that replaces the target
+    when it is complete, so that the target can also be a file that is
+    read at the same time (e.g. the source of another inversion)."""
+    result = Inversion(source, target)
+
+    # the source flows of each target flow, to detect collisions
+    sources_of: dict[str, list[str]] = {}
+    tmp = target.parent / f".{target.name}.{os.getpid()}.tmp"
+    with open(source, "r", encoding="utf-8", newline="") as inp, open(
+        tmp, "w", encoding="utf-8", newline=""
+    ) as out:
+        writer = csv.writer(out, delimiter=";", lineterminator="\n")
+        for row in csv.reader(inp, delimiter=";"):
+            if len(row) < 2:
+                continue
+            n = len(row)
+            inv: list[str | float] = [
+                row[i] if i < n else "" for i in _PERMUTATION
+            ]
+            inv.extend([""] * (_WIDTH - len(inv)))
+            f = _factor_of(row)
+            inv[Col.FACTOR] = 0 if f == 0 else 1 / f
+            writer.writerow(inv)
+            result.rows += 1
+
+            if any(row[i].strip() != "" for i in _PROVIDER_COLS if i < n):
+                result.providers += 1
+            s = row[Col.SOURCE_FLOW_UUID]
+            sources = sources_of.get(row[Col.TARGET_FLOW_UUID])
+            if sources is None:
+                sources_of[row[Col.TARGET_FLOW_UUID]] = [s]
+            elif s not in sources:
+                sources.append(s)
+    os.replace(tmp, target)
+
+    for (t, sources) in sources_of.items():
+        if len(sources) > 1:
+            result.collisions.append((t, sources))
+    return result
+
+
+def _factor_of(row: list[str]) -> float:
+    if len(row) <= Col.FACTOR:
+        return 1.0
+    try:
+        return float(row[Col.FACTOR])
+    except ValueError:
+        return 1.0
+
+
+def _target_of(source: Path, out_dir: Path | None) -> Path:
+    name = source.stem
+    if "_Import" in name:
+        name = name.replace("_Import", "_Export")
+    elif "_Export" in name:
+        name = name.replace("_Export", "_Import")
+    else:
+        name = f"{name}_inverted"
+    return (out_dir or source.parent) / f"{name}{source.suffix}"
+
+
+def _invert(pair: tuple[Path, Path]) -> Inversion:
+    return invert(*pair)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="inverts the source and target flows of mapping files"
+    )
+    parser.add_argument("mappings", nargs="+", type=Path)
+    parser.add_argument(
+        "-o",
+        "--out",
+        type=Path,
+        help="the output file, only possible for a single mapping file",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        help="the output folder; default: the folder of each mapping file",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="allow to overwrite the mapping files in refdata/mappings",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="the number of files that are inverted in parallel",
+    )
+    args = parser.parse_args()
+
+    if args.out is not None:
+        if len(args.mappings) > 1:
+            parser.error("--out can only be used with a single mapping file")
+        pairs = [(args.mappings[0], args.out)]
+    else:
+        pairs = [(m, _target_of(m, args.out_dir)) for m in args.mappings]
+    mappings = (model._ref_dir / "mappings").resolve()
+    for (source, target) in pairs:
+        if target.resolve() == source.resolve():
+            parser.error(f"the output {target} is the input mapping file")
+        if target.resolve().is_relative_to(mappings) and not args.force:
+            parser.error(
+                f"the output {target} is a mapping file of the reference"
+                " data; use --out, --out-dir, or --force"
+            )
+    if args.out_dir is not None:
+        args.out_dir.mkdir(parents=True, exist_ok=True)
+
+    workers = min(args.workers, len(pairs))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_invert, pairs))
+    else:
+        results = [_invert(pair) for pair in pairs]
+
+    for r in results:
+        print(f"{r.source} -> {r.target}: {r.rows} rows")
+        if r.providers > 0:
+            log.warning(
+                "%s: dropped the providers of %i rows", r.source, r.providers
+            )
+        for (t, sources) in r.collisions:
+            log.warning(
+                "%s: %i flows map to %s: %s",
+                r.source,
+                len(sources),
+                t,
+                ", ".join(sources),
+            )
 
 
 if __name__ == "__main__":
-    with open(OUT, "w", encoding="utf-8", newline="") as out:
-        writer = csv.writer(out, delimiter=";")
-        with open(INP, "r", encoding="utf-8") as inp:
-            reader = csv.reader(inp, delimiter=";")
-            for row in reader:
-                source = cast(list[str | float], row)
-                target = Row(source).swap().row
-                writer.writerow(target)
+    main()
@@ -0,0 +1,119 @@
+import pickle
+import zipfile
+
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, TypeVar
+
+import olca_schema as lca
+from olca_schema import zipio
+
+E = TypeVar("E", bound=lca.RootEntity)
+
+# the maximum number of characterization factors (or entities) that are sent
+# to a worker in one batch
+_BATCH_WEIGHT = 20_000
+
+
+class ZipWriter:
+    """Writes entities into a JSON-LD zip package like `zipio.ZipWriter`, but
+    the entities are serialized to JSON in a process pool of the given size.
+    The entries are written in the order of the entities, so the result is
+    the same for any number of workers. With `append`, the entities are
+    added to an existing package."""
+
+    def __init__(
+        self,
+        file_name: str,
+        workers: int = 1,
+        compresslevel: int = 6,
+        append: bool = False,
+    ):
+        self.workers = workers
+        self._zip = zipfile.ZipFile(
+            file_name,
+            mode="a" if append else "w",
+            compression=zipfile.ZIP_DEFLATED,
+            compresslevel=compresslevel,
+        )
+        if "olca-schema.json" not in self._zip.namelist():
+            self._zip.writestr("olca-schema.json", '{"version": 2}')
+        self._pool: ProcessPoolExecutor | None = None
+        if workers > 1:
+            self._pool = ProcessPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._zip.close()
+
+    def write(self, entity: lca.RootEntity):
+        self.write_all([entity])
+
+    def write_all(self, entities: Iterable[E]):
+        """Writes the given entities; entities with an ID that was already
+        written in this call are skipped."""
+        if self._pool is None:
+            for e in _unique(entities):
+                self._zip.writestr(_path_of(e), e.to_json())
+            return
+
+        # the entities are pickled when we get them and not later in the
+        # background thread of the pool, as they could be changed in the
+        # meantime (e.g. lazily loaded factors that are dropped again); we
+        # keep a bounded number of batches in flight, so that the JSON of a
+        # large sequence never needs to be in memory at once
+        pending: deque[tuple[list[str], Future[list[bytes]]]] = deque()
+        for (paths, batch) in _batches_of(entities):
+            pending.append((paths, self._pool.submit(_to_json, batch)))
+            if len(pending) >= 2 * self.workers:
+                self._put(*pending.popleft())
+        while pending:
+            self._put(*pending.popleft())
+
+    def _put(self, paths: list[str], future: Future[list[bytes]]):
+        for (path, data) in zip(paths, future.result()):
+            self._zip.writestr(path, data)
+
+
+def _unique(entities: Iterable[E]) -> Iterable[E]:
+    handled: set[str] = set()
+    for e in entities:
+        if e.id is None or e.id == "" or e.id in handled:
+            continue
+        handled.add(e.id)
+        yield e
+
+
+def _path_of(e: lca.RootEntity) -> str:
+    return f"{zipio._folder_of_entity(e)}/{e.id}.json"
+
+
+def _batches_of(
+    entities: Iterable[E],
+) -> Iterable[tuple[list[str], list[bytes]]]:
+    paths: list[str] = []
+    batch: list[bytes] = []
+    weight = 0
+    for e in _unique(entities):
+        paths.append(_path_of(e))
+        batch.append(pickle.dumps(e, protocol=pickle.HIGHEST_PROTOCOL))
+        factors = getattr(e, "impact_factors", None)
+        weight += 1 + (len(factors) if factors else 0)
+        if weight >= _BATCH_WEIGHT:
+            yield (paths, batch)
+            paths = []
+            batch = []
+            weight = 0
+    if batch:
+        yield (paths, batch)
+
+
+def _to_json(batch: list[bytes]) -> list[bytes]:
+    return [pickle.loads(e).to_json().encode("utf-8") for e in batch]
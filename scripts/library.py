@@ -0,0 +1,454 @@
+import csv
+import logging as log
+import struct
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Mapping, Sequence
+
+import numpy as np
+from scipy import sparse
+
+import formulas
+
+from formulas import ParameterSet
+
+
+@dataclass
+class Method:
+    id: str
+    name: str
+    rows: list[int]
+
+
+@dataclass
+class NwSet:
+    index: int
+    id: str
+    name: str
+    method_id: str
+    unit: str | None
+
+
+@dataclass
+class NwResults:
+    """The normalized and weighted results and the single scores of a batch
+    of LCIA results. For results with the shape `(..., indicators)`, the
+    normalized and weighted results have the same shape and the single
+    scores the shape `(...)`. Indicators without a normalization or
+    weighting factor have `nan` values in the respective results."""
+
+    normalized: np.ndarray
+    weighted: np.ndarray
+    single_scores: np.ndarray
+
+
+class Library:
+    """Reads the matrix C and its indices of an LCIA library that was created
+    by build_libs.py. Next to `C.npz`, the library contains a CSR copy of C
+    in `C_indptr.npy`, `C_indices.npy` and `C_data.npy` and the rows of the
+    LCIA methods in `index_methods.csv`. These arrays are memory-mapped, so
+    that the matrix of a single method can be loaded without reading the
+    factors of the other methods. The normalization and weighting factors
+    of the NW sets in `index_nw_sets.csv` are stored as dense matrices in
+    `N.npy` and `W.npy` with the indicators of C as columns. Optionally,
+    the library contains an uncompressed copy of C in `C.bin` that is
+    memory-mapped instead of reading `C.npz`, see `write_raw`.
+
+    Factors with formulas are stored in `C_formulas.csv` and the parameters
+    of the LCIA categories in `parameters.csv`; in C, these factors have the
+    values of the default parameters. The values of the formula factors for
+    other parameter sets are cached for the `max_cached` most recently used
+    sets."""
+
+    def __init__(self, folder: Path, max_cached: int = 16):
+        self.folder = folder
+        self.max_cached = max(1, max_cached)
+        self._cached: OrderedDict[tuple, np.ndarray] = OrderedDict()
+
+    @cached_property
+    def flow_ids(self) -> list[str]:
+        return [row[2] for row in self._idx("index_B.csv")]
+
+    @cached_property
+    def location_ids(self) -> list[str | None]:
+        """The locations of the columns of C; these are only set in a
+        regionalized library."""
+        return [row[7] or None for row in self._idx("index_B.csv")]
+
+    @cached_property
+    def is_regionalized(self) -> bool:
+        return any(loc is not None for loc in self.location_ids)
+
+    @cached_property
+    def columns(self) -> dict[tuple[str, str | None], int]:
+        """The column indices of C by (flow ID, location ID) pairs."""
+        return {
+            (flow_id, loc_id): i
+            for (i, (flow_id, loc_id)) in enumerate(
+                zip(self.flow_ids, self.location_ids)
+            )
+        }
+
+    @cached_property
+    def impact_ids(self) -> list[str]:
+        return [row[1] for row in self._idx("index_C.csv")]
+
+    @cached_property
+    def impact_names(self) -> list[str]:
+        return [row[2] for row in self._idx("index_C.csv")]
+
+    @cached_property
+    def impact_units(self) -> list[str]:
+        return [row[3] for row in self._idx("index_C.csv")]
+
+    @cached_property
+    def methods(self) -> dict[str, Method]:
+        """The LCIA methods of the library by ID and name."""
+        methods: dict[str, Method] = {}
+        for row in self._idx("index_methods.csv"):
+            method = methods.get(row[0])
+            if method is None:
+                method = Method(row[0], row[1], [])
+                methods[method.id] = method
+                methods[method.name] = method
+            method.rows.append(int(row[2]))
+        return methods
+
+    @cached_property
+    def nw_sets(self) -> dict[str, NwSet]:
+        """The normalization and weighting sets of the library by ID."""
+        sets: dict[str, NwSet] = {}
+        for row in self._idx("index_nw_sets.csv"):
+            nw_set = NwSet(int(row[0]), row[1], row[2], row[3], row[4] or None)
+            sets[nw_set.id] = nw_set
+        return sets
+
+    @cached_property
+    def nw_factors(self) -> tuple[np.ndarray, np.ndarray]:
+        """The factors of the NW sets that are applied to the LCIA results:
+        a matrix with the reciprocal normalization factors and a matrix
+        with the weighting factors that also contain the normalization.
+        The rows of these matrices are the NW sets and the columns the
+        indicators; the NW set of an index is given in `nw_sets`."""
+        k = len(self.impact_ids)
+        (n, w) = (np.zeros((0, k)), np.zeros((0, k)))
+        if (self.folder / "N.npy").exists():
+            n = np.load(self.folder / "N.npy")
+            w = np.load(self.folder / "W.npy")
+        with np.errstate(divide="ignore"):
+            norm = np.where(np.isfinite(n) & (n != 0), 1 / n, np.nan)
+        # without normalization factor, the results are weighted directly
+        weight = w * np.where(np.isnan(n), 1.0, norm)
+        return (norm, weight)
+
+    def nw_results(self, results: np.ndarray, nw_set: str) -> NwResults:
+        """Normalizes and weights the given LCIA results with the given NW
+        set. The last axis of the results are the indicators of C; the
+        leading axes can contain a batch of results."""
+        s = self.nw_sets.get(nw_set)
+        if s is None:
+            raise KeyError(f"unknown NW set: {nw_set}")
+        (norm, weight) = self.nw_factors
+        h = np.asarray(results, dtype=np.float64)
+        return NwResults(
+            normalized=h * norm[s.index],
+            weighted=h * weight[s.index],
+            single_scores=h @ np.nan_to_num(weight[s.index], nan=0.0),
+        )
+
+    def single_scores(self, results: np.ndarray) -> np.ndarray:
+        """Calculates the single scores of the given LCIA results for all NW
+        sets in one matrix product. For results with the shape `(...,
+        indicators)`, the scores have the shape `(..., NW sets)`."""
+        (_, weight) = self.nw_factors
+        h = np.asarray(results, dtype=np.float64)
+        return h @ np.nan_to_num(weight, nan=0.0).T
+
+    @cached_property
+    def formula_factors(
+        self,
+    ) -> tuple[formulas.FormulaFactors, formulas.Parameters]:
+        """The factors with formulas and the parameters of the library."""
+        return formulas.read_formulas(self.folder)
+
+    def matrix(
+        self, parameters: ParameterSet | None = None
+    ) -> sparse.csc_array:
+        """Loads the full matrix C; from `C.bin` without copying if the
+        library contains it. With a parameter set, the formula factors are
+        evaluated with these parameter values."""
+        raw = self.folder / "C.bin"
+        if raw.exists():
+            C = read_raw(raw)
+        else:
+            C = sparse.csc_array(sparse.load_npz(str(self.folder / "C.npz")))
+        if not parameters:
+            return C
+        (factors, _) = self.formula_factors
+        if len(factors) == 0:
+            return C
+        return factors.apply(C, self.formula_values([parameters])[0])
+
+    def matrices(
+        self, parameter_sets: Sequence[ParameterSet]
+    ) -> list[sparse.csc_array]:
+        """Creates the matrix C for each of the given parameter sets. The
+        formulas are evaluated for all sets in one batch."""
+        C = self.matrix()
+        (factors, _) = self.formula_factors
+        if len(factors) == 0:
+            return [C for _ in parameter_sets]
+        return [
+            factors.apply(C, values)
+            for values in self.formula_values(parameter_sets)
+        ]
+
+    def formula_values(
+        self, parameter_sets: Sequence[ParameterSet]
+    ) -> list[np.ndarray]:
+        """Evaluates the formula factors for the given parameter sets. The
+        sets that are not in the cache are evaluated in one batch."""
+        keys = [_key_of(params) for params in parameter_sets]
+        missing = list(dict.fromkeys(k for k in keys if k not in self._cached))
+        if missing:
+            (factors, params) = self.formula_factors
+            values = factors.evaluate(
+                self.impact_ids, params, [dict(k) for k in missing]
+            )
+            for (i, key) in enumerate(missing):
+                self._cached[key] = values[:, i]
+        result: list[np.ndarray] = []
+        for key in keys:
+            self._cached.move_to_end(key)
+            result.append(self._cached[key])
+        while len(self._cached) > self.max_cached:
+            self._cached.popitem(last=False)
+        return result
+
+    def method_matrix(
+        self, method: str, parameters: ParameterSet | None = None
+    ) -> tuple[sparse.csr_array, list[int]]:
+        """Loads the rows of C that belong to the given method (ID or name).
+        Returns the matrix and the indices of its rows in C."""
+        m = self.methods.get(method)
+        if m is None:
+            raise KeyError(f"unknown LCIA method: {method}")
+        return (self.rows_matrix(m.rows, parameters), m.rows)
+
+    def rows_matrix(
+        self, rows: list[int], parameters: ParameterSet | None = None
+    ) -> sparse.csr_array:
+        """Loads the given rows of C. Only the entries of these rows are
+        read from the memory-mapped CSR arrays."""
+        C = self._rows_of(rows)
+        (factors, _) = self.formula_factors if parameters else (None, None)
+        if factors is None or len(factors) == 0:
+            return C
+
+        # only the formula factors of the rows are replaced
+        pos = np.full(len(self.impact_ids), -1, dtype=np.int64)
+        pos[np.asarray(rows, dtype=np.int64)] = np.arange(len(rows))
+        selected = pos[factors.rows] >= 0
+        if not selected.any():
+            return C
+        values = self.formula_values([parameters])[0][selected]
+        subset = formulas.FormulaFactors(
+            rows=pos[factors.rows[selected]],
+            cols=factors.cols[selected],
+            formulas=[],
+            defaults=factors.defaults[selected],
+        )
+        return sparse.csr_array(subset.apply(C, values))
+
+    def _rows_of(self, rows: list[int]) -> sparse.csr_array:
+        indptr = self._array("C_indptr.npy")
+        starts = indptr[rows].astype(np.int64)
+        counts = indptr[np.asarray(rows, dtype=np.int64) + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        positions = np.repeat(starts - offsets[:-1], counts) + np.arange(
+            offsets[-1]
+        )
+        return sparse.csr_array(
+            (
+                np.asarray(self._array("C_data.npy")[positions]),
+                np.asarray(self._array("C_indices.npy")[positions]),
+                offsets,
+            ),
+            shape=(len(rows), len(self.flow_ids)),
+        )
+
+    def inventory_vector(
+        self, amounts: Mapping[str | tuple[str, str | None], float]
+    ) -> np.ndarray:
+        """Creates an inventory vector that is aligned with the columns of C.
+        The amounts are given by flow ID or by (flow ID, location ID) pairs.
+        In a regionalized library, the amount of a flow with a location that
+        has no column is assigned to the column of the flow without location
+        (the default factors of that flow). Flows without factors are
+        ignored."""
+        g = np.zeros(len(self.flow_ids), dtype=np.float64)
+        columns = self.columns
+        for (key, amount) in amounts.items():
+            (flow_id, loc_id) = key if isinstance(key, tuple) else (key, None)
+            col = columns.get((flow_id, loc_id))
+            if col is None and loc_id is not None:
+                col = columns.get((flow_id, None))
+            if col is not None:
+                g[col] += amount
+        return g
+
+    def results(
+        self,
+        amounts: Mapping[str | tuple[str, str | None], float],
+        parameters: ParameterSet | None = None,
+    ) -> np.ndarray:
+        """Calculates the LCIA results `h = C * g` of the given inventory,
+        aligned with the rows of C."""
+        return self.matrix(parameters) @ self.inventory_vector(amounts)
+
+    def _array(self, name: str) -> np.ndarray:
+        return np.load(self.folder / name, mmap_mode="r")
+
+    def _idx(self, name: str) -> list[list[str]]:
+        path = self.folder / name
+        if not path.exists():
+            log.error("index file %s does not exist", path)
+            return []
+        with open(path, "r", encoding="utf-8", newline="") as inp:
+            reader = csv.reader(inp)
+            next(reader)
+            return list(reader)
+
+
+def _key_of(parameters: ParameterSet) -> tuple:
+    return tuple(
+        sorted((k.lower(), float(v)) for (k, v) in parameters.items())
+    )
+
+
+# the header of `C.bin`: a magic number, the dtypes of the index and value
+# arrays, the shape of C, the number of entries, and the byte offsets of the
+# arrays indptr, indices, and data in the file
+_RAW_HEADER = struct.Struct("<8s4s4s6q")
+_RAW_MAGIC = b"OLCA-CSC"
+_RAW_ALIGN = 64
+
+# the maximum relative error of values that are stored as float32 numbers
+_F32_RTOL = 1e-6
+
+
+def write_raw(
+    folder: Path, C: sparse.csc_array | sparse.csr_array, compact=False
+) -> Path:
+    """Writes the CSC arrays of the given matrix uncompressed into `C.bin`,
+    so that they can be memory-mapped without copying; see `read_raw`. In
+    compact mode, the values are stored as float32 and the indices as int32
+    numbers, otherwise as float64 and int64 numbers. Values that cannot be
+    stored as float32 numbers within a relative tolerance of `_F32_RTOL`
+    (because they would underflow to 0 or overflow, for example) are not
+    rounded silently: an error is logged and the values are then stored as
+    float64 numbers."""
+    csc = sparse.csc_array(C)
+    csc.sort_indices()
+    (index_type, value_type) = (
+        (np.dtype("<i4"), np.dtype("<f4"))
+        if compact
+        else (np.dtype("<i8"), np.dtype("<f8"))
+    )
+    if compact and max(csc.nnz, *csc.shape) > np.iinfo(np.int32).max:
+        raise ValueError("matrix C is too large for int32 indices")
+    with np.errstate(over="ignore"):
+        values = csc.data.astype(value_type)
+    if compact:
+        lost = _f32_losses(csc.data, values)
+        if lost > 0:
+            log.error(
+                "%i values of C cannot be stored as float32 numbers;"
+                " C.bin is written with float64 values",
+                lost,
+            )
+            value_type = np.dtype("<f8")
+            values = csc.data.astype(value_type)
+    arrays = (
+        csc.indptr.astype(index_type),
+        csc.indices.astype(index_type),
+        values,
+    )
+    offsets: list[int] = []
+    pos = _RAW_HEADER.size
+    for a in arrays:
+        pos += -pos % _RAW_ALIGN
+        offsets.append(pos)
+        pos += a.nbytes
+    path = folder / "C.bin"
+    with open(path, "wb") as out:
+        out.write(
+            _RAW_HEADER.pack(
+                _RAW_MAGIC,
+                index_type.str.encode("ascii"),
+                value_type.str.encode("ascii"),
+                *csc.shape,
+                csc.nnz,
+                *offsets,
+            )
+        )
+        for (offset, a) in zip(offsets, arrays):
+            out.write(b"\0" * (offset - out.tell()))
+            out.write(a.tobytes())
+    return path
+
+
+def _f32_losses(data: np.ndarray, narrowed: np.ndarray) -> int:
+    """Counts the nonzero values that change by more than `_F32_RTOL` when
+    they are stored as float32 numbers; including values that become 0 or
+    infinite."""
+    back = narrowed.astype(np.float64)
+    with np.errstate(invalid="ignore", over="ignore"):
+        changed = np.abs(back - data) > _F32_RTOL * np.abs(data)
+    lost = (data != 0) & ((back == 0) | ~np.isfinite(back) | changed)
+    return int(np.count_nonzero(lost))
+
+
+def read_raw(path: Path) -> sparse.csc_array:
+    """Opens a matrix that was written with `write_raw`. The arrays of the
+    matrix are read-only memory maps of the file, so that processes that
+    open the same file share its pages in the file system cache."""
+    with open(path, "rb") as inp:
+        head = inp.read(_RAW_HEADER.size)
+    if len(head) < _RAW_HEADER.size:
+        raise ValueError(f"invalid matrix file: {path}")
+    (magic, index_type, value_type, k, m, nnz, *offsets) = (
+        _RAW_HEADER.unpack(head)
+    )
+    if magic != _RAW_MAGIC:
+        raise ValueError(f"invalid matrix file: {path}")
+    index_type = np.dtype(index_type.rstrip(b"\0").decode("ascii"))
+    value_type = np.dtype(value_type.rstrip(b"\0").decode("ascii"))
+
+    def array(dtype: np.dtype, offset: int, n: int) -> np.ndarray:
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=n)
+
+    return sparse.csc_array(
+        (
+            array(value_type, offsets[2], nnz),
+            array(index_type, offsets[1], nnz),
+            array(index_type, offsets[0], m + 1),
+        ),
+        shape=(k, m),
+        copy=False,
+    )
+
+
+def write_csr(folder: Path, C: sparse.csc_array | sparse.csr_array):
+    """Writes the CSR copy of the given matrix that is read by `Library`."""
+    csr = sparse.csr_array(C)
+    csr.sort_indices()
+    np.save(folder / "C_indptr.npy", csr.indptr)
+    np.save(folder / "C_indices.npy", csr.indices)
+    np.save(folder / "C_data.npy", csr.data)
@@ -0,0 +1,247 @@
+# This script applies a flow mapping to the characterization factors of the
+# LCIA library that is created by build_libs.py. The source flows of the
+# mapping are the flows of the library (e.g. SimaPro_Export.csv) and the
+# factors are converted via `c_t = (1 / x) * c_s`, see
+# docs/format_csv_flow_mapping.md. The result is written as matrix C with
+# the respective flow and indicator indices like in the library.
+
+import argparse
+import csv
+import logging as log
+
+from enum import StrEnum
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from scipy import sparse
+
+import build_libs
+import flowmap
+import library
+
+from flowmap import Col
+
+
+class Aggregation(StrEnum):
+    """How the factors are combined when several source flows of an
+    indicator are mapped to the same target flow."""
+
+    MEAN = "mean"
+    SUM = "sum"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="applies a flow mapping to the LCIA library"
+    )
+    parser.add_argument(
+        "mapping", help="the mapping file name in refdata/mappings or a path"
+    )
+    parser.add_argument(
+        "--method",
+        action="append",
+        default=[],
+        help="the ID or name of an LCIA method; default: all methods",
+    )
+    parser.add_argument(
+        "--aggregate",
+        choices=[a.value for a in Aggregation],
+        default=Aggregation.MEAN.value,
+        help="how factors of source flows with the same target are combined",
+    )
+    parser.add_argument(
+        "--lib",
+        type=Path,
+        default=build_libs._LIB / f"openLCA-LCIA-pack-{build_libs.VERSION}",
+        help="the folder of the LCIA library",
+    )
+    parser.add_argument("--out", type=Path, help="the output folder")
+    args = parser.parse_args()
+
+    fm = flowmap.FlowMap.open(args.mapping)
+    out: Path = args.out or (
+        build_libs._LIB.parent / "mapped" / Path(args.mapping).stem
+    )
+    try:
+        map_library(
+            args.lib, fm, out, args.method, Aggregation(args.aggregate)
+        )
+    except KeyError as e:
+        parser.error(e.args[0])
+
+
+def map_library(
+    lib: Path,
+    fm: flowmap.FlowMap,
+    out: Path,
+    methods: list[str] = [],
+    aggregation: Aggregation = Aggregation.MEAN,
+):
+    """Maps the matrix C of the given library and writes the result with its
+    indices into the output folder. Raises a `KeyError` for an unknown
+    method before anything is written. In a regionalized library, the
+    columns of a flow with different locations are mapped to separate
+    columns of the target flow that keep these locations."""
+    lib_dir = library.Library(lib)
+    flow_ids = lib_dir.flow_ids
+    locations = lib_dir.location_ids if lib_dir.is_regionalized else None
+    impacts = _read_idx(lib / "index_C.csv")
+
+    if methods:
+        rows: list[int] = []
+        for method_id in methods:
+            method = lib_dir.methods.get(method_id)
+            if method is None:
+                raise KeyError(f"unknown LCIA method: {method_id}")
+            rows.extend(row for row in method.rows if row not in rows)
+        C = lib_dir.rows_matrix(rows)
+        impacts = [impacts[i] for i in rows]
+    else:
+        C = sparse.csr_array(lib_dir.matrix())
+
+    (C_t, targets, sources) = map_matrix(
+        C, flow_ids, fm, aggregation, locations
+    )
+    log.info(
+        "mapped %ix%i matrix to %i target flows with %i factors",
+        C.shape[0],
+        C.shape[1],
+        C_t.shape[1],
+        C_t.nnz,
+    )
+
+    out.mkdir(parents=True, exist_ok=True)
+    sparse.save_npz(str(out / "C.npz"), C_t.tocsc())
+    flow_idx = _read_idx(lib / "index_B.csv") if locations else None
+    _write_flow_idx(out / "index_B.csv", fm, targets, sources, flow_idx)
+    with open(out / "index_C.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["index", "indicator ID", "indicator name", "indicator unit"]
+        )
+        for (i, row) in enumerate(impacts):
+            writer.writerow([i] + row[1:4])
+
+
+def map_matrix(
+    C: sparse.csr_array,
+    flow_ids: list[str],
+    fm: flowmap.FlowMap,
+    aggregation: Aggregation = Aggregation.MEAN,
+    locations: list[str | None] | None = None,
+) -> tuple[sparse.csr_array, list[int], list[int]]:
+    """Re-indexes the columns of the given characterization matrix from the
+    source flows to the target flows of the mapping. This is the product
+    `C * M` with a mapping matrix `M` that contains `1 / x` for each source
+    flow `s` and target flow `t`. With the locations of the columns of a
+    regionalized matrix, a target flow gets a column for each location of
+    its source flows, so that factors of different locations are not
+    combined. Returns the mapped matrix and, for each of its columns, the
+    mapping row that describes the target flow and the first column of C
+    that is mapped to it."""
+
+    (cols, rows) = fm.find_all(flow_ids)
+    unmapped = len(flow_ids) - len(np.unique(cols))
+    if unmapped > 0:
+        log.warning("%i flows with factors are not mapped", unmapped)
+
+    # flows with a conversion factor of 0 cannot be mapped
+    x = fm.factors[rows]
+    valid = x != 0
+    if not valid.all():
+        log.error("%i mappings have a conversion factor of 0", (~valid).sum())
+    (cols, rows, x) = (cols[valid], rows[valid], x[valid])
+
+    # the target flows get their columns in the order of their first
+    # occurrence in the mapping
+    target_keys = [
+        flowmap.key_of(fm.cell(int(r), Col.TARGET_FLOW_UUID)) for r in rows
+    ]
+    if locations is not None:
+        target_keys = [
+            f"{key}\t{locations[c] or ''}"
+            for (key, c) in zip(target_keys, cols.tolist())
+        ]
+    (keys, first, target_cols) = np.unique(
+        target_keys, return_index=True, return_inverse=True
+    )
+    order = np.argsort(first, kind="stable")
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[order] = np.arange(len(keys))
+    target_cols = rank[target_cols]
+    targets = [int(rows[first[i]]) for i in order]
+    sources = [int(cols[first[i]]) for i in order]
+
+    # the same source and target could be in the mapping more than once
+    (pairs, index) = np.unique(
+        np.stack((cols, target_cols)), axis=1, return_index=True
+    )
+    M = sparse.csr_array(
+        (1 / x[index], (pairs[0], pairs[1])),
+        shape=(len(flow_ids), len(targets)),
+    )
+
+    C_t = sparse.csr_array(C @ M)
+    if aggregation == Aggregation.MEAN:
+        counts = sparse.csr_array(
+            (C != 0).astype(np.float64) @ (M != 0).astype(np.float64)
+        )
+        C_t = sparse.csr_array(C_t.multiply(counts.power(-1)))
+    C_t.eliminate_zeros()
+    return (C_t, targets, sources)
+
+
+def _read_idx(path: Path) -> list[list[str]]:
+    with open(path, "r", encoding="utf-8", newline="") as inp:
+        reader = csv.reader(inp)
+        next(reader)
+        return list(reader)
+
+
+def _write_flow_idx(
+    path: Path,
+    fm: flowmap.FlowMap,
+    targets: list[int],
+    sources: list[int],
+    flow_idx: list[list[str]] | None = None,
+):
+    """Writes the flow index of the mapped matrix. With the flow index of a
+    regionalized library, the locations of the columns are taken from the
+    source columns, otherwise the target location of the mapping is
+    written."""
+    with open(path, "w", encoding="utf-8", newline="") as out:
+        writer = csv.writer(out)
+        writer.writerow(
+            [
+                "index",
+                "is input",
+                "flow ID",
+                "flow name",
+                "flow category",
+                "flow unit",
+                "flow type",
+                "location ID",
+                "location name",
+                "location code",
+            ]
+        )
+        for (i, (row, source)) in enumerate(zip(targets, sources)):
+            category = fm.cell(row, Col.TARGET_CATEGORY)
+            record: list[Any] = [None] * 10
+            record[0] = i
+            record[1] = "true" if "resource" in category.lower() else "false"
+            record[2] = fm.cell(row, Col.TARGET_FLOW_UUID)
+            record[3] = fm.cell(row, Col.TARGET_FLOW_NAME)
+            record[4] = category
+            record[5] = fm.cell(row, Col.TARGET_UNIT_NAME)
+            if flow_idx is not None:
+                record[7:10] = [v or None for v in flow_idx[source][7:10]]
+            else:
+                record[9] = fm.cell(row, Col.TARGET_LOCATION) or None
+            writer.writerow(record)
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO)
+    main()
@@ -1,18 +1,54 @@
+# This module reads the reference data into olca-schema objects. The LCIA
+# factors are the largest part of these data; reading them has two steps:
+# parsing the files in `refdata/lcia_factors` into dictionary encoded shards
+# and creating the `lca.ImpactFactor` objects from these shards. Only the
+# first step is sped up by the worker processes, the cache in `build/cache`,
+# and the factor store (see factor_store.py). The objects are still created
+# one by one in the calling process, which takes most of the time of a read
+# with a warm cache. Code that only needs the factor values, like the matrix
+# of build_libs.py, should therefore use `FactorTable`, which resolves the
+# shards with NumPy without creating objects, or the `lazy` mode of
+# `RefData.read` that creates the objects of a category on first access.
+
 import csv
+import gc
+import hashlib
 import logging as log
+import marshal
+import numpy as np
 import olca_schema as lca
-
+import os
+import stages
+import sys
+
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from typing import Iterable
+from typing import Any, Callable, Iterable, Iterator, TypeVar
 
 _ref_dir = Path(__file__).parent.parent / "refdata"
+_cache_dir = Path(__file__).parent.parent / "build" / "cache"
+
+# the LCIA factors in columnar form, see factor_store.py; it is used instead
+# of the CSV files when it was created from their current content
+_factor_store = Path(__file__).parent.parent / "build" / "lcia_factors.npz"
+
+# increment this when the format of the cache entries changes
+_CACHE_VERSION = 1
+
+T = TypeVar("T")
 
 
 class RefDataSet(Enum):
     UNITS = 1
     FLOWS = 2
-    ALL = 3
+    METHODS = 3  # LCIA categories and methods without factors
+    ALL = 4
 
 
 class RefData:
@@ -23,30 +59,301 @@ class RefData:
         self.flow_properties: dict[str, lca.FlowProperty] = {}
         self.flows: dict[str, lca.Flow] = {}
         self.locations: dict[str, lca.Location] = {}
-        self.impact_categories: dict[str, lca.ImpactCategory] = {}
+        self.impact_categories: Mapping[str, lca.ImpactCategory] = {}
         self.impact_methods: dict[str, lca.ImpactMethod] = {}
+        self._cache: _Cache | None = None
+        self._refs: dict[tuple[str, str | None], lca.Ref] = {}
+
+    def ref_of(self, entity: lca.RootEntity) -> lca.Ref:
+        """Returns the reference to the given entity. There is one shared
+        `Ref` instance per entity in these data; so it should not be changed
+        for a single usage."""
+        key = (entity.__class__.__name__, entity.id)
+        ref = self._refs.get(key)
+        if ref is None:
+            ref = _ref_of(entity)
+            self._refs[key] = ref
+        return ref
 
     @staticmethod
-    def read(subset=RefDataSet.ALL) -> "RefData":
+    def read(
+        subset=RefDataSet.ALL,
+        workers: int = 1,
+        cache: bool = False,
+        lazy: bool = False,
+        max_factor_lists: int = 64,
+    ) -> "RefData":
+        """Reads the reference data. With `workers > 1`, the files in the
+        `lcia_factors` folder are parsed in a process pool of that size. With
+        `cache`, the parsed CSV files are stored in `build/cache` and only
+        files with a changed content are parsed again in later runs. Both
+        only speed up the parsing; the factor objects are created in this
+        process in any case.
+
+        With `lazy`, the factors of an LCIA category are read when the
+        category is first accessed in `impact_categories`, and at most
+        `max_factor_lists` categories keep their factors in memory; the
+        factors of the least recently used category are dropped first."""
         data = RefData()
-        _units_into(data)
-        _currencies_into(data)
-        if subset == RefDataSet.UNITS:
-            return data
-        _flows_into(data)
-        _locations_into(data)
-        if subset == RefDataSet.FLOWS:
-            return data
-        _impact_categories_into(data)
-        _impact_methods_into(data)
+        if cache:
+            data._cache = _Cache(_cache_dir)
+        with stages.stage("read"):
+            _run("units", _units_into, data)
+            _run("currencies", _currencies_into, data)
+            if subset == RefDataSet.UNITS:
+                return data
+            _run("flows", _flows_into, data)
+            _run("locations", _locations_into, data)
+            if subset == RefDataSet.FLOWS:
+                return data
+            _run("impact categories", _impact_categories_into, data)
+            _run("impact methods", _impact_methods_into, data)
+            if subset == RefDataSet.METHODS:
+                return data
+            if lazy:
+                data.impact_categories = _LazyImpactCategories(
+                    data, max_factor_lists
+                )
+                return data
+            _run("impact factors", _impact_factors_into, data, workers)
         return data
 
 
+class _LazyImpactCategories(Mapping[str, lca.ImpactCategory]):
+    """The LCIA categories of the reference data that read their factors
+    from the `lcia_factors` folder when they are accessed. Only the factor
+    lists of the `max_loaded` most recently accessed categories are kept;
+    the factors of other categories are set to `None` again."""
+
+    def __init__(self, data: RefData, max_loaded: int):
+        self.heads = dict(data.impact_categories)
+        self.max_loaded = max(1, max_loaded)
+        self._data = data
+        self._loaded: OrderedDict[str, lca.ImpactCategory] = OrderedDict()
+        self._shards: dict[str, Path] | None = None
+
+    def __getitem__(self, key: str) -> lca.ImpactCategory:
+        impact = self.heads[key]
+        self._load(impact)
+        return impact
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.heads
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.heads)
+
+    def __len__(self) -> int:
+        return len(self.heads)
+
+    def _load(self, impact: lca.ImpactCategory):
+        if impact.id is None:
+            return
+        if impact.id in self._loaded:
+            self._loaded.move_to_end(impact.id)
+            return
+        path = self._shard_of(impact.id)
+        if path is not None:
+            shard = _read_factor_shard(path, self._data._cache)
+            _factors_into(self._data, shard, only=impact)
+        self._loaded[impact.id] = impact
+        while len(self._loaded) > self.max_loaded:
+            (_, dropped) = self._loaded.popitem(last=False)
+            dropped.impact_factors = None
+
+    def _shard_of(self, impact_id: str) -> Path | None:
+        path = _ref_dir / "lcia_factors" / f"{impact_id[0:5]}.csv"
+        if path.exists():
+            return path
+        # the file names are not required to follow the ID prefixes; in this
+        # case, we index the files by the category of their first row
+        if self._shards is None:
+            self._shards = {}
+            for path in (_ref_dir / "lcia_factors").iterdir():
+                for row in _read_csv(path):
+                    self._shards.setdefault(row[0], path)
+                    break
+        return self._shards.get(impact_id)
+
+
+@dataclass
+class FormulaFactor:
+    flow: int
+    flow_property: int
+    unit: int
+    location: int
+    formula: str
+
+
+@dataclass
+class FactorColumns:
+    """The numeric characterization factors of an LCIA category as columns
+    of equal length. Factors with a formula are stored in `formulas`."""
+
+    flows: np.ndarray
+    flow_properties: np.ndarray
+    units: np.ndarray
+    locations: np.ndarray
+    values: np.ndarray
+    formulas: list[FormulaFactor]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+@dataclass
+class FactorTable:
+    """The characterization factors of the reference data without creating
+    `lca.ImpactFactor` objects. The index columns of the categories point
+    into the ID lists of the table; the location index is -1 if a factor
+    has no location. The given data need to contain the flows and LCIA
+    categories (`RefDataSet.METHODS`) to resolve the factors; the cache
+    setting of these data is also used for reading the factors."""
+
+    flows: list[str] = field(default_factory=list)
+    flow_properties: list[str] = field(default_factory=list)
+    units: list[str] = field(default_factory=list)
+    locations: list[str] = field(default_factory=list)
+    categories: dict[str, FactorColumns] = field(default_factory=dict)
+
+    @staticmethod
+    def read(data: RefData, workers: int = 1) -> "FactorTable":
+        table = FactorTable()
+        chunks: dict[str, list[FactorColumns]] = {}
+        for (impact_id, columns) in table.stream(data, workers):
+            chunks.setdefault(impact_id, []).append(columns)
+        for (impact_id, cs) in chunks.items():
+            table.categories[impact_id] = _concat_columns(cs)
+        return table
+
+    def stream(
+        self, data: RefData, workers: int = 1
+    ) -> Iterator[tuple[str, FactorColumns]]:
+        """Reads the factors file by file and yields them as columns of the
+        respective LCIA category, without storing them in `categories`. The
+        ID lists of this table grow while reading; the factors of a category
+        can be split over multiple chunks."""
+        impact_ids: list[str] = []
+        indices = (
+            _TableIndex(impact_ids, _impact_heads(data)),
+            _TableIndex(self.flows, data.flows),
+            _TableIndex(self.flow_properties, data.flow_properties),
+            _TableIndex(self.units, data.units),
+            _TableIndex(self.locations, data.locations),
+        )
+
+        for shard in _factor_shards(workers, data._cache):
+            codes = np.frombuffer(shard.codes, dtype=np.intc).reshape(-1, 5)
+            cols = [
+                idx.lut(shard.keys, codes[:, j])[codes[:, j]]
+                for (j, idx) in enumerate(indices)
+            ]
+            (impacts, flows, props, units, locations) = cols
+            valid = (impacts >= 0) & (flows >= 0) & (props >= 0) & (units >= 0)
+            if not valid.all():
+                _log_invalid_factors(shard, codes, cols, valid)
+
+            values = np.frombuffer(shard.values, dtype=np.float64)
+            is_formula = np.zeros(len(values), dtype=bool)
+            if shard.formulas:
+                is_formula[list(shard.formulas.keys())] = True
+
+            for impact in np.unique(impacts[valid]):
+                rows = valid & (impacts == impact)
+                nums = rows & ~is_formula
+                yield (
+                    impact_ids[impact],
+                    FactorColumns(
+                        flows=flows[nums],
+                        flow_properties=props[nums],
+                        units=units[nums],
+                        locations=locations[nums],
+                        values=values[nums],
+                        formulas=[
+                            FormulaFactor(
+                                flow=int(flows[i]),
+                                flow_property=int(props[i]),
+                                unit=int(units[i]),
+                                location=int(locations[i]),
+                                formula=shard.formulas[i],
+                            )
+                            for i in np.flatnonzero(rows & is_formula)
+                        ],
+                    ),
+                )
+
+
+class _TableIndex:
+    """Maps the keys (IDs or names) of entities to positions in a list of
+    entity IDs."""
+
+    def __init__(self, ids: list[str], entities: dict[str, Any]):
+        self.ids = ids
+        self.entities = entities
+        self.positions: dict[str, int] = {}
+        self.resolved: dict[str, int] = {}
+
+    def lut(self, keys: list[str], codes: np.ndarray) -> np.ndarray:
+        """Returns a lookup table from the given key codes to positions in
+        the ID list; -1 for keys that cannot be resolved."""
+        lut = np.full(len(keys), -1, dtype=np.int32)
+        used = np.unique(codes)
+        resolved = self.resolved
+        lut[used] = [
+            resolved[key] if key in resolved else self._resolve(key)
+            for key in (keys[code] for code in used.tolist())
+        ]
+        return lut
+
+    def _resolve(self, key: str) -> int:
+        entity = self.entities.get(key) if key else None
+        if entity is None or entity.id is None:
+            pos = -1
+        else:
+            pos = self.positions.get(entity.id, -1)
+            if pos == -1:
+                pos = len(self.ids)
+                self.positions[entity.id] = pos
+                self.ids.append(entity.id)
+        self.resolved[key] = pos
+        return pos
+
+
+def _log_invalid_factors(
+    shard: "_FactorShard",
+    codes: np.ndarray,
+    cols: list[np.ndarray],
+    valid: np.ndarray,
+):
+    labels = ("impact category", "flow", "flow property", "unit")
+    for i in np.flatnonzero(~valid):
+        for (j, label) in enumerate(labels):
+            if cols[j][i] < 0:
+                log.error("invalid %s %s", label, shard.keys[codes[i, j]])
+                break
+
+
+def _concat_columns(cs: list[FactorColumns]) -> FactorColumns:
+    if len(cs) == 1:
+        return cs[0]
+    formulas: list[FormulaFactor] = []
+    for c in cs:
+        formulas.extend(c.formulas)
+    return FactorColumns(
+        flows=np.concatenate([c.flows for c in cs]),
+        flow_properties=np.concatenate([c.flow_properties for c in cs]),
+        units=np.concatenate([c.units for c in cs]),
+        locations=np.concatenate([c.locations for c in cs]),
+        values=np.concatenate([c.values for c in cs]),
+        formulas=formulas,
+    )
+
+
 def _units_into(data: RefData):
 
     # collect units as {group_id -> list[Unit]}
     units: dict[str, list[lca.Unit]] = {}
-    for row in _csv("units.csv"):
+    for row in _csv("units.csv", data._cache):
         unit = lca.Unit()
         unit.id = row[0]
         unit.name = row[1]
@@ -67,7 +374,7 @@ def _units_into(data: RefData):
 
     # collect unit groups
     groups: dict[str, tuple[lca.UnitGroup, str]] = {}
-    for row in _csv("unit_groups.csv"):
+    for row in _csv("unit_groups.csv", data._cache):
         group = lca.UnitGroup()
         ids = _fill_head(group, row)
         group.units = []
@@ -81,7 +388,7 @@ def _units_into(data: RefData):
             groups[group_id] = (group, row[4])
 
     # collect flow properties
-    for row in _csv("flow_properties.csv"):
+    for row in _csv("flow_properties.csv", data._cache):
         prop = lca.FlowProperty()
         ids = _fill_head(prop, row)
         for prop_id in ids:
@@ -96,14 +403,14 @@ def _units_into(data: RefData):
             log.error("invalid unit group %s", row[4])
             continue
         (group, default_prop) = group_def
-        prop.unit_group = _ref_of(group)
+        prop.unit_group = data.ref_of(group)
         if default_prop in ids:
-            group.default_flow_property = _ref_of(prop)
+            group.default_flow_property = data.ref_of(prop)
 
 
 def _currencies_into(data: RefData):
     refc: lca.Currency | None = None
-    for row in _csv("currencies.csv"):
+    for row in _csv("currencies.csv", data._cache):
         c = lca.Currency()
         ids = _fill_head(c, row)
         for cid in ids:
@@ -117,14 +424,23 @@ def _currencies_into(data: RefData):
         log.error("no reference currency defined")
         return
     for c in data.currencies.values():
-        c.ref_currency = _ref_of(refc)
+        c.ref_currency = data.ref_of(refc)
 
 
 def _flows_into(data: RefData):
-    for row in _csv("flows.csv"):
+
+    # we index the flow property factors of each flow by property ID and
+    # track the flows that already have a reference flow property, so that
+    # adding factors does not need to scan the factor lists of the flows
+    factors_of: dict[str, dict[str, lca.FlowPropertyFactor]] = {}
+    with_ref: set[str] = set()
+
+    for row in _csv("flows.csv", data._cache):
         flow = lca.Flow()
         (flow_id, _) = _fill_head(flow, row)
         data.flows[flow_id] = flow
+        factors_of[flow_id] = {}
+        with_ref.discard(flow_id)
         flow.flow_type = _flow_type_of(row[4])
         flow.cas = _opt(row[5])
         flow.formula = _opt(row[6])
@@ -132,16 +448,16 @@ def _flows_into(data: RefData):
         if prop is None:
             log.error("invalid flow property %s in flow %s", row[7], flow_id)
             continue
-        if prop is not None:
-            flow.flow_properties = [
-                lca.FlowPropertyFactor(
-                    conversion_factor=1,
-                    flow_property=_ref_of(prop),
-                    is_ref_flow_property=True,
-                )
-            ]
+        factor = lca.FlowPropertyFactor(
+            conversion_factor=1,
+            flow_property=data.ref_of(prop),
+            is_ref_flow_property=True,
+        )
+        flow.flow_properties = [factor]
+        factors_of[flow_id][prop.id] = factor
+        with_ref.add(flow_id)
 
-    for row in _csv("flow_property_factors.csv"):
+    for row in _csv("flow_property_factors.csv", data._cache):
         flow = data.flows.get(row[0])
         if flow is None:
             log.error("invalid flow %s in flow property factors", row[0])
@@ -150,41 +466,26 @@ def _flows_into(data: RefData):
         if prop is None:
             log.error("invalid property %s in flow property factors", row[1])
             continue
-        factor = float(row[2])
-        if flow.flow_properties is None:
-            flow.flow_properties = [
-                lca.FlowPropertyFactor(
-                    conversion_factor=factor,
-                    flow_property=_ref_of(prop),
-                    is_ref_flow_property=factor == 1.0,
-                )
-            ]
-            continue
-
-        already_exists = False
-        has_ref = False
-        for f in flow.flow_properties:
-            if not f.flow_property:
-                continue
-            if f.flow_property and f.flow_property.id == prop.id:
-                already_exists = True
-                break
-            if f.is_ref_flow_property:
-                has_ref = True
-
-        if already_exists:
+        factors = factors_of[row[0]]
+        if prop.id in factors:
             continue
-        flow.flow_properties.append(
-            lca.FlowPropertyFactor(
-                conversion_factor=factor,
-                flow_property=_ref_of(prop),
-                is_ref_flow_property=not has_ref and factor == 1.0,
-            )
+        value = float(row[2])
+        factor = lca.FlowPropertyFactor(
+            conversion_factor=value,
+            flow_property=data.ref_of(prop),
+            is_ref_flow_property=row[0] not in with_ref and value == 1.0,
         )
+        if flow.flow_properties is None:
+            flow.flow_properties = [factor]
+        else:
+            flow.flow_properties.append(factor)
+        factors[prop.id] = factor
+        if factor.is_ref_flow_property:
+            with_ref.add(row[0])
 
 
 def _locations_into(data: RefData):
-    for row in _csv("locations.csv"):
+    for row in _csv("locations.csv", data._cache):
         loc = lca.Location()
         ids = _fill_head(loc, row)
         for loc_id in ids:
@@ -195,86 +496,278 @@ def _locations_into(data: RefData):
 
 
 def _impact_categories_into(data: RefData):
-
-    for row in _csv("lcia_categories.csv"):
+    impacts: dict[str, lca.ImpactCategory] = {}
+    for row in _csv("lcia_categories.csv", data._cache):
         impact = lca.ImpactCategory()
         (imp_id, _) = _fill_head(impact, row)
         impact.ref_unit = _opt(row[4])
-        data.impact_categories[imp_id] = impact
+        impacts[imp_id] = impact
+    data.impact_categories = impacts
+
+
+def _impact_heads(data: RefData) -> Mapping[str, lca.ImpactCategory]:
+    # the LCIA categories without triggering a lazy loading of factors
+    impacts = data.impact_categories
+    if isinstance(impacts, _LazyImpactCategories):
+        return impacts.heads
+    return impacts
+
+
+def _impact_factors_into(data: RefData, workers: int = 1):
+    for shard in _factor_shards(workers, data._cache):
+        stages.count(len(shard.values))
+        _factors_into(data, shard)
+
+    # the number of factors per category for the statistics
+    counts = [
+        len(impact.impact_factors or [])
+        for impact in data.impact_categories.values()
+    ]
+    if stage := stages.current():
+        stage.details["categories"] = len(counts)
+        stage.details["factors"] = sum(counts)
+        if counts:
+            stage.details["factors per category (mean, max)"] = (
+                round(sum(counts) / len(counts)),
+                max(counts),
+            )
+
+
+def _factor_shards(
+    workers: int = 1, cache: "_Cache | None" = None
+) -> Iterator["_FactorShard"]:
+    # each file contains the factors of one category; so we can parse them
+    # independently and merge the results in a stable order
+    paths = sorted((_ref_dir / "lcia_factors").iterdir())
+    store = _FactorStore.current(paths)
+    if store is not None:
+        yield from store.shards()
+        return
+    if workers <= 1 or len(paths) < 2:
+        for path in paths:
+            yield _read_factor_shard(path, cache)
+        return
+    read = partial(_read_factor_shard, cache=cache)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(read, paths, chunksize=4)
+
+
+@dataclass
+class _FactorShard:
+    """The parsed rows of a file in the `lcia_factors` folder. The string
+    columns (category, flow, flow property, unit, location) are dictionary
+    encoded: each row has 5 codes in `codes` that point into `keys`. Values
+    that are not numbers are stored in `formulas` by row index."""
+
+    keys: list[str]
+    codes: array
+    values: array
+    formulas: dict[int, str]
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def encode(self) -> tuple:
+        return (
+            self.keys,
+            self.codes.tobytes(),
+            self.values.tobytes(),
+            self.formulas,
+        )
+
+    @staticmethod
+    def decode(t: tuple) -> "_FactorShard":
+        (keys, codes, values, formulas) = t
+        shard = _FactorShard(keys, array("i"), array("d"), formulas)
+        shard.codes.frombytes(codes)
+        shard.values.frombytes(values)
+        return shard
+
+
+def _read_factor_shard(
+    path: Path, cache: "_Cache | None" = None
+) -> _FactorShard:
+    if cache is not None:
+        return cache.shard(path)
+    shard = _FactorShard([], array("i"), array("d"), {})
+    key_idx: dict[str, int] = {}
+    for row in _read_csv(path):
+        for key in row[0:5]:
+            code = key_idx.get(key)
+            if code is None:
+                code = len(shard.keys)
+                key_idx[key] = code
+                shard.keys.append(key)
+            shard.codes.append(code)
+        try:
+            shard.values.append(float(row[5]))
+        except:
+            shard.formulas[len(shard.values)] = row[5]
+            shard.values.append(0.0)
+    return shard
+
+
+class _FactorStore:
+    """The LCIA factors of all files in the `lcia_factors` folder in a NumPy
+    archive, with the string columns dictionary encoded: for each of the
+    `COLUMNS` there is an array with the distinct strings and an array
+    with the codes of the rows. The rows of the files are stored one after
+    another in `offsets`, and the SHA-1 hashes of the files are stored to
+    check that the archive is up to date."""
+
+    COLUMNS = ("category", "flow", "property", "unit", "location")
+
+    def __init__(self, npz: Any):
+        self.npz = npz
 
-    for path in (_ref_dir / "lcia_factors").iterdir():
-        for row in _csv(path):
-            impact = data.impact_categories.get(row[0])
+    @staticmethod
+    def current(paths: list[Path]) -> "_FactorStore | None":
+        if not _factor_store.exists():
+            return None
+        try:
+            npz = np.load(_factor_store, allow_pickle=False)
+            names = npz["shards"].tolist()
+            hashes = npz["hashes"].tolist()
+        except Exception as e:
+            log.warning("invalid factor store %s: %s", _factor_store, e)
+            return None
+        if names != [p.name for p in paths]:
+            return None
+        for (path, digest) in zip(paths, hashes):
+            with open(path, "rb") as inp:
+                if hashlib.sha1(inp.read()).hexdigest() != digest:
+                    log.info("factor store is outdated: %s changed", path)
+                    return None
+        log.info("read LCIA factors from %s", _factor_store)
+        return _FactorStore(npz)
+
+    def shards(self) -> Iterator[_FactorShard]:
+        npz = self.npz
+
+        # the codes of the columns are shifted into one key space
+        keys: list[str] = []
+        columns = []
+        for col in self.COLUMNS:
+            columns.append(npz[col].astype(np.int64) + len(keys))
+            keys.extend(npz[f"{col}_keys"].tolist())
+        codes = np.stack(columns, axis=1)
+        del columns
+
+        values = npz["values"]
+        offsets = npz["offsets"]
+        formula_rows = npz["formula_rows"]
+        formulas = npz["formulas"].tolist()
+        for i in range(len(offsets) - 1):
+            (start, end) = (int(offsets[i]), int(offsets[i + 1]))
+            (used, local) = np.unique(codes[start:end], return_inverse=True)
+            shard = _FactorShard(
+                [keys[k] for k in used], array("i"), array("d"), {}
+            )
+            shard.codes.frombytes(local.ravel().astype(np.intc).tobytes())
+            shard.values.frombytes(values[start:end].tobytes())
+            (a, b) = np.searchsorted(formula_rows, [start, end])
+            for j in range(a, b):
+                shard.formulas[int(formula_rows[j]) - start] = formulas[j]
+            yield shard
+
+
+def _factors_into(
+    data: RefData,
+    shard: _FactorShard,
+    only: lca.ImpactCategory | None = None,
+):
+    keys = shard.keys
+    heads = _impact_heads(data)
+    impacts = [heads.get(k) for k in keys]
+    flows = [_ref_or_none(data, data.flows.get(k)) for k in keys]
+    props = [_ref_or_none(data, data.flow_properties.get(k)) for k in keys]
+    units = [_ref_or_none(data, data.units.get(k)) for k in keys]
+    locations = [
+        _ref_or_none(data, data.locations.get(k)) if k else None
+        for k in keys
+    ]
+
+    # we only create acyclic objects here, so there is no need to let the
+    # cyclic garbage collector run over them again and again
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        codes = iter(shard.codes)
+        rows = zip(codes, codes, codes, codes, codes)
+        for (i, (ic, fc, pc, uc, lc)) in enumerate(rows):
+            impact = impacts[ic]
             if impact is None:
-                log.error("invalid impact category %s", row[0])
+                log.error("invalid impact category %s", keys[ic])
+                continue
+            if only is not None and impact is not only:
                 continue
-            flow = data.flows.get(row[1])
+            flow = flows[fc]
             if flow is None:
-                log.error("invalid flow %s", row[1])
+                log.error("invalid flow %s", keys[fc])
                 continue
-            prop = data.flow_properties.get(row[2])
+            prop = props[pc]
             if prop is None:
-                log.error("invalid flow property %s", row[2])
+                log.error("invalid flow property %s", keys[pc])
                 continue
-            unit = data.units.get(row[3])
+            unit = units[uc]
             if unit is None:
-                log.error("invalid unit %s", row[3])
+                log.error("invalid unit %s", keys[uc])
                 continue
 
-            loc_id = _opt(row[4])
-            location = data.locations.get(loc_id) if loc_id else None
             factor = lca.ImpactFactor(
-                flow=_ref_of(flow),
-                flow_property=_ref_of(prop),
-                unit=lca.Ref(id=unit.id, name=unit.name, model_type="Unit"),
-                location=_ref_of(location) if location else None,
+                flow=flow,
+                flow_property=prop,
+                unit=unit,
+                location=locations[lc],
             )
-            try:
-                factor.value = float(row[5])
-            except:
-                factor.formula = row[5]
+            formula = shard.formulas.get(i) if shard.formulas else None
+            if formula is None:
+                factor.value = shard.values[i]
+            else:
+                factor.formula = formula
 
             if impact.impact_factors is None:
                 impact.impact_factors = [factor]
             else:
                 impact.impact_factors.append(factor)
+    finally:
+        if gc_enabled:
+            gc.enable()
 
 
 def _impact_methods_into(data: RefData):
 
-    for row in _csv("lcia_methods.csv"):
+    for row in _csv("lcia_methods.csv", data._cache):
         method = lca.ImpactMethod()
         ids = _fill_head(method, row)
         for method_id in ids:
             data.impact_methods[method_id] = method
 
-    for row in _csv("lcia_method_categories.csv"):
+    for row in _csv("lcia_method_categories.csv", data._cache):
         method = data.impact_methods.get(row[0])
         if method is None:
             log.error("invalid LCIA method %s", row[0])
             continue
-        impact = data.impact_categories.get(row[1])
+        impact = _impact_heads(data).get(row[1])
         if impact is None:
             log.error("incalid LCIA category %s", row[1])
             continue
         if method.impact_categories is None:
-            method.impact_categories = [_ref_of(impact)]
+            method.impact_categories = [data.ref_of(impact)]
         else:
-            method.impact_categories.append(_ref_of(impact))
+            method.impact_categories.append(data.ref_of(impact))
 
-    for row in _csv("lcia_method_nw_sets.csv"):
+    # the NW sets by method object and NW set ID
+    nw_sets: dict[tuple[int, str], lca.NwSet] = {}
+    for row in _csv("lcia_method_nw_sets.csv", data._cache):
         method = data.impact_methods.get(row[0])
         if method is None:
             log.error("invalid LCIA method %s", row[0])
             continue
 
-        nw_set: lca.NwSet | None = None
         if method.nw_sets is None:
             method.nw_sets = []
-        for nws in method.nw_sets:
-            if nws.id == row[1]:
-                nw_set = nws
-                break
+        nw_set = nw_sets.get((id(method), row[1]))
         if nw_set is None:
             nw_set = lca.NwSet(
                 id=row[1],
@@ -282,14 +775,15 @@ def _impact_methods_into(data: RefData):
                 weighted_score_unit=_opt(row[6]),
             )
             method.nw_sets.append(nw_set)
+            nw_sets[(id(method), row[1])] = nw_set
 
-        impact = data.impact_categories.get(row[3])
+        impact = _impact_heads(data).get(row[3])
         if impact is None:
             log.error("incalid LCIA category %s", row[3])
             continue
 
         factor = lca.NwFactor(
-            impact_category=_ref_of(impact),
+            impact_category=data.ref_of(impact),
             normalisation_factor=_opt_num(row[4]),
             weighting_factor=_opt_num(row[5]),
         )
@@ -312,17 +806,30 @@ def _flow_type_of(s: str) -> lca.FlowType | None:
 
 
 def _fill_head(e: lca.RootEntity, row: list[str]) -> tuple[str, str]:
-    e.id = row[0]
-    e.name = row[1]
+    e.id = sys.intern(row[0])
+    e.name = sys.intern(row[1])
     e.description = row[2]
     e.category = _opt(row[3])
     return (e.id, e.name)
 
 
-def _csv(file: str | Path) -> Iterable[list[str]]:
+def _csv(
+    file: str | Path, cache: "_Cache | None" = None
+) -> Iterable[list[str]]:
     path = _ref_dir / file if isinstance(file, str) else file
     if not path.exists():
-        return
+        return []
+    if cache is not None:
+        return stages.counted(cache.rows(path))
+    return stages.counted(_read_csv(path))
+
+
+def _run(stage: str, fn: Callable[..., None], *args: Any):
+    with stages.stage(stage):
+        fn(*args)
+
+
+def _read_csv(path: Path) -> Iterable[list[str]]:
     with open(path, "r", encoding="utf-8") as inp:
         reader = csv.reader(inp)
         next(reader)  # skip header
@@ -330,6 +837,56 @@ def _csv(file: str | Path) -> Iterable[list[str]]:
             yield row
 
 
+class _Cache:
+    """Stores parsed CSV files in a folder. The entries are marshalled
+    Python values and are keyed by the SHA-1 hash of the file content, so a
+    changed file is parsed again while unchanged files are loaded from the
+    cache."""
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+
+    def rows(self, path: Path) -> list[list[str]]:
+        return self._get(
+            path, "rows", lambda: list(_read_csv(path)), list, list
+        )
+
+    def shard(self, path: Path) -> "_FactorShard":
+        return self._get(
+            path,
+            "shard",
+            lambda: _read_factor_shard(path),
+            _FactorShard.encode,
+            _FactorShard.decode,
+        )
+
+    def _get(
+        self,
+        path: Path,
+        kind: str,
+        parse: Callable[[], T],
+        encode: Callable[[T], Any],
+        decode: Callable[[Any], T],
+    ) -> T:
+        with open(path, "rb") as inp:
+            digest = hashlib.sha1(inp.read()).hexdigest()
+        entry = self.folder / f"{digest}.{kind}.v{_CACHE_VERSION}"
+        if entry.exists():
+            try:
+                return decode(marshal.loads(entry.read_bytes()))
+            except Exception as e:
+                log.warning("invalid cache entry %s: %s", entry, e)
+
+        value = parse()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, as other processes could read or
+        # write the same entry at the same time
+        tmp = self.folder / f"{entry.name}.{os.getpid()}.tmp"
+        tmp.write_bytes(marshal.dumps(encode(value)))
+        os.replace(tmp, entry)
+        return value
+
+
 def _opt(s: str) -> str | None:
     if s is None or s.strip() == "":
         return s
@@ -348,6 +905,14 @@ def _opt_num(s: str) -> float | None:
 def _ref_of(entity: lca.RootEntity) -> lca.Ref:
     return lca.Ref(
         model_type=entity.__class__.__name__,
-        id=entity.id,
-        name=entity.name,
+        id=_intern(entity.id),
+        name=_intern(entity.name),
     )
+
+
+def _ref_or_none(data: RefData, e: lca.RootEntity | None) -> lca.Ref | None:
+    return data.ref_of(e) if e is not None else None
+
+
+def _intern(s: str | None) -> str | None:
+    return sys.intern(s) if s is not None else None
@@ -1,10 +1,38 @@
+import argparse
 import csv
+import hashlib
+import heapq
+import io
+import json
 import operator
+import os
+import sys
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
+from typing import Iterable, Iterator
 
 Row = list[str]
 
+# the files are sorted with an external merge sort when their rows would
+# take more than this number of bytes in memory
+_MEMORY_BUDGET = 256 * 1024 * 1024
+
+# the rows of a file take about this many times the file size in memory, as
+# each row is a list of string objects
+_MEMORY_PER_FILE_BYTE = 6
+
+# the minimum number of rows of a sorted run, so that a small budget cannot
+# create a temporary file per row, and the maximum number of runs that are
+# merged at once, so that the merge does not run out of file handles
+_MIN_RUN_ROWS = 10_000
+_MAX_FAN_IN = 64
+
+# the SHA-1 hashes of files that are known to be in canonical order
+_STAMPS = Path(__file__).parent.parent / "build" / "cache" / "order.json"
+
 
 @dataclass
 class CsvFile:
@@ -33,7 +61,11 @@ class CsvFile:
         self.rows.sort(key=operator.itemgetter(*col_order))
 
 
-def apply():
+def apply(
+    workers: int | None = None,
+    budget: int = _MEMORY_BUDGET,
+    folder: Path = Path(__file__).parent.parent / "refdata",
+):
     csv_files = [
         ("currencies.csv", [1, 0]),
         ("flow_properties.csv", [1, 0]),
@@ -46,19 +78,266 @@ def apply():
         ("unit_groups.csv", [1, 0]),
         ("units.csv", [1, 0]),
     ]
-    folder = Path(__file__).parent.parent / "refdata"
-    for (file, order) in csv_files:
-        path = folder / file
-        csv_file = CsvFile.read(path)
-        csv_file.sort(order)
-        csv_file.write()
+    tasks = [
+        (folder / file, order)
+        for (file, order) in csv_files
+        if (folder / file).exists()
+    ]
 
     # LCIA factors
-    for path in (folder / 'lcia_factors').iterdir():
-        csv_file = CsvFile.read(path)
-        csv_file.sort([0, 1])
-        csv_file.write()
+    for path in sorted((folder / "lcia_factors").iterdir()):
+        tasks.append((path, [0, 1]))
+
+    # files that were not changed since they were sorted the last time are
+    # skipped by their hash
+    stamps = _read_stamps()
+    todo = []
+    for (path, order) in tasks:
+        stamp = stamps.get(_stamp_key(path, order))
+        if stamp is None or stamp != _sha1_of(path):
+            todo.append((path, order, budget))
+
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_canonicalize, todo, chunksize=8))
+    else:
+        results = [_canonicalize(task) for task in todo]
+
+    changed = 0
+    for ((path, order, _), (was_changed, digest)) in zip(todo, results):
+        stamps[_stamp_key(path, order)] = digest
+        if was_changed:
+            changed += 1
+    _write_stamps(stamps)
+    print(f"sorted {changed} of {len(tasks)} files; {len(todo)} checked")
+
+
+def canonicalize(
+    path: Path, order: list[int], budget: int = _MEMORY_BUDGET
+) -> tuple[bool, str]:
+    """Sorts the rows of the given file by the given columns, if they are
+    not in canonical order yet. Returns whether the file was rewritten and
+    the SHA-1 hash of the canonical file."""
+    if path.stat().st_size * _MEMORY_PER_FILE_BYTE > budget:
+        return _canonicalize_large(path, order, budget)
+
+    content = path.read_bytes()
+    newline = _newline_of(content[:64 * 1024])
+    reader = csv.reader(io.StringIO(content.decode("utf-8"), newline=""))
+    header = next(reader, None)
+    if header is None:
+        return (False, hashlib.sha1(content).hexdigest())
+    rows = list(reader)
+    rows.sort(key=operator.itemgetter(*order))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator=newline)
+    writer.writerow(header)
+    writer.writerows(rows)
+    canonical = buffer.getvalue().encode("utf-8")
+    if canonical == content:
+        return (False, hashlib.sha1(content).hexdigest())
+    _replace(path, canonical)
+    return (True, hashlib.sha1(canonical).hexdigest())
+
+
+def _canonicalize(task: tuple[Path, list[int], int]) -> tuple[bool, str]:
+    return canonicalize(*task)
+
+
+def _canonicalize_large(
+    path: Path, order: list[int], budget: int
+) -> tuple[bool, str]:
+    """Sorts a large file with an external merge sort: sorted runs that fit
+    into the memory budget are written to temporary files, which are then
+    merged into the canonical file; in several passes when there are more
+    than `_MAX_FAN_IN` runs."""
+    with open(path, "rb") as inp:
+        newline = _newline_of(inp.read(64 * 1024))
+    key = operator.itemgetter(*order)
+
+    # check first if the file is already canonical
+    digest = _sha1_of(path)
+    with open(path, "r", encoding="utf-8", newline="") as inp:
+        reader = csv.reader(inp)
+        header = next(reader, None)
+        if header is None:
+            return (False, digest)
+        if _sha1_of_rows(header, _checked_sorted(reader, key), newline) == (
+            digest
+        ):
+            return (False, digest)
+
+    with tempfile.TemporaryDirectory(dir=path.parent) as tmp:
+        runs: list[Path] = []
+        with open(path, "r", encoding="utf-8", newline="") as inp:
+            reader = csv.reader(inp)
+            next(reader)
+            for run in _runs_of(reader, budget):
+                run.sort(key=key)
+                run_path = Path(tmp) / f"{len(runs)}.csv"
+                with open(run_path, "w", encoding="utf-8", newline="") as out:
+                    csv.writer(out).writerows(run)
+                runs.append(run_path)
+
+        # merge groups of runs into longer runs until they can be merged
+        # into the target file at once
+        while len(runs) > _MAX_FAN_IN:
+            merged_runs: list[Path] = []
+            for i in range(0, len(runs), _MAX_FAN_IN):
+                group = runs[i : i + _MAX_FAN_IN]
+                run_path = Path(tmp) / f"m{len(merged_runs)}-{len(runs)}.csv"
+                with open(run_path, "w", encoding="utf-8", newline="") as out:
+                    _merge_into(csv.writer(out), group, key)
+                for r in group:
+                    r.unlink()
+                merged_runs.append(run_path)
+            runs = merged_runs
+
+        target = Path(tmp) / "sorted.csv"
+        hasher = hashlib.sha1()
+        with open(target, "w", encoding="utf-8", newline="") as out:
+            writer = csv.writer(
+                _HashingWriter(out, hasher), lineterminator=newline
+            )
+            writer.writerow(header)
+            _merge_into(writer, runs, key)
+        os.replace(target, path)
+    return (True, hasher.hexdigest())
+
+
+def _merge_into(writer, runs: list[Path], key):
+    files = [open(r, "r", encoding="utf-8", newline="") for r in runs]
+    try:
+        writer.writerows(
+            heapq.merge(*[csv.reader(f) for f in files], key=key)
+        )
+    finally:
+        for f in files:
+            f.close()
+
+
+def _runs_of(rows: Iterable[Row], budget: int) -> Iterator[list[Row]]:
+    """Splits the rows into runs that take about `budget` bytes in memory
+    but have at least `_MIN_RUN_ROWS` rows."""
+    run: list[Row] = []
+    size = 0
+    for row in rows:
+        run.append(row)
+        size += _size_of(row)
+        if size >= budget and len(run) >= _MIN_RUN_ROWS:
+            yield run
+            run = []
+            size = 0
+    if run:
+        yield run
+
+
+def _size_of(row: Row) -> int:
+    """The memory size of a row with its strings and its pointer in the run
+    list."""
+    return sys.getsizeof(row) + sum(sys.getsizeof(s) for s in row) + 8
+
+
+class _NotSorted(Exception):
+    pass
+
+
+def _checked_sorted(rows: Iterable[Row], key) -> Iterator[Row]:
+    prev = None
+    for row in rows:
+        k = key(row)
+        if prev is not None and k < prev:
+            raise _NotSorted()
+        prev = k
+        yield row
+
+
+def _sha1_of_rows(header: Row, rows: Iterable[Row], newline: str) -> str:
+    hasher = hashlib.sha1()
+    writer = csv.writer(
+        _HashingWriter(None, hasher), lineterminator=newline
+    )
+    writer.writerow(header)
+    try:
+        writer.writerows(rows)
+    except _NotSorted:
+        return ""
+    return hasher.hexdigest()
+
+
+class _HashingWriter:
+    """A text sink that updates a hash with the UTF-8 bytes of the written
+    text and optionally passes the text to another sink."""
+
+    def __init__(self, out, hasher):
+        self.out = out
+        self.hasher = hasher
+
+    def write(self, s: str):
+        self.hasher.update(s.encode("utf-8"))
+        if self.out is not None:
+            self.out.write(s)
+
+
+def _newline_of(head: bytes) -> str:
+    """Returns the line terminator of a file, so that files keep their line
+    endings when they are rewritten."""
+    i = head.find(b"\n")
+    if i > 0 and head[i - 1 : i] == b"\r":
+        return "\r\n"
+    if i >= 0:
+        return "\n"
+    return "\r\n"
+
+
+def _replace(path: Path, content: bytes):
+    tmp = path.parent / f".{path.name}.{os.getpid()}.tmp"
+    tmp.write_bytes(content)
+    os.replace(tmp, path)
+
+
+def _sha1_of(path: Path) -> str:
+    hasher = hashlib.sha1()
+    with open(path, "rb") as inp:
+        for chunk in iter(lambda: inp.read(1 << 20), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _stamp_key(path: Path, order: list[int]) -> str:
+    return f"{path.resolve()}:{','.join(str(i) for i in order)}"
+
+
+def _read_stamps() -> dict[str, str]:
+    if not _STAMPS.exists():
+        return {}
+    try:
+        with open(_STAMPS, "r", encoding="utf-8") as inp:
+            return json.load(inp)
+    except ValueError:
+        return {}
+
+
+def _write_stamps(stamps: dict[str, str]):
+    _STAMPS.parent.mkdir(parents=True, exist_ok=True)
+    _replace(_STAMPS, json.dumps(stamps, indent=2).encode("utf-8"))
 
 
 if __name__ == "__main__":
-    apply()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="the number of files sorted in parallel; default: CPU count",
+    )
+    parser.add_argument(
+        "--budget",
+        type=int,
+        default=_MEMORY_BUDGET // (1024 * 1024),
+        help="the memory budget (in MB) for sorting a file; files whose rows"
+        " would need more memory are sorted externally",
+    )
+    args = parser.parse_args()
+    apply(workers=args.workers, budget=args.budget * 1024 * 1024)
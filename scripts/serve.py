@@ -0,0 +1,555 @@
+# This script runs a local service that calculates LCIA results with the
+# matrix C of an LCIA library that is created by build_libs.py. The library
+# is loaded once; concurrent requests are collected into micro-batches that
+# are calculated with a single sparse matrix product. When the library is
+# rebuilt, or a library with a new version appears in build/libraries, it is
+# loaded again without restarting the service.
+#
+# python serve.py --port 8080
+# python serve.py --socket /tmp/olca-lcia.sock
+#
+# The service speaks HTTP with JSON bodies:
+#
+# POST /results  {"inventory": {"<flow ID>": 1.0, ...}, "method": "<ID>"}
+#                {"inventories": [[{"flow": "<ID>", "location": "<ID>",
+#                                   "amount": 1.0}, ...], ...]}
+# GET  /status
+
+import argparse
+import asyncio
+import json
+import logging as log
+import math
+import time
+
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+from scipy import sparse
+
+import build_libs
+import calculate
+import library
+
+_MAX_BODY = 64 * 1024**2
+# many clients may connect at the same time when they send single inventories
+_BACKLOG = 1024
+
+
+@dataclass
+class _Loaded:
+    """A loaded library with the fingerprint of its files."""
+
+    lib: library.Library
+    calc: calculate.Calculator
+    fingerprint: tuple
+
+
+@dataclass
+class _Request:
+    loaded: _Loaded
+    keys: list[calculate.FlowKey]
+    amounts: list[float]
+    future: asyncio.Future
+
+
+@dataclass
+class _Stats:
+    requests: int = 0
+    inventories: int = 0
+    batches: int = 0
+    reloads: int = 0
+    seconds: float = 0.0
+    started: float = field(default_factory=time.time)
+
+
+class Service:
+    """Calculates LCIA results of inventories in micro-batches: requests
+    that arrive within `max_delay` seconds after the first request of a
+    batch are calculated together, up to `max_batch` inventories."""
+
+    def __init__(
+        self,
+        lib: Path | None = None,
+        name: str = "openLCA-LCIA-pack",
+        max_batch: int = 256,
+        max_delay: float = 0.002,
+        reload_interval: float = 2.0,
+    ):
+        self.lib_path = lib
+        self.name = name
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max(0.0, max_delay)
+        self.reload_interval = reload_interval
+        self.stats = _Stats()
+        self._loaded: _Loaded | None = None
+        self._queue: asyncio.Queue[_Request] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def loaded(self) -> _Loaded:
+        if self._loaded is None:
+            raise RuntimeError("no LCIA library loaded")
+        return self._loaded
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        path = self._find_library()
+        if path is None:
+            raise FileNotFoundError(
+                f"no LCIA library found in {build_libs._LIB}"
+            )
+        self._loaded = await loop.run_in_executor(None, _load, path)
+        self._tasks.append(asyncio.create_task(self._batches()))
+        if self.reload_interval > 0:
+            self._tasks.append(asyncio.create_task(self._watch()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def results(
+        self, inventory: Any, loaded: _Loaded | None = None
+    ) -> np.ndarray:
+        """Calculates the results of an inventory with the given library,
+        or with the currently loaded library by default. The results are
+        aligned with the indicators of that library. The inventory is
+        validated before it is queued, so that an invalid inventory cannot
+        fail the batch of other requests."""
+        (keys, amounts) = _parse_inventory(inventory)
+        return await self._submit(
+            loaded if loaded is not None else self.loaded, keys, amounts
+        )
+
+    async def _submit(
+        self,
+        loaded: _Loaded,
+        keys: list[calculate.FlowKey],
+        amounts: list[float],
+    ) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(loaded, keys, amounts, future))
+        return await future
+
+    async def _batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(self._queue.get(), timeout)
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+            # each request is calculated with the library that was pinned
+            # when it was received; after a reload, a batch can contain
+            # requests for the old and the new library
+            start = time.perf_counter()
+            groups: dict[int, list[_Request]] = {}
+            for r in batch:
+                groups.setdefault(id(r.loaded), []).append(r)
+            for group in groups.values():
+                outcomes = await loop.run_in_executor(
+                    None, _calculate, group[0].loaded, group
+                )
+                for (r, outcome) in zip(group, outcomes):
+                    if r.future.done():
+                        continue
+                    if isinstance(outcome, Exception):
+                        r.future.set_exception(outcome)
+                    else:
+                        r.future.set_result(outcome)
+            self.stats.seconds += time.perf_counter() - start
+            self.stats.batches += 1
+            self.stats.inventories += len(batch)
+
+    async def _watch(self):
+        """Checks the library files periodically and loads the library again
+        when they changed and were not modified since the last check."""
+        loop = asyncio.get_running_loop()
+        candidate: tuple | None = None
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            path = self._find_library()
+            if path is None:
+                continue
+            fingerprint = _fingerprint(path)
+            if fingerprint == self.loaded.fingerprint:
+                candidate = None
+                continue
+            if fingerprint != candidate:
+                # wait until the files are stable, a build may be running
+                candidate = fingerprint
+                continue
+            try:
+                loaded = await loop.run_in_executor(None, _load, path)
+            except Exception:
+                log.exception("failed to load library %s", path)
+                continue
+            if loaded.fingerprint != fingerprint:
+                candidate = loaded.fingerprint
+                continue
+            self._loaded = loaded
+            self.stats.reloads += 1
+            log.info("loaded library %s", path)
+
+    def _find_library(self) -> Path | None:
+        """Returns the library folder: the given one or the most recently
+        built library with the configured name in build/libraries."""
+        if self.lib_path is not None:
+            if (self.lib_path / "C.npz").exists():
+                return self.lib_path
+            return None
+        candidates: list[tuple[int, Path]] = []
+        if build_libs._LIB.exists():
+            for path in build_libs._LIB.iterdir():
+                suffix = path.name.removeprefix(f"{self.name}-")
+                if suffix == path.name or not suffix[:1].isdigit():
+                    continue
+                matrix = path / "C.npz"
+                if matrix.exists():
+                    candidates.append((matrix.stat().st_mtime_ns, path))
+        if not candidates:
+            return None
+        return max(candidates)[1]
+
+    def status(self) -> dict[str, Any]:
+        loaded = self._loaded
+        s = self.stats
+        info: dict[str, Any] = {
+            "uptime": round(time.time() - s.started, 1),
+            "requests": s.requests,
+            "inventories": s.inventories,
+            "batches": s.batches,
+            "meanBatchSize": (
+                round(s.inventories / s.batches, 2) if s.batches else None
+            ),
+            "calculationSeconds": round(s.seconds, 3),
+            "reloads": s.reloads,
+            "queued": self._queue.qsize(),
+        }
+        if loaded is not None:
+            info["library"] = loaded.lib.folder.name
+            info["path"] = str(loaded.lib.folder)
+            info["shape"] = list(loaded.calc.C.shape)
+        return info
+
+    async def handle(
+        self, method: str, path: str, body: bytes
+    ) -> tuple[HTTPStatus, Any]:
+        """Handles a request and returns the status and JSON response."""
+        if method == "GET" and path == "/status":
+            return (HTTPStatus.OK, self.status())
+        if path != "/results":
+            return (HTTPStatus.NOT_FOUND, {"error": f"unknown path {path}"})
+        self.stats.requests += 1
+        if method != "POST":
+            return (HTTPStatus.METHOD_NOT_ALLOWED, {"error": "use POST"})
+
+        # all inventories of a request are calculated with the same library,
+        # also when the library is reloaded in between
+        loaded = self.loaded
+        lib = loaded.lib
+        try:
+            req = json.loads(body)
+            if not isinstance(req, dict):
+                raise ValueError("the request must be a JSON object")
+            single = "inventories" not in req
+            inventories = (
+                [req.get("inventory")] if single else req["inventories"]
+            )
+            if not isinstance(inventories, list):
+                raise ValueError("inventories must be a list")
+            rows = list(range(len(lib.impact_ids)))
+            if (key := req.get("method")) is not None:
+                m = lib.methods.get(key) if isinstance(key, str) else None
+                if m is None:
+                    error = {"error": f"unknown method {key}"}
+                    return (HTTPStatus.NOT_FOUND, error)
+                rows = m.rows
+            parsed = [_parse_inventory(inv) for inv in inventories]
+            results = await asyncio.gather(
+                *(self._submit(loaded, *inv) for inv in parsed)
+            )
+        except (ValueError, TypeError, KeyError) as e:
+            return (HTTPStatus.BAD_REQUEST, {"error": str(e)})
+        except Exception as e:
+            log.exception("failed to calculate results")
+            return (HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)})
+
+        values = [_results_of(lib, h, rows) for h in results]
+        response = {
+            "library": lib.folder.name,
+            "results": values[0] if single else values,
+        }
+        return (HTTPStatus.OK, response)
+
+
+def _results_of(
+    lib: library.Library, h: np.ndarray, rows: list[int]
+) -> list[dict[str, Any]]:
+    return [
+        {
+            "@id": lib.impact_ids[i],
+            "name": lib.impact_names[i],
+            "unit": lib.impact_units[i],
+            "value": float(h[i]),
+        }
+        for i in rows
+    ]
+
+
+def _parse_inventory(
+    inventory: Any,
+) -> tuple[list[calculate.FlowKey], list[float]]:
+    """An inventory is a JSON object that maps flow IDs to amounts, or a
+    list of objects with a `flow`, an optional `location`, and an `amount`
+    field."""
+    keys: list[calculate.FlowKey] = []
+    amounts: list[float] = []
+    if isinstance(inventory, dict):
+        for (flow_id, amount) in inventory.items():
+            keys.append(flow_id)
+            amounts.append(_amount_of(amount))
+    elif isinstance(inventory, list):
+        for item in inventory:
+            if not isinstance(item, dict) or "flow" not in item:
+                raise ValueError("an inventory item needs a flow")
+            (flow, loc) = (item["flow"], item.get("location"))
+            if not isinstance(flow, str):
+                raise ValueError("the flow of an item must be a string")
+            if loc is not None and not isinstance(loc, str):
+                raise ValueError("the location of an item must be a string")
+            keys.append((flow, loc) if loc else flow)
+            amounts.append(_amount_of(item.get("amount", 0)))
+    else:
+        raise ValueError("an inventory must be an object or a list")
+    return (keys, amounts)
+
+
+def _amount_of(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f"invalid amount: {value!r}")
+    amount = float(value)
+    if not math.isfinite(amount):
+        raise ValueError(f"invalid amount: {value!r}")
+    return amount
+
+
+def _calculate(
+    loaded: _Loaded, batch: list[_Request]
+) -> list[np.ndarray | Exception]:
+    """Calculates the results of a batch with one matrix product. Returns the
+    results or the error of each request; a request that fails does not
+    fail the other requests of the batch."""
+    errors: dict[int, Exception] = {}
+    (valid, rows, cols, vals) = ([], [], [], [])
+    for (i, r) in enumerate(batch):
+        try:
+            c = loaded.calc.columns_of(r.keys)
+            amounts = np.asarray(r.amounts, dtype=np.float64)
+            if len(amounts) != len(c):
+                raise ValueError("the flows and amounts do not match")
+        except Exception as e:
+            errors[i] = e
+            continue
+        valid.append(i)
+        rows.append(np.full(int(np.count_nonzero(c >= 0)), len(rows)))
+        cols.append(c[c >= 0])
+        vals.append(amounts[c >= 0])
+
+    results: dict[int, np.ndarray] = {}
+    if valid:
+        G = sparse.csr_array(
+            (
+                np.concatenate(vals),
+                (np.concatenate(rows), np.concatenate(cols)),
+            ),
+            shape=(len(valid), loaded.calc.C.shape[1]),
+        )
+        try:
+            H = loaded.calc.calculate(G)
+            results = {i: H[row] for (row, i) in enumerate(valid)}
+        except Exception as e:
+            log.exception("failed to calculate a batch")
+            errors.update((i, e) for i in valid)
+    return [
+        errors[i] if i in errors else results[i] for i in range(len(batch))
+    ]
+
+
+def _fingerprint(path: Path) -> tuple:
+    parts: list[Any] = [str(path)]
+    for name in (
+        "C.npz",
+        "C.bin",
+        "index_B.csv",
+        "index_C.csv",
+        "index_methods.csv",
+    ):
+        f = path / name
+        if f.exists():
+            stat = f.stat()
+            parts.append((name, stat.st_mtime_ns, stat.st_size))
+    return tuple(parts)
+
+
+def _load(path: Path) -> _Loaded:
+    fingerprint = _fingerprint(path)
+    lib = library.Library(path)
+    calc = calculate.Calculator(lib)
+    # read the indices now, and not with the first request
+    _ = (lib.columns, lib.impact_names, lib.impact_units, lib.methods)
+    log.info("loaded %s with a %ix%i matrix C", path, *calc.C.shape)
+    return _Loaded(lib, calc, fingerprint)
+
+
+async def _serve_http(
+    service: Service,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            parts = line.decode("latin-1").split()
+            if len(parts) < 2:
+                break
+            (method, path) = (parts[0].upper(), parts[1].split("?")[0])
+            headers: dict[str, str] = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                (key, _, value) = line.decode("latin-1").partition(":")
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", "0") or 0)
+            if length > _MAX_BODY:
+                status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+                payload: Any = {"error": "request too large"}
+                close = True
+            else:
+                body = await reader.readexactly(length) if length else b""
+                (status, payload) = await service.handle(method, path, body)
+                close = headers.get("connection", "").lower() == "close"
+            data = json.dumps(payload).encode("utf-8")
+            writer.write(
+                (
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'close' if close else 'keep-alive'}\r\n"
+                    "\r\n"
+                ).encode("latin-1")
+                + data
+            )
+            await writer.drain()
+            if close:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(
+    service: Service,
+    host: str = "127.0.0.1",
+    port: int = 8080,
+    socket: Path | None = None,
+):
+    await service.start()
+
+    async def handler(reader, writer):
+        await _serve_http(service, reader, writer)
+
+    if socket is not None:
+        socket.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(
+            handler, path=str(socket), backlog=_BACKLOG
+        )
+        print(f"serving {service.status()['library']} on {socket}")
+    else:
+        server = await asyncio.start_server(
+            handler, host, port, backlog=_BACKLOG
+        )
+        print(f"serving {service.status()['library']} on {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="runs a local service for LCIA results"
+    )
+    parser.add_argument(
+        "--lib",
+        type=Path,
+        help="the folder of the LCIA library; default: the newest LCIA"
+        " library in build/libraries",
+    )
+    parser.add_argument(
+        "--name",
+        default="openLCA-LCIA-pack",
+        help="the name of the library in build/libraries without version",
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--socket", type=Path, help="listen on this unix socket instead"
+    )
+    parser.add_argument(
+        "--max-batch",
+        type=int,
+        default=256,
+        help="the maximum number of inventories in a batch",
+    )
+    parser.add_argument(
+        "--max-delay-ms",
+        type=float,
+        default=2.0,
+        help="how long a batch waits for more requests",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=2.0,
+        help="how often the library files are checked for changes, in"
+        " seconds; 0 disables the reloading",
+    )
+    args = parser.parse_args()
+    service = Service(
+        lib=args.lib,
+        name=args.name,
+        max_batch=args.max_batch,
+        max_delay=args.max_delay_ms / 1000,
+        reload_interval=args.reload_interval,
+    )
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO)
+    main()
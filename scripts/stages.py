@@ -0,0 +1,274 @@
+import argparse
+import cProfile
+import io
+import json
+import logging as log
+import os
+import pstats
+import re
+import sys
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None  # type: ignore
+
+_BUILD = Path(__file__).parent.parent / "build"
+
+
+@dataclass
+class Stage:
+    """The statistics of a stage of the data loading or build process. The
+    name of a nested stage is prefixed with the name of its parent stage,
+    e.g. `read/units`."""
+
+    name: str
+    seconds: float = 0.0
+    rows: int = 0
+    errors: int = 0
+    rss_mb: float | None = None
+    peak_rss_mb: float | None = None
+    details: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def rows_per_second(self) -> float | None:
+        if self.rows == 0 or self.seconds == 0:
+            return None
+        return self.rows / self.seconds
+
+    def summary(self) -> str:
+        s = f"{self.name}: {self.seconds:.2f} s"
+        if (rps := self.rows_per_second) is not None:
+            s += f", {self.rows} rows ({rps:,.0f} rows/s)"
+        if self.errors > 0:
+            s += f", {self.errors} errors"
+        if self.rss_mb is not None:
+            s += f", {self.rss_mb:.0f} MB"
+        return s
+
+
+# the finished stages in the order in which they ended
+_stages: list[Stage] = []
+
+# the currently running stages, the innermost last
+_active: list[Stage] = []
+
+# the names of the stages that are profiled or traced
+_profiled: set[str] = set()
+_traced: set[str] = set()
+
+
+class _ErrorCounter(log.Handler):
+    """Counts the logged errors of the running stages."""
+
+    def __init__(self):
+        super().__init__(level=log.ERROR)
+
+    def emit(self, record: log.LogRecord):
+        for s in _active:
+            s.errors += 1
+
+
+_counter: _ErrorCounter | None = None
+
+
+def configure(profile: Iterable[str] = (), trace: Iterable[str] = ()):
+    """Sets the stages that are profiled with cProfile or traced with
+    tracemalloc. A stage is selected by its full or its short name. The
+    profiles are written to `build/profiles`."""
+    _profiled.clear()
+    _profiled.update(profile)
+    _traced.clear()
+    _traced.update(trace)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print the statistics of the stages when finished",
+    )
+    parser.add_argument(
+        "--profile",
+        action="append",
+        default=[],
+        metavar="STAGE",
+        help="profile the given stage with cProfile",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="append",
+        default=[],
+        metavar="STAGE",
+        help="trace the memory allocations of the given stage",
+    )
+
+
+def setup(args: argparse.Namespace):
+    configure(args.profile, args.trace_memory)
+    if args.stats or args.profile or args.trace_memory:
+        log.basicConfig(level=log.INFO)
+
+
+def finish(args: argparse.Namespace, name: str):
+    if not args.stats:
+        return
+    print(report())
+    path = write(_BUILD / "stats" / f"{name}.json")
+    print(f"statistics written to {path}")
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Stage]:
+    """Measures the wrapped code as a stage."""
+    global _counter
+    if _counter is None:
+        _counter = _ErrorCounter()
+        log.getLogger().addHandler(_counter)
+
+    full_name = f"{_active[-1].name}/{name}" if _active else name
+    s = Stage(full_name)
+    selected = {name, full_name}
+    profile = cProfile.Profile() if selected & _profiled else None
+    trace = bool(selected & _traced) and not tracemalloc.is_tracing()
+
+    _active.append(s)
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    if profile is not None:
+        profile.enable()
+    try:
+        yield s
+    finally:
+        if profile is not None:
+            profile.disable()
+        s.seconds = time.perf_counter() - start
+        _active.pop()
+        (s.rss_mb, s.peak_rss_mb) = _memory()
+        if profile is not None:
+            _dump_profile(s, profile)
+        if trace:
+            _dump_trace(s)
+            tracemalloc.stop()
+        _stages.append(s)
+        log.info("stage %s", s.summary())
+
+
+def count(rows: int):
+    """Adds the given number of processed rows to the running stages."""
+    for s in _active:
+        s.rows += rows
+
+
+def counted(rows: Iterable[Any]) -> Iterable[Any]:
+    """Counts the rows of the given iterable when it is consumed."""
+    if isinstance(rows, list):
+        count(len(rows))
+        return rows
+    return _counting(rows)
+
+
+def _counting(rows: Iterable[Any]) -> Iterator[Any]:
+    n = 0
+    try:
+        for row in rows:
+            n += 1
+            yield row
+    finally:
+        count(n)
+
+
+def current() -> Stage | None:
+    """Returns the innermost running stage."""
+    return _active[-1] if _active else None
+
+
+def finished() -> list[Stage]:
+    return list(_stages)
+
+
+def reset():
+    _stages.clear()
+
+
+def report() -> str:
+    lines = [
+        f"{'stage':<36} {'time [s]':>9} {'rows':>10} {'rows/s':>10}"
+        f" {'errors':>7} {'RSS [MB]':>9}"
+    ]
+    for s in _stages:
+        rps = s.rows_per_second
+        lines.append(
+            f"{s.name:<36} {s.seconds:>9.2f} {s.rows:>10}"
+            f" {'' if rps is None else f'{rps:,.0f}':>10}"
+            f" {s.errors:>7}"
+            f" {'' if s.rss_mb is None else f'{s.rss_mb:.0f}':>9}"
+        )
+        for (key, value) in s.details.items():
+            lines.append(f"  {key}: {value}")
+    return "\n".join(lines)
+
+
+def write(path: Path) -> Path:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as out:
+        json.dump(
+            [
+                dict(asdict(s), rows_per_second=s.rows_per_second)
+                for s in _stages
+            ],
+            out,
+            indent=2,
+        )
+    return path
+
+
+def _memory() -> tuple[float | None, float | None]:
+    """Returns the current and the peak resident set size in MB."""
+    current = None
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        current = pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, AttributeError):
+        pass
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if sys.platform == "darwin":
+            peak /= 1024
+    return (current, peak)
+
+
+def _file_name(s: Stage) -> str:
+    return re.sub(r"[^\w.-]+", "_", s.name)
+
+
+def _dump_profile(s: Stage, profile: cProfile.Profile):
+    folder = _BUILD / "profiles"
+    folder.mkdir(parents=True, exist_ok=True)
+    path = folder / f"{_file_name(s)}.prof"
+    profile.dump_stats(str(path))
+    buffer = io.StringIO()
+    stats = pstats.Stats(profile, stream=buffer)
+    stats.sort_stats("cumulative").print_stats(20)
+    log.info("profile of stage %s -> %s\n%s", s.name, path, buffer.getvalue())
+
+
+def _dump_trace(s: Stage):
+    (_, peak) = tracemalloc.get_traced_memory()
+    s.details["traced peak MB"] = round(peak / 1024**2, 1)
+    top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+    log.info(
+        "largest allocations of stage %s:\n%s",
+        s.name,
+        "\n".join(str(stat) for stat in top),
+    )
@@ -0,0 +1,61 @@
+# tests of the compiled flow mappings; run with python -m pytest scripts
+
+import pytest
+
+import flowmap
+
+
+@pytest.fixture
+def fm(mapping) -> flowmap.FlowMap:
+    return mapping(
+        [
+            ("s1", "t1", 1.0),
+            ("S2", "t2", 2.0),
+            ("s2", "t3", 4.0),
+            ("a/B/c", "t4", 0.5),
+            ("s3", "t5", 1.0),
+            ("s2", "t2", 8.0),
+        ]
+    )
+
+
+def test_find(fm):
+    rows = fm.find(["s1", " S1 ", "s2", "A/b/C", "missing", "s3"])
+    assert rows.tolist() == [0, 0, 1, 3, -1, 4]
+    assert fm.find([]).tolist() == []
+    assert fm.cell(1, flowmap.Col.TARGET_FLOW_UUID) == "t2"
+    assert fm.factors[rows[2]] == 2.0
+
+
+def test_find_all(fm):
+    (positions, rows) = fm.find_all(["missing", "s2", "s1", "s2", "x"])
+    # all rows of a key in the order of the mapping file, for each position
+    assert positions.tolist() == [1, 1, 1, 2, 3, 3, 3]
+    assert rows.tolist() == [1, 2, 5, 0, 1, 2, 5]
+
+    (positions, rows) = fm.find_all(["missing"])
+    assert positions.tolist() == [] and rows.tolist() == []
+
+
+def test_lookup_of_single_keys(fm):
+    assert "S1" in fm and "missing" not in fm
+    assert fm.rows_of("s2") == [1, 2, 5]
+    assert fm.rows_of("missing") == []
+    assert fm.get("missing") is None
+    assert [e.target_flow for e in fm.entries_of("s2")] == ["t2", "t3", "t2"]
+    assert fm.get("a/b/c").factor == 0.5
+
+
+def test_convert(fm):
+    (targets, amounts) = fm.convert(["s2", "missing", "s1"], [1.0, 3.0, 5.0])
+    assert targets == ["t2", None, "t1"]
+    assert amounts.tolist() == [2.0, 3.0, 5.0]
+
+
+def test_find_with_hash_collisions(mapping, monkeypatch):
+    monkeypatch.setattr(flowmap, "_hash", lambda key: 42)
+    fm = mapping([("s1", "t1", 1.0), ("s2", "t2", 1.0), ("s1", "t3", 1.0)])
+    assert fm.find(["s2", "s1", "s3"]).tolist() == [1, 0, -1]
+    (positions, rows) = fm.find_all(["s1", "s3", "s2"])
+    assert positions.tolist() == [0, 0, 2]
+    assert rows.tolist() == [0, 2, 1]
@@ -0,0 +1,174 @@
+# tests of the formula engine of the LCIA factors; run with
+# python -m pytest scripts
+
+import ast
+
+import numpy as np
+import pytest
+
+import build_libs
+import formulas
+import library
+import model
+
+from formulas import FormulaFactors
+
+
+def _check(expression: str):
+    """Runs the whitelist check on a Python expression directly, for nodes
+    that the openLCA syntax cannot produce."""
+    tree = ast.parse(expression, mode="eval")
+    formulas._Checker(expression).visit(tree)
+
+
+def test_translate():
+    assert formulas._translate("2^3") == "2 ** 3"
+    assert formulas._translate("Pi * 2") == "v_pi * 2"
+    assert formulas._translate("IF(a > 1; b; c)") == (
+        "f_if ( v_a > 1 , v_b , v_c )"
+    )
+    assert formulas._translate("a <> b") == "v_a != v_b"
+    assert formulas._translate("A && !b").split() == [
+        "v_a", "and", "not", "v_b"
+    ]
+
+
+def test_evaluate():
+    def value(source: str, **params) -> float:
+        return float(formulas.compile_formula(source).evaluate(params)[0])
+
+    assert value("2^3") == 8
+    assert value("2 * 3 + 1") == 7
+    assert value("IF(a > 1; 10; 20)", a=2.0) == 10
+    assert value("IF(a > 1; 10; 20)", a=0.5) == 20
+    assert value("sqrt(a) + abs(-1)", a=4.0) == 3
+    assert value("a = 1 && b <> 1", a=1.0, b=2.0) == 1
+    assert value("max(a; 3; 2)", a=1.0) == 3
+    assert formulas.compile_formula("A * b").variables == {"a", "b"}
+    with pytest.raises(NameError):
+        formulas.compile_formula("a * 2").evaluate({})
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "a.real",
+        "a[0]",
+        "'os'",
+        "open(1)",
+        "__import__(1)",
+        "1 < a < 2",
+        "a +",
+    ],
+)
+def test_reject_formula(source: str):
+    with pytest.raises(ValueError):
+        formulas.compile_formula(source)
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "v_a.real",
+        "v_a[0]",
+        "f_open(1)",
+        "v_a(1)",
+        "f_abs.__class__",
+        "(lambda: 1)()",
+        "[x for x in v_a]",
+        "{x: 1 for x in v_a}",
+        "(x for x in v_a)",
+        "f_abs(*v_a)",
+        "f_abs(x=1)",
+        "v_a if v_b else 1",
+        "'text'",
+    ],
+)
+def test_reject_python(expression: str):
+    with pytest.raises(ValueError):
+        _check(expression)
+
+
+def test_batch_with_overrides():
+    factors = FormulaFactors(
+        rows=np.array([0, 0, 1]),
+        cols=np.array([0, 1, 0]),
+        formulas=["a * b", "b", "a"],
+        defaults=np.zeros(3),
+    )
+    params = {"c1": {"a": "2", "b": "a * 10"}, "c2": {"a": "5"}}
+    sets = [{}, {"A": 3}, {"b": 1}, {"a": 3, "b": 1}]
+    values = factors.evaluate(["c1", "c2"], params, sets)
+    assert values.shape == (3, 4)
+    # b is derived from a, unless it is overridden
+    assert values[0].tolist() == [40, 90, 2, 3]
+    assert values[1].tolist() == [20, 30, 1, 1]
+    # the overrides apply to the parameters of all categories
+    assert values[2].tolist() == [5, 3, 5, 3]
+    # without parameter sets, the defaults are evaluated
+    defaults = factors.evaluate(["c1", "c2"], params)
+    assert defaults[:, 0].tolist() == [40, 20, 5]
+
+
+def test_parameter_cycle(caplog):
+    factors = FormulaFactors(
+        rows=np.array([0, 0]),
+        cols=np.array([0, 1]),
+        formulas=["a + 1", "c"],
+        defaults=np.zeros(2),
+    )
+    params = {"c1": {"a": "b * 2", "b": "a / 2", "c": "3"}}
+    values = factors.evaluate(["c1"], params)[:, 0]
+    assert np.isnan(values[0])
+    assert values[1] == 3
+    assert "cyclic definition" in caplog.text
+
+    # an override of a parameter in the cycle breaks it
+    values = factors.evaluate(["c1"], params, [{"b": 1}])[:, 0]
+    assert values.tolist() == [3, 3]
+
+
+def test_scope_cycle():
+    scope = formulas._Scope({"a": "a + 1"}, {}, 1)
+    with pytest.raises(ValueError):
+        scope["a"]
+
+
+def test_formula_defaults_in_matrix(refdata, tmp_path):
+    refdata(
+        {
+            "lcia_categories.csv": (
+                "ID,Name,Description,Category,Reference unit\n"
+                "c1,Climate,,M,kg CO2 eq\n"
+            ),
+            "flows.csv": (
+                "ID,Name,Description,Category,Type,CAS,Formula,Property\n"
+                "f1,flow 1,,Elementary flows/air,elementary,,,Mass\n"
+                "f2,flow 2,,Elementary flows/air,elementary,,,Mass\n"
+                "f3,flow 3,,Elementary flows/air,elementary,,,Mass\n"
+            ),
+            "lcia_factors/c1.csv": (
+                "LCIA category,Flow,Flow property,Flow unit,Location,Factor\n"
+                "c1,f1,Mass,kg,,2*3\n"
+                "c1,f2,Mass,kg,,a * 2\n"
+                "c1,f3,Mass,kg,,1.5\n"
+            ),
+            "lcia_parameters.csv": (
+                "LCIA category,Parameter,Value\nc1,a,4\n"
+            ),
+        }
+    )
+    data = model.RefData.read(model.RefDataSet.METHODS)
+    lib_dir = tmp_path / "lib"
+    lib_dir.mkdir()
+    build_libs._build_impact_matrix(lib_dir, data)
+
+    lib = library.Library(lib_dir)
+    cols = {flow: i for (i, flow) in enumerate(lib.flow_ids)}
+    C = lib.matrix().toarray()
+    assert C[0, cols["f1"]] == 6
+    assert C[0, cols["f2"]] == 8
+    assert C[0, cols["f3"]] == 1.5
+    C = lib.matrix({"a": 10}).toarray()
+    assert C[0, cols["f1"]] == 6
+    assert C[0, cols["f2"]] == 20
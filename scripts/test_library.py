@@ -0,0 +1,48 @@
+# tests of the raw matrix format of the LCIA library; run with
+# python -m pytest scripts
+
+import numpy as np
+
+from scipy import sparse
+
+import library
+
+
+def _matrix(values: list[float]) -> sparse.csc_array:
+    n = len(values)
+    return sparse.csc_array(
+        (np.asarray(values), (np.arange(n) % 2, np.arange(n))), shape=(2, n)
+    )
+
+
+def test_full_round_trip(tmp_path):
+    C = _matrix([1.5, -2e-300, 3e300, 9.39e-13])
+    R = library.read_raw(library.write_raw(tmp_path, C))
+    assert R.data.dtype == np.float64
+    assert R.indices.dtype == np.int64
+    assert (R != C).nnz == 0
+
+
+def test_compact_round_trip(tmp_path):
+    C = _matrix([1.5, -0.25, 42.0, 9.39e-13])
+    R = library.read_raw(library.write_raw(tmp_path, C, compact=True))
+    assert R.data.dtype == np.float32
+    assert R.indices.dtype == np.int32
+    assert np.allclose(R.toarray(), C.toarray(), rtol=1e-6, atol=0)
+
+
+def test_compact_keeps_values_below_float32_range(tmp_path, caplog):
+    C = _matrix([1.5, 1e-46, 42.0])
+    R = library.read_raw(library.write_raw(tmp_path, C, compact=True))
+    assert "cannot be stored as float32" in caplog.text
+    assert R.data.dtype == np.float64
+    assert R.indices.dtype == np.int32
+    assert R[1, 1] == 1e-46
+    assert (R != C).nnz == 0
+
+
+def test_compact_keeps_values_above_float32_range(tmp_path):
+    C = _matrix([1.5, 1e39])
+    R = library.read_raw(library.write_raw(tmp_path, C, compact=True))
+    assert R.data.dtype == np.float64
+    assert (R != C).nnz == 0
@@ -0,0 +1,66 @@
+# tests of mapping the factors of the LCIA library; run with
+# python -m pytest scripts
+
+import numpy as np
+import pytest
+
+from scipy import sparse
+
+import map_factors
+
+from map_factors import Aggregation
+
+
+@pytest.fixture
+def fm(mapping):
+    return mapping(
+        [
+            ("f1", "t1", 1.0),
+            ("f2", "t1", 2.0),
+            ("f3", "t2", 0.0),
+            ("f4", "t3", 1.0),
+            ("f4", "t3", 1.0),
+        ]
+    )
+
+
+def _C() -> sparse.csr_array:
+    # the columns are the flows f1 to f5; f5 is not mapped
+    return sparse.csr_array(
+        np.array([[2.0, 4.0, 5.0, 3.0, 7.0], [0.0, 6.0, 0.0, 0.0, 1.0]])
+    )
+
+
+_FLOWS = ["f1", "f2", "f3", "f4", "f5"]
+
+
+def test_sum(fm, caplog):
+    (C, targets, sources) = map_factors.map_matrix(
+        _C(), _FLOWS, fm, Aggregation.SUM
+    )
+    # c_t = c_s / x; f3 has a factor of 0 and its target is dropped, and
+    # the duplicate mapping of f4 is only applied once
+    assert C.toarray().tolist() == [[4.0, 3.0], [3.0, 0.0]]
+    assert targets == [0, 3]
+    assert sources == [0, 3]
+    assert "conversion factor of 0" in caplog.text
+    assert "1 flows with factors are not mapped" in caplog.text
+
+
+def test_mean(fm):
+    (C, _, _) = map_factors.map_matrix(_C(), _FLOWS, fm, Aggregation.MEAN)
+    # the mean is taken over the source flows that have a factor
+    assert C.toarray().tolist() == [[2.0, 3.0], [3.0, 0.0]]
+    assert C.nnz == 3
+
+
+def test_locations(mapping):
+    fm = mapping([("f1", "t1", 1.0), ("f2", "t1", 2.0)])
+    C = sparse.csr_array(np.array([[1.0, 2.0, 4.0]]))
+    (C_t, targets, sources) = map_factors.map_matrix(
+        C, ["f1", "f1", "f2"], fm, locations=[None, "DE", "DE"]
+    )
+    # the factors of the same location are combined
+    assert C_t.toarray().tolist() == [[1.0, 2.0]]
+    assert targets == [0, 0]
+    assert sources == [0, 1]
@@ -0,0 +1,63 @@
+# tests of reading the reference data; run with python -m pytest scripts
+
+import model
+
+
+def _refdata(refdata):
+    flows = "".join(
+        f"f{i},flow {i},,Elementary flows/air,elementary,,,Mass\n"
+        for i in range(1, 3)
+    )
+    files = {
+        "lcia_categories.csv": (
+            "ID,Name,Description,Category,Reference unit\n"
+            + "".join(f"c{i},Category {i},,M,kg\n" for i in range(1, 4))
+        ),
+        "flows.csv": (
+            "ID,Name,Description,Category,Type,CAS,Formula,Property\n"
+            + flows
+        ),
+    }
+    for i in range(1, 4):
+        files[f"lcia_factors/c{i}.csv"] = (
+            "LCIA category,Flow,Flow property,Flow unit,Location,Factor\n"
+            f"c{i},f1,Mass,kg,,{i}\n"
+            f"c{i},f2,Mass,kg,,{i * 10}\n"
+        )
+    refdata(files)
+
+
+def _values(impact) -> list[float]:
+    return sorted(f.value for f in impact.impact_factors)
+
+
+def test_lazy_factors_are_evicted_and_loaded_again(refdata):
+    _refdata(refdata)
+    data = model.RefData.read(lazy=True, max_factor_lists=2)
+    impacts = data.impact_categories
+    heads = model._impact_heads(data)
+    assert len(impacts) == 3
+    assert all(h.impact_factors is None for h in heads.values())
+
+    assert _values(impacts["c1"]) == [1, 10]
+    assert _values(impacts["c2"]) == [2, 20]
+    # c1 is used again, so that c2 is the least recently used category
+    assert _values(impacts["c1"]) == [1, 10]
+    assert _values(impacts["c3"]) == [3, 30]
+    assert heads["c2"].impact_factors is None
+    assert heads["c1"].impact_factors is not None
+
+    # an evicted category is read again, without duplicate factors
+    assert _values(impacts["c2"]) == [2, 20]
+    assert heads["c1"].impact_factors is None
+    assert heads["c3"].impact_factors is not None
+
+
+def test_lazy_factors_of_files_with_other_names(refdata):
+    _refdata(refdata)
+    folder = model._ref_dir / "lcia_factors"
+    (folder / "c2.csv").rename(folder / "other.csv")
+    data = model.RefData.read(lazy=True, max_factor_lists=1)
+    assert _values(data.impact_categories["c2"]) == [2, 20]
+    assert _values(data.impact_categories["c1"]) == [1, 10]
+    assert model._impact_heads(data)["c2"].impact_factors is None
@@ -0,0 +1,52 @@
+# tests of sorting the reference data files; run with
+# python -m pytest scripts
+
+import hashlib
+import random
+
+import pytest
+
+import order
+
+
+def _write(path, newline: str = "\n"):
+    rand = random.Random(42)
+    lines = ["category,flow,value"]
+    for i in range(2000):
+        # many duplicate keys, so that the order of ties is tested too
+        lines.append(f"c{rand.randrange(5)},f{rand.randrange(40)},{i}")
+    path.write_bytes((newline.join(lines) + newline).encode("utf-8"))
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_external_sort_matches_memory_sort(tmp_path, monkeypatch, newline):
+    # small runs and a small fan-in, so that runs are merged in passes
+    monkeypatch.setattr(order, "_MIN_RUN_ROWS", 50)
+    monkeypatch.setattr(order, "_MAX_FAN_IN", 3)
+    small = tmp_path / "small.csv"
+    large = tmp_path / "large.csv"
+    _write(small, newline)
+    _write(large, newline)
+
+    (changed, digest) = order.canonicalize(small, [0, 1], budget=1 << 30)
+    assert changed
+    assert digest == hashlib.sha1(small.read_bytes()).hexdigest()
+    (changed, digest) = order.canonicalize(large, [0, 1], budget=1)
+    assert changed
+    assert digest == hashlib.sha1(large.read_bytes()).hexdigest()
+    assert large.read_bytes() == small.read_bytes()
+
+    # rows with the same key keep their order like in a stable sort
+    rows = [r.split(",") for r in small.read_text().splitlines()[1:]]
+    assert rows == sorted(rows, key=lambda r: (r[0], r[1], int(r[2])))
+
+    # a canonical file is not changed again
+    assert order.canonicalize(large, [0, 1], budget=1) == (False, digest)
+    assert order.canonicalize(small, [0, 1]) == (False, digest)
+
+
+def test_sort_of_empty_file(tmp_path):
+    path = tmp_path / "empty.csv"
+    path.write_bytes(b"")
+    assert order.canonicalize(path, [0], budget=1)[0] is False
+    assert order.canonicalize(path, [0])[0] is False
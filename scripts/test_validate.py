@@ -0,0 +1,86 @@
+# tests of the validation of the reference data; run with
+# python -m pytest scripts
+
+import validate
+
+
+def _issues(refdata) -> dict[tuple[str, str], list[validate.Issue]]:
+    refdata(
+        {
+            "flows.csv": (
+                "ID,Name,Description,Category,Type,CAS,Formula,Property\n"
+                "f1,flow 1,,Elementary flows/air,elementary,,,Mass\n"
+                "f2,flow 2,,Elementary flows/air,elementary,,,Mass\n"
+                "f3,flow 3,,Elementary flows/air,unknown,,,Volume X\n"
+            ),
+            "lcia_categories.csv": (
+                "ID,Name,Description,Category,Reference unit\n"
+                "c1,Climate,,M,kg CO2 eq\n"
+            ),
+            "lcia_factors/c1.csv": (
+                "LCIA category,Flow,Flow property,Flow unit,Location,Factor\n"
+                "c1,f1,Mass,kg,,1\n"
+                "c1,f9,Mass,kg,,2\n"
+                "c1,f2,Mass,MJ,,3\n"
+                "c1,f2,Energy,MJ,,4\n"
+                "c1,f1,Mass,kg,XX,5\n"
+                "cX,f1,Mass,kg,,6\n"
+                "c1,f1,Mass,kg,,a *\n"
+                "c1,f1,Mass,g,,a * 2\n"
+                "c1,f9,Mass,kg,,7\n"
+                "c1,f2,Mass,kg,,inf\n"
+            ),
+            "mappings/Test_Export.csv": (
+                "f1;t1;0\n"
+                "f1;t1;1\n"
+                "f8;t2;1\n"
+            ),
+        }
+    )
+    issues: dict[tuple[str, str], list[validate.Issue]] = {}
+    for issue in validate.validate():
+        issues.setdefault((issue.file, issue.check), []).append(issue)
+    return issues
+
+
+def test_broken_references(refdata):
+    issues = _issues(refdata)
+    factors = "lcia_factors/c1.csv"
+
+    [flow] = issues[(factors, "dangling-flow")]
+    assert (flow.line, flow.value, flow.count) == (3, "f9", 2)
+    [category] = issues[(factors, "dangling-category")]
+    assert category.value == "cX"
+    [location] = issues[(factors, "dangling-location")]
+    assert (location.line, location.value) == (6, "XX")
+
+    [unit] = issues[(factors, "unit-not-in-group")]
+    assert (unit.line, unit.value) == (4, "MJ")
+    [prop] = issues[(factors, "property-not-in-flow")]
+    assert (prop.line, prop.value) == (5, "Energy")
+
+    [flow_type] = issues[("flows.csv", "invalid-flow-type")]
+    assert (flow_type.line, flow_type.value) == (4, "unknown")
+    [prop] = issues[("flows.csv", "dangling-flow-property")]
+    assert prop.value == "Volume X"
+
+
+def test_invalid_numbers_and_formulas(refdata):
+    issues = _issues(refdata)
+    numbers = issues[("lcia_factors/c1.csv", "invalid-number")]
+    # a valid formula like `a * 2` is not reported
+    assert sorted((i.line, i.value) for i in numbers) == [
+        (8, "a *"),
+        (11, "inf"),
+    ]
+
+
+def test_broken_mapping(refdata):
+    issues = _issues(refdata)
+    file = "mappings/Test_Export.csv"
+    [number] = issues[(file, "invalid-number")]
+    assert (number.line, number.value) == (1, "0")
+    [duplicate] = issues[(file, "duplicate-mapping")]
+    assert (duplicate.line, duplicate.severity) == (2, "warning")
+    [flow] = issues[(file, "dangling-flow")]
+    assert flow.value == "f8"
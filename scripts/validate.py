@@ -0,0 +1,665 @@
+# This script checks the referential integrity of the reference data and the
+# flow mappings and writes the found issues as JSON report. It exits with a
+# non-zero status code when errors were found, so that it can be used as a
+# check before merging changes. Instead of building the model objects, the
+# IDs and names of the entities are collected in sets first and the keys
+# that are used in the files are then joined against these sets.
+
+import argparse
+import csv
+import json
+import logging as log
+import math
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+import formulas
+import model
+
+from flowmap import Col
+
+
+@dataclass
+class Issue:
+    file: str
+    line: int
+    check: str
+    value: str
+    message: str = ""
+    count: int = 1
+    severity: str = "error"
+
+
+@dataclass
+class Keys:
+    """The valid keys (IDs and names) of the reference data."""
+
+    units: set[str] = field(default_factory=set)
+    unit_groups: set[str] = field(default_factory=set)
+    currencies: set[str] = field(default_factory=set)
+    locations: set[str] = field(default_factory=set)
+    impacts: set[str] = field(default_factory=set)
+    methods: set[str] = field(default_factory=set)
+
+    # flow property keys -> flow property IDs
+    props: dict[str, str] = field(default_factory=dict)
+
+    # flow property ID -> keys of the units of its unit group
+    units_of_prop: dict[str, set[str]] = field(default_factory=dict)
+
+    # flow ID -> flow property IDs of the flow; `None` when there is no
+    # flows.csv, then flow references are not checked
+    flows: dict[str, set[str]] | None = None
+
+
+class _Join:
+    """Collects the keys that are used in a file with the first line and
+    the number of their occurrences, to join them with a set of valid keys
+    at once."""
+
+    def __init__(self):
+        self.used: dict[str, list[int]] = {}
+
+    def add(self, line: int, key: str):
+        entry = self.used.get(key)
+        if entry is None:
+            self.used[key] = [line, 1]
+        else:
+            entry[1] += 1
+
+    def missing(
+        self, file: str, check: str, valid: set[str] | dict
+    ) -> list[Issue]:
+        return [
+            Issue(file, line, check, key, count=count)
+            for (key, (line, count)) in self.used.items()
+            if key not in valid
+        ]
+
+
+# the keys of the reference data; set in the worker processes
+_keys: Keys | None = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="checks the referential integrity of the reference data"
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=Path(__file__).parent.parent / "build" / "validation.json",
+        help="the file of the JSON report",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="the number of files checked in parallel",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="read the LCIA factors from the cache of build/cache",
+    )
+    args = parser.parse_args()
+
+    issues = validate(args.workers, args.cache)
+    args.out.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as out:
+        json.dump(report_of(issues), out, indent=2)
+
+    errors = sum(1 for i in issues if i.severity == "error")
+    print(f"{errors} errors, {len(issues) - errors} warnings -> {args.out}")
+    sys.exit(1 if errors > 0 else 0)
+
+
+def validate(workers: int = 1, cache: bool = False) -> list[Issue]:
+    (keys, issues) = collect_keys()
+    if keys.flows is None:
+        issues.append(
+            Issue(
+                "flows.csv",
+                0,
+                "missing-file",
+                "flows.csv",
+                "flow references are not checked",
+                severity="warning",
+            )
+        )
+
+    factor_dir = model._ref_dir / "lcia_factors"
+    shards = sorted(factor_dir.iterdir()) if factor_dir.exists() else []
+    mapping_dir = model._ref_dir / "mappings"
+    mappings = (
+        sorted(mapping_dir.glob("*.csv")) if mapping_dir.exists() else []
+    )
+    tasks = [(_check_shard, p, cache) for p in shards] + [
+        (_check_mapping, p, cache) for p in mappings
+    ]
+    if workers > 1:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init, initargs=(keys,)
+        ) as pool:
+            for found in pool.map(_run, tasks, chunksize=4):
+                issues.extend(found)
+    else:
+        _init(keys)
+        for task in tasks:
+            issues.extend(_run(task))
+    return issues
+
+
+def report_of(issues: list[Issue]) -> dict:
+    summary: dict[str, int] = {}
+    for issue in issues:
+        summary[issue.check] = summary.get(issue.check, 0) + issue.count
+    return {
+        "errors": sum(1 for i in issues if i.severity == "error"),
+        "warnings": sum(1 for i in issues if i.severity == "warning"),
+        "summary": summary,
+        "issues": [asdict(i) for i in issues],
+    }
+
+
+def collect_keys() -> tuple[Keys, list[Issue]]:
+    """Collects the keys of the reference data and checks the references
+    between the entities in the top-level files."""
+    keys = Keys()
+    issues: list[Issue] = []
+
+    # units and unit groups
+    units: list[tuple[int, str, list[str]]] = []
+    ref_factors: dict[str, float | None] = {}
+    join = _Join()
+    for (line, row) in _rows("units.csv", 6, issues):
+        units.append((line, row[0], row))
+        _check_number("units.csv", line, row[3], issues)
+        keys.units.update((row[0], row[1]))
+        ref_factors[row[0]] = ref_factors[row[1]] = _num(row[3])
+        join.add(line, row[5])
+    issues.extend(_heads("units.csv", units))
+
+    default_props: list[tuple[int, str, str]] = []
+    heads: list[tuple[int, str, list[str]]] = []
+    for (line, row) in _rows("unit_groups.csv", 6, issues):
+        heads.append((line, row[0], row))
+        keys.unit_groups.update((row[0], row[1]))
+        if row[4].strip() != "":
+            default_props.append((line, row[0], row[4]))
+    issues.extend(_heads("unit_groups.csv", heads))
+    issues.extend(
+        join.missing("units.csv", "dangling-unit-group", keys.unit_groups)
+    )
+
+    # the unit keys of each group; a unit refers to a group by ID or name
+    group_id_of = {}
+    for (_, gid, row) in heads:
+        group_id_of[gid] = group_id_of[row[1]] = gid
+    units_of_group: dict[str, set[str]] = {}
+    for (_, _, row) in units:
+        gid = group_id_of.get(row[5])
+        if gid is not None:
+            units_of_group.setdefault(gid, set()).update((row[0], row[1]))
+    for (line, gid, row) in heads:
+        ref_unit = row[5]
+        if ref_unit not in units_of_group.get(gid, set()):
+            issues.append(
+                Issue(
+                    "unit_groups.csv",
+                    line,
+                    "ref-unit",
+                    ref_unit,
+                    f"not a unit of group {gid}",
+                )
+            )
+        elif ref_factors.get(ref_unit) != 1.0:
+            issues.append(
+                Issue(
+                    "unit_groups.csv",
+                    line,
+                    "ref-unit",
+                    ref_unit,
+                    "conversion factor of the reference unit is not 1",
+                )
+            )
+
+    # flow properties
+    heads = []
+    join = _Join()
+    group_of_prop: dict[str, str] = {}
+    for (line, row) in _rows("flow_properties.csv", 6, issues):
+        heads.append((line, row[0], row))
+        keys.props[row[0]] = keys.props[row[1]] = row[0]
+        join.add(line, row[4])
+        gid = group_id_of.get(row[4])
+        if gid is not None:
+            group_of_prop[row[0]] = gid
+            keys.units_of_prop[row[0]] = units_of_group.get(gid, set())
+    issues.extend(_heads("flow_properties.csv", heads))
+    issues.extend(
+        join.missing("flow_properties.csv", "dangling-unit-group", group_id_of)
+    )
+    for (line, gid, prop) in default_props:
+        prop_id = keys.props.get(prop)
+        if prop_id is None:
+            issues.append(
+                Issue("unit_groups.csv", line, "dangling-flow-property", prop)
+            )
+        elif group_of_prop.get(prop_id) != gid:
+            issues.append(
+                Issue(
+                    "unit_groups.csv",
+                    line,
+                    "default-property",
+                    prop,
+                    f"the property is not in group {gid}",
+                )
+            )
+
+    # currencies
+    heads = []
+    ref_currencies = _Join()
+    for (line, row) in _rows("currencies.csv", 7, issues):
+        heads.append((line, row[0], row))
+        keys.currencies.update((row[0], row[1]))
+        _check_number("currencies.csv", line, row[6], issues)
+        ref_currencies.add(line, row[4])
+    issues.extend(_heads("currencies.csv", heads))
+    issues.extend(
+        ref_currencies.missing(
+            "currencies.csv", "dangling-currency", keys.currencies
+        )
+    )
+    if len(ref_currencies.used) > 1:
+        for (key, (line, count)) in ref_currencies.used.items():
+            issues.append(
+                Issue(
+                    "currencies.csv",
+                    line,
+                    "ref-currency",
+                    key,
+                    "currencies have different reference currencies",
+                    count=count,
+                )
+            )
+
+    # flows
+    if (model._ref_dir / "flows.csv").exists():
+        keys.flows = {}
+        heads = []
+        join = _Join()
+        for (line, row) in _rows("flows.csv", 8, issues):
+            heads.append((line, row[0], row))
+            if model._flow_type_of(row[4]) is None:
+                issues.append(
+                    Issue("flows.csv", line, "invalid-flow-type", row[4])
+                )
+            join.add(line, row[7])
+            prop_id = keys.props.get(row[7])
+            keys.flows[row[0]] = set() if prop_id is None else {prop_id}
+        issues.extend(_heads("flows.csv", heads, aliases=False))
+        issues.extend(
+            join.missing("flows.csv", "dangling-flow-property", keys.props)
+        )
+
+        flows = _Join()
+        props = _Join()
+        for (line, row) in _rows("flow_property_factors.csv", 3, issues):
+            _check_number("flow_property_factors.csv", line, row[2], issues)
+            flows.add(line, row[0])
+            props.add(line, row[1])
+            prop_id = keys.props.get(row[1])
+            flow_props = keys.flows.get(row[0])
+            if flow_props is not None and prop_id is not None:
+                flow_props.add(prop_id)
+        file = "flow_property_factors.csv"
+        issues.extend(flows.missing(file, "dangling-flow", keys.flows))
+        issues.extend(
+            props.missing(file, "dangling-flow-property", keys.props)
+        )
+
+    # locations
+    heads = []
+    for (line, row) in _rows("locations.csv", 7, issues):
+        heads.append((line, row[0], row))
+        keys.locations.update((row[0], row[1]))
+        _check_number("locations.csv", line, row[5], issues)
+        _check_number("locations.csv", line, row[6], issues)
+    issues.extend(_heads("locations.csv", heads))
+
+    # LCIA categories and methods
+    heads = []
+    for (line, row) in _rows("lcia_categories.csv", 5, issues):
+        heads.append((line, row[0], row))
+        keys.impacts.add(row[0])
+    issues.extend(_heads("lcia_categories.csv", heads, aliases=False))
+
+    heads = []
+    for (line, row) in _rows("lcia_methods.csv", 4, issues):
+        heads.append((line, row[0], row))
+        keys.methods.update((row[0], row[1]))
+    issues.extend(_heads("lcia_methods.csv", heads))
+
+    methods = _Join()
+    impacts = _Join()
+    for (line, row) in _rows("lcia_method_categories.csv", 2, issues):
+        methods.add(line, row[0])
+        impacts.add(line, row[1])
+    file = "lcia_method_categories.csv"
+    issues.extend(methods.missing(file, "dangling-method", keys.methods))
+    issues.extend(impacts.missing(file, "dangling-category", keys.impacts))
+
+    methods = _Join()
+    impacts = _Join()
+    for (line, row) in _rows("lcia_method_nw_sets.csv", 7, issues):
+        methods.add(line, row[0])
+        impacts.add(line, row[3])
+        for s in (row[4], row[5]):
+            if s.strip() != "":
+                _check_number("lcia_method_nw_sets.csv", line, s, issues)
+    file = "lcia_method_nw_sets.csv"
+    issues.extend(methods.missing(file, "dangling-method", keys.methods))
+    issues.extend(impacts.missing(file, "dangling-category", keys.impacts))
+
+    return (keys, issues)
+
+
+def _init(keys: Keys):
+    global _keys
+    _keys = keys
+
+
+def _run(task) -> list[Issue]:
+    (fn, path, cache) = task
+    return fn(path, cache)
+
+
+def _check_shard(path: Path, cache: bool = False) -> list[Issue]:
+    """Checks the references of the characterization factors in a shard of
+    the `lcia_factors` folder."""
+    assert _keys is not None
+    keys = _keys
+    file = f"lcia_factors/{path.name}"
+    shard = model._read_factor_shard(
+        path, model._Cache(model._cache_dir) if cache else None
+    )
+    codes = np.frombuffer(shard.codes, dtype=np.intc).reshape((-1, 5))
+    issues: list[Issue] = []
+
+    def dangling(col: int, check: str, valid: Iterable[str] | None):
+        if valid is None:
+            return
+        (used, first, counts) = _groups(codes[:, col])
+        for (code, row, count) in zip(used, first, counts):
+            key = shard.keys[code]
+            if key in valid or (col == 4 and key == ""):
+                continue
+            issues.append(
+                Issue(file, int(row) + 2, check, key, count=int(count))
+            )
+
+    dangling(0, "dangling-category", keys.impacts)
+    dangling(1, "dangling-flow", keys.flows)
+    dangling(2, "dangling-flow-property", keys.props)
+    dangling(3, "dangling-unit", keys.units)
+    dangling(4, "dangling-location", keys.locations)
+
+    # the unit of a factor must be a unit of the group of its property and
+    # the property must be a property of the flow
+    (pairs, first, counts) = _groups(codes[:, 2:4])
+    for ((p, u), row, count) in zip(pairs, first, counts):
+        group = keys.units_of_prop.get(keys.props.get(shard.keys[p], ""))
+        if group is None or shard.keys[u] in group:
+            continue
+        issues.append(
+            Issue(
+                file,
+                int(row) + 2,
+                "unit-not-in-group",
+                shard.keys[u],
+                f"not a unit of flow property {shard.keys[p]}",
+                count=int(count),
+            )
+        )
+    if keys.flows is not None:
+        (pairs, first, counts) = _groups(codes[:, 1:3])
+        for ((f, p), row, count) in zip(pairs, first, counts):
+            flow_props = keys.flows.get(shard.keys[f])
+            prop_id = keys.props.get(shard.keys[p])
+            if flow_props is None or prop_id is None or prop_id in flow_props:
+                continue
+            issues.append(
+                Issue(
+                    file,
+                    int(row) + 2,
+                    "property-not-in-flow",
+                    shard.keys[p],
+                    f"not a flow property of flow {shard.keys[f]}",
+                    count=int(count),
+                )
+            )
+
+    values = np.frombuffer(shard.values, dtype=np.float64)
+    for i in np.flatnonzero(~np.isfinite(values)):
+        issues.append(
+            Issue(file, int(i) + 2, "invalid-number", str(values[i]))
+        )
+    for (i, formula) in shard.formulas.items():
+        if not formulas.is_formula(formula):
+            issues.append(Issue(file, i + 2, "invalid-number", formula))
+    return issues
+
+
+def _check_mapping(path: Path, cache: bool = False) -> list[Issue]:
+    """Checks the rows of a flow mapping file. The flows of the openLCA side
+    of a mapping, the target flows of an import or the source flows of an
+    export mapping, are checked against the reference data."""
+    assert _keys is not None
+    keys = _keys
+    file = f"mappings/{path.name}"
+    issues: list[Issue] = []
+    if path.stem.endswith("_Import"):
+        (flow, prop, unit) = (
+            Col.TARGET_FLOW_UUID,
+            Col.TARGET_PROPERTY_UUID,
+            Col.TARGET_UNIT_UUID,
+        )
+    elif path.stem.endswith("_Export"):
+        (flow, prop, unit) = (
+            Col.SOURCE_FLOW_UUID,
+            Col.SOURCE_PROPERTY_UUID,
+            Col.SOURCE_UNIT_UUID,
+        )
+    else:
+        (flow, prop, unit) = (None, None, None)
+
+    flows = _Join()
+    props = _Join()
+    units: dict[tuple[str, str], list[int]] = {}
+    sources: dict[tuple[str, str], int] = {}
+    for (line, row) in _rows(path, 3, issues, delimiter=";", header=False):
+        x = _num(row[Col.FACTOR])
+        if x is None or x == 0 or not math.isfinite(x):
+            issues.append(
+                Issue(
+                    file,
+                    line,
+                    "invalid-number",
+                    row[Col.FACTOR],
+                    "conversion factor must be a non-zero number",
+                )
+            )
+        pair = (row[Col.SOURCE_FLOW_UUID], row[Col.TARGET_FLOW_UUID])
+        first = sources.get(pair)
+        if first is None:
+            sources[pair] = line
+        else:
+            issues.append(
+                Issue(
+                    file,
+                    line,
+                    "duplicate-mapping",
+                    f"{pair[0]} -> {pair[1]}",
+                    f"already defined in line {first}",
+                    severity="warning",
+                )
+            )
+        if flow is None:
+            continue
+        flows.add(line, row[flow])
+        p = row[prop] if prop < len(row) else ""
+        u = row[unit] if unit < len(row) else ""
+        if p != "":
+            props.add(line, p)
+        if p != "" and u != "":
+            entry = units.get((p, u))
+            if entry is None:
+                units[(p, u)] = [line, 1]
+            else:
+                entry[1] += 1
+
+    if keys.flows is not None:
+        issues.extend(flows.missing(file, "dangling-flow", keys.flows))
+    issues.extend(props.missing(file, "dangling-flow-property", keys.props))
+    for ((p, u), (line, count)) in units.items():
+        group = keys.units_of_prop.get(keys.props.get(p, ""))
+        if group is None or u in group:
+            continue
+        issues.append(
+            Issue(
+                file,
+                line,
+                "unit-not-in-group",
+                u,
+                f"not a unit of flow property {p}",
+                count=count,
+            )
+        )
+    return issues
+
+
+def _rows(
+    file: str | Path,
+    columns: int,
+    issues: list[Issue],
+    delimiter: str = ",",
+    header: bool = True,
+) -> Iterable[tuple[int, list[str]]]:
+    """Reads the rows of a file with their line numbers; rows with less
+    than the given number of columns are reported and skipped."""
+    path = model._ref_dir / file if isinstance(file, str) else file
+    if not path.exists():
+        return
+    name = str(path.relative_to(model._ref_dir))
+    with open(path, "r", encoding="utf-8", newline="") as inp:
+        reader = csv.reader(inp, delimiter=delimiter)
+        if header:
+            next(reader, None)
+        for row in reader:
+            line = reader.line_num
+            if len(row) == 0:
+                continue
+            if len(row) < columns:
+                issues.append(
+                    Issue(
+                        name,
+                        line,
+                        "missing-columns",
+                        str(len(row)),
+                        f"expected at least {columns} columns",
+                    )
+                )
+                continue
+            yield (line, row)
+
+
+def _heads(
+    file: str,
+    heads: list[tuple[int, str, list[str]]],
+    aliases: bool = True,
+) -> list[Issue]:
+    """Checks for duplicate IDs and, when entities are also referenced by
+    name, for names that are used by other entities as name or ID."""
+    issues: list[Issue] = []
+    ids: dict[str, int] = {}
+    for (line, eid, _) in heads:
+        first = ids.get(eid)
+        if first is None:
+            ids[eid] = line
+            continue
+        issues.append(
+            Issue(
+                file,
+                line,
+                "duplicate-id",
+                eid,
+                f"already defined in line {first}",
+            )
+        )
+    if not aliases:
+        return issues
+
+    names: dict[str, tuple[int, str]] = {}
+    for (line, eid, row) in heads:
+        name = row[1]
+        if name in ids and name != eid:
+            issues.append(
+                Issue(
+                    file,
+                    line,
+                    "alias-conflict",
+                    name,
+                    "the name is also the ID of another entity",
+                )
+            )
+        first = names.get(name)
+        if first is None:
+            names[name] = (line, eid)
+        elif first[1] != eid:
+            issues.append(
+                Issue(
+                    file,
+                    line,
+                    "alias-conflict",
+                    name,
+                    f"the name is also used in line {first[0]}",
+                    severity="warning",
+                )
+            )
+    return issues
+
+
+def _num(s: str) -> float | None:
+    try:
+        return float(s)
+    except ValueError:
+        return None
+
+
+def _check_number(file: str, line: int, s: str, issues: list[Issue]):
+    x = _num(s)
+    if x is None or not math.isfinite(x):
+        issues.append(Issue(file, line, "invalid-number", s))
+
+
+def _groups(columns: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the distinct rows of the given code columns with the index of
+    their first occurrence and the number of their occurrences."""
+    (groups, first, inverse) = np.unique(
+        columns, axis=0, return_index=True, return_inverse=True
+    )
+    counts = np.bincount(inverse.ravel(), minlength=len(groups))
+    return (groups, first, counts)
+
+
+if __name__ == "__main__":
+    log.basicConfig(level=log.INFO)
+    main()